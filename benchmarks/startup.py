@@ -0,0 +1,97 @@
+"""Measure how long a Database takes to start and serve its first query.
+
+Creates a data directory with many namespaces, then starts a fresh
+interpreter twice: once opening namespaces lazily (the default), and once
+touching every namespace up front the way startup used to. Each run reports
+the time to construct the Database, the time until the first db_get
+returns, the open file descriptors and which heavy plugin modules were
+imported.
+
+    python benchmarks/startup.py --namespaces 500 --storage leveldb
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+LIATH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'liath')
+HEAVY_MODULES = ['llama_cpp', 'openai', 'fastembed', 'pandas', 'usearch', 'numpy']
+
+
+def open_database(args):
+    sys.path.insert(0, LIATH_DIR)
+    from database import Database
+    return Database(data_dir=args.data_dir, plugins_dir=os.path.join(LIATH_DIR, 'plugins'),
+                    storage_type=args.storage, storage_layout=args.layout)
+
+
+def populate(args):
+    db = open_database(args)
+    # Keep the number of open DBs bounded while populating
+    db.max_open_namespaces = 16
+    for i in range(args.namespaces):
+        name = f"tenant{i}"
+        db.create_namespace(name)
+        db.execute_query(name, "db_put('greeting', 'hello')")
+    db.close()
+
+
+def measure(args):
+    start = time.perf_counter()
+    db = open_database(args)
+    constructed = time.perf_counter()
+    if args.eager:
+        for name in db.list_namespaces():
+            db.execute_query(name, "return 1")
+    result = db.execute_query('tenant0', "return db_get('greeting')")
+    first_query = time.perf_counter()
+    assert result == 'hello', result
+    report = {
+        'mode': 'eager' if args.eager else 'lazy',
+        'init_s': round(constructed - start, 3),
+        'first_query_s': round(first_query - start, 3),
+        'open_namespaces': len(db.open_namespaces()),
+        'open_fds': len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None,
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+    db.close()
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--namespaces', type=int, default=200)
+    parser.add_argument('--storage', default='auto', choices=['auto', 'rocksdb', 'leveldb'])
+    parser.add_argument('--layout', default='per_namespace', choices=['per_namespace', 'shared'])
+    parser.add_argument('--data-dir')
+    parser.add_argument('--eager', action='store_true')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args)
+        return
+
+    created = args.data_dir is None
+    if created:
+        args.data_dir = tempfile.mkdtemp(prefix='liath-startup-')
+    data_dir = args.data_dir
+    try:
+        populate(args)
+        base = [sys.executable, os.path.abspath(__file__), '--measure', '--data-dir', data_dir,
+                '--storage', args.storage, '--layout', args.layout]
+        for extra in ([], ['--eager']):
+            # A fresh interpreter per run, so module imports are counted
+            output = subprocess.run(base + extra, check=True, capture_output=True, text=True).stdout
+            print(output.strip().splitlines()[-1])
+    finally:
+        if created:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from database import Database
 import json
 import yaml
 import argparse
+import uuid
 
 class DatabaseCLI(cmd.Cmd):
     intro = "Welcome to the Liath Database CLI. Type help or ? to list commands.\n"
@@ -14,6 +15,8 @@ class DatabaseCLI(cmd.Cmd):
         self.current_namespace = 'default'
         self.username = None
         self.return_format = 'dict'
+        # Keeps transactions open across queries typed in this shell
+        self.session_id = str(uuid.uuid4())
 
     def do_login(self, arg):
         """Login to the database: login username password"""
@@ -33,9 +36,13 @@ class DatabaseCLI(cmd.Cmd):
             print(f"Namespace '{arg}' does not exist")
 
     def do_create_namespace(self, arg):
-        """Create a new namespace: create_namespace namespace_name"""
-        self.db.create_namespace(arg)
-        print(f"Created namespace: {arg}")
+        """Create a new namespace: create_namespace namespace_name [storage_profile]"""
+        parts = arg.split()
+        try:
+            self.db.create_namespace(parts[0], profile=parts[1] if len(parts) > 1 else None)
+            print(f"Created namespace: {parts[0]}")
+        except ValueError as e:
+            print("Error:", str(e))
 
     def do_list_namespaces(self, arg):
         """List all namespaces"""
@@ -68,20 +75,49 @@ class DatabaseCLI(cmd.Cmd):
             query = '\n'.join(lines)
             self._execute_query(query)
 
+    def do_prepare(self, arg):
+        """Register a named query in the current namespace: prepare name query"""
+        if not self.username:
+            print("Please login first")
+            return
+
+        try:
+            name, query = arg.split(None, 1)
+            self.db.prepare(self.current_namespace, name, query)
+            print(f"Prepared query: {name}")
+        except ValueError as e:
+            print("Error:", str(e))
+
+    def do_execute(self, arg):
+        """Run a prepared query with JSON params: execute name [params_json]"""
+        if not self.username:
+            print("Please login first")
+            return
+
+        parts = arg.split(None, 1)
+        try:
+            params = json.loads(parts[1]) if len(parts) > 1 else {}
+            self._print_result(self.db.execute_prepared(self.current_namespace, parts[0], params,
+                                                          session=self.session_id))
+        except Exception as e:
+            print("Error:", str(e))
+
     def _execute_query(self, query):
         try:
-            result = self.db.execute_query(self.current_namespace, query)
-            if self.return_format == 'dict':
-                print(result)
-            elif self.return_format == 'json':
-                print(json.dumps(result, indent=2))
-            elif self.return_format == 'yaml':
-                print(yaml.dump(result))
-            elif self.return_format == 'lua':
-                print(result)  # Assuming result is already in Lua format
+            self._print_result(self.db.execute_query(self.current_namespace, query, session=self.session_id))
         except Exception as e:
             print("Error:", str(e))
 
+    def _print_result(self, result):
+        if self.return_format == 'dict':
+            print(result)
+        elif self.return_format == 'json':
+            print(json.dumps(result, indent=2))
+        elif self.return_format == 'yaml':
+            print(yaml.dump(result))
+        elif self.return_format == 'lua':
+            print(result)  # Assuming result is already in Lua format
+
     def do_exit(self, arg):
         """Exit the CLI"""
         print("Goodbye!")
@@ -0,0 +1,65 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class CompiledQueryCache:
+    """Bounded LRU of compiled Lua query chunks.
+
+    Entries are keyed by namespace and a hash of the query text. A loaded
+    chunk belongs to the Lua runtime that compiled it, so each pooled runtime
+    holds its own entry for the same query.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(namespace, query):
+        return (namespace, hashlib.sha256(query.encode()).hexdigest())
+
+    def get(self, runtime, key):
+        entry_key = (runtime.id,) + key
+        with self._lock:
+            chunk = self._entries.get(entry_key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return chunk
+
+    def put(self, runtime, key, chunk):
+        with self._lock:
+            self._entries[(runtime.id,) + key] = chunk
+            self._entries.move_to_end((runtime.id,) + key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, namespace=None, query=None):
+        digest = self.key(namespace, query)[1] if query is not None else None
+        with self._lock:
+            stale = [
+                entry_key for entry_key in self._entries
+                if (namespace is None or entry_key[1] == namespace)
+                and (digest is None or entry_key[2] == digest)
+            ]
+            for entry_key in stale:
+                del self._entries[entry_key]
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,19 +1,51 @@
-from lupa import LuaRuntime, lua_type
+from lua_pool import LuaRuntimePool
+from lupa import lua_type
 import json
 import yaml
 import os
 import threading
 import importlib.util
 import inspect
+import logging
+import re
+import time
+from contextlib import contextmanager
 from plugin_base import PluginBase
+from compiled_cache import CompiledQueryCache
+from model_registry import registry
+from session import Session
+from rwlock import ReadWriteLock
 from storage.rocksdb_storage import RocksDBStorage
 from storage.leveldb_storage import LevelDBStorage
+from storage.encoding import DEFAULT_CODEC, get_codecs
+from storage.profiles import load_profiles, resolve_profile
+
+logger = logging.getLogger('Liath')
 
 class Database:
-    def __init__(self, data_dir='./data', plugins_dir='./plugins', storage_type='auto'):
+    def __init__(self, data_dir='./data', plugins_dir='./plugins', storage_type='auto', lua_pool_size=8,
+                 compiled_cache_size=1024, session_timeout=300, block_cache_size=512 * 1024 ** 2,
+                 storage_profiles=None, storage_layout='per_namespace', max_open_namespaces=None,
+                 namespace_idle_timeout=None, model_memory_budget=None):
         self.data_dir = data_dir
         self.plugins_dir = plugins_dir
+        self.lua_pool_size = lua_pool_size
         self.namespaces = {}
+        # Guards the per-namespace 'active' and 'last_used' bookkeeping
+        self._namespaces_lock = threading.Lock()
+        self.max_open_namespaces = max_open_namespaces
+        self.namespace_idle_timeout = namespace_idle_timeout
+        self.compiled_cache = CompiledQueryCache(compiled_cache_size)
+        # Models are shared by every Database in the process, so the budget
+        # is too
+        if model_memory_budget is not None:
+            registry.budget = model_memory_budget
+        self._metadata_lock = threading.Lock()
+        self.session_timeout = session_timeout
+        self.sessions = {}
+        self._sessions_lock = threading.Lock()
+        # (context, bound plugins) of the query running on each thread
+        self._query = threading.local()
         self.metadata_file = os.path.join(data_dir, 'metadata.json')
         
         if storage_type == 'auto':
@@ -29,42 +61,42 @@ class Database:
         else:
             raise ValueError("Invalid storage_type. Choose 'auto', 'rocksdb', or 'leveldb'")
 
-        self.auth_db = self.StorageClass(os.path.join(data_dir, "auth.db"))
-        self.lua = LuaRuntime(unpack_returned_tuples=True)
-        self._setup_lua_environment()
+        # One block cache for every DB this process opens, so memory use is
+        # bounded by block_cache_size no matter how many namespaces exist
+        self.block_cache = self.StorageClass.create_block_cache(block_cache_size)
+        self.storage_profiles = load_profiles(data_dir, storage_profiles)
+
+        self.auth_db = self._open_storage(os.path.join(data_dir, "auth.db"), 'default')
+
+        # 'per_namespace' keeps one DB per namespace. 'shared' keeps every
+        # namespace in one DB, as column families (RocksDB) or key prefixes
+        # (LevelDB), so open files and background work don't grow with the
+        # number of tenants.
+        if storage_layout == 'shared':
+            self.shared_db = self._open_storage(os.path.join(data_dir, "shared.db"), 'default')
+        elif storage_layout == 'per_namespace':
+            self.shared_db = None
+        else:
+            raise ValueError("Invalid storage_layout. Choose 'per_namespace' or 'shared'")
+        self.storage_layout = storage_layout
         self.plugins = self.load_plugins()
         self.load_metadata()
 
-    def _setup_lua_environment(self):
-        lua = LuaRuntime(unpack_returned_tuples=True)
-        
-        # Set up the Lua package path to include LuaRocks packages
-        setup_script = """
-        local home = os.getenv("HOME")
-        local lua_version = _VERSION:match("%d+%.%d+")
-        package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?.lua"
-        package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?/init.lua"
-        package.cpath = package.cpath .. ";" .. home .. "/.luarocks/lib/lua/" .. lua_version .. "/?.so"
-        
-        -- Add the namespace-specific LuaRocks path
-        local function add_namespace_path(namespace)
-            local ns_path = "NAMESPACE_PATH/" .. namespace
-            package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?.lua"
-            package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?/init.lua"
-            package.cpath = package.cpath .. ";" .. ns_path .. "/lib/lua/" .. lua_version .. "/?.so"
-        end
-        
-        -- Expose the add_namespace_path function to Python
-        return add_namespace_path
-        """
-        
-        # Replace NAMESPACE_PATH with the actual path to your namespaces
-        setup_script = setup_script.replace("NAMESPACE_PATH", os.path.join(self.data_dir, "namespaces"))
-        
-        # Execute the setup script and get the add_namespace_path function
-        self.add_namespace_path = lua.execute(setup_script)
-        
-        return lua
+        # Eviction also runs whenever a namespace opens, but an otherwise
+        # quiet process needs the sweep to close idle namespaces
+        self._stop_sweep = threading.Event()
+        self._sweeper = None
+        if namespace_idle_timeout is not None:
+            self._sweeper = threading.Thread(target=self._sweep_idle_namespaces, daemon=True)
+            self._sweeper.start()
+
+    def _sweep_idle_namespaces(self):
+        interval = min(max(self.namespace_idle_timeout / 2, 0.1), 60)
+        while not self._stop_sweep.wait(interval):
+            try:
+                self.evict_namespaces()
+            except Exception as e:
+                logger.warning(f"Closing idle namespaces failed: {e}")
 
     def load_plugins(self):
         plugins = {}
@@ -78,8 +110,7 @@ class Database:
                 
                 for name, obj in inspect.getmembers(module):
                     if inspect.isclass(obj) and issubclass(obj, PluginBase) and obj is not PluginBase:
-                        plugin = obj()
-                        plugins[plugin.name] = plugin
+                        plugins[obj().name] = obj
         return plugins
 
     def load_metadata(self):
@@ -87,86 +118,454 @@ class Database:
             with open(self.metadata_file, 'r') as f:
                 metadata = json.load(f)
                 for name, info in metadata.items():
-                    self.create_namespace(name, info['packages'])
+                    self._register_namespace(name, info['packages'], info.get('prepared'), info.get('codec'),
+                                             info.get('profile'))
         else:
             self.create_namespace('default')
 
     def save_metadata(self):
-        metadata = {name: {'packages': list(info['packages'])} for name, info in self.namespaces.items()}
-        with open(self.metadata_file, 'w') as f:
-            json.dump(metadata, f)
+        with self._metadata_lock:
+            metadata = {
+                name: {
+                    'packages': list(info['packages']),
+                    'prepared': info['prepared'],
+                    'codec': info['codec'],
+                    'profile': info['profile'],
+                }
+                for name, info in list(self.namespaces.items())
+            }
+            with open(self.metadata_file, 'w') as f:
+                json.dump(metadata, f)
 
-    def create_namespace(self, name, packages=None):
+    def create_namespace(self, name, packages=None, prepared=None, codec=None, profile=None):
         if name not in self.namespaces:
-            db_path = os.path.join(self.data_dir, f"{name}.db")
-            self.namespaces[name] = {
-                'db': self.StorageClass(db_path),
-                'lock': threading.Lock(),
-                'packages': set(packages or []),
-            }
+            if not name or '/' in name or '\x00' in name:
+                raise ValueError(f"Invalid namespace name '{name}'")
+            codec = dict(DEFAULT_CODEC, **(codec or {}))
+            get_codecs(codec)  # Fail early on unknown codec names
+            resolve_profile(self.storage_profiles, profile)
+            self._register_namespace(name, packages, prepared, codec, profile)
             self.save_metadata()
 
-            self.add_namespace_path(name)
-       
-    def execute_query(self, namespace, query, return_format='dict'):
+    def _register_namespace(self, name, packages=None, prepared=None, codec=None, profile=None):
+        # Namespaces are only opened when a query first needs them
+        self.namespaces[name] = {
+            'lock': ReadWriteLock(),
+            'open_lock': threading.Lock(),
+            'packages': set(packages or []),
+            'prepared': dict(prepared or {}),
+            'codec': dict(DEFAULT_CODEC, **(codec or {})),
+            'profile': profile or 'default',
+            'handle': None,
+            'active': 0,
+            'last_used': time.monotonic(),
+        }
+
+    @contextmanager
+    def _namespace(self, name):
+        # Yields the open handle of a namespace ({db, plugins, lua_pool,
+        # mutating_pattern}), opening it first if needed. A namespace is never
+        # evicted while a caller is inside this block.
+        if name not in self.namespaces:
+            raise ValueError(f"Namespace '{name}' does not exist")
+        ns = self.namespaces[name]
+        with self._namespaces_lock:
+            ns['active'] += 1
+        try:
+            opened = False
+            with ns['open_lock']:
+                if ns['handle'] is None:
+                    ns['handle'] = self._open_namespace(name, ns)
+                    opened = True
+            if opened:
+                self.evict_namespaces(exclude=name)
+            yield ns['handle']
+        finally:
+            with self._namespaces_lock:
+                ns['active'] -= 1
+                ns['last_used'] = time.monotonic()
+
+    def _open_namespace(self, name, ns):
+        if self.shared_db is not None:
+            # Storage profiles are per DB, so shared namespaces use the shared DB's
+            db = self.shared_db.namespace_view(name)
+        else:
+            db = self._open_storage(os.path.join(self.data_dir, f"{name}.db"), ns['profile'])
+        context = self._plugin_context(name, db, ns['packages'], ns['codec'])
+        plugins, lazy = self._start_plugins(context)
+        handle = {
+            'db': db,
+            'context': context,
+            # Started plugins. Replaced, never mutated, when a lazy plugin
+            # starts, so queries can iterate over it without a lock.
+            'plugins': plugins,
+            'lazy': lazy,
+            'start_lock': threading.Lock(),
+            'mutating_pattern': self._mutating_pattern({**plugins, **lazy}),
+        }
+        # Lazy plugins get this when they start; eager ones can't rely on
+        # their peers having started yet
+        context['plugin'] = self._plugin_lookup(handle)
+        handle['lua_pool'] = self._create_lua_pool(name, handle)
+        return handle
+
+    def _close_namespace(self, name, handle):
+        handle['lua_pool'].close()
+        self._stop_plugins(handle['plugins'])
+        handle['db'].close()
+        self.compiled_cache.invalidate(name)
+
+    def evict_namespaces(self, exclude=None):
+        # Closes namespaces idle for longer than namespace_idle_timeout, then
+        # the least recently used ones beyond max_open_namespaces. Namespaces
+        # in use or with an open session transaction are left alone.
+        with self._sessions_lock:
+            pinned = {ns for (ns, _), session in self.sessions.items() if session.transaction is not None}
+        with self._namespaces_lock:
+            open_names = [name for name, ns in self.namespaces.items() if ns['handle'] is not None]
+            idle = sorted(
+                (name for name in open_names
+                 if name != exclude and name not in pinned and self.namespaces[name]['active'] == 0),
+                key=lambda name: self.namespaces[name]['last_used'],
+            )
+        victims = []
+        if self.namespace_idle_timeout is not None:
+            cutoff = time.monotonic() - self.namespace_idle_timeout
+            victims = [name for name in idle if self.namespaces[name]['last_used'] < cutoff]
+        if self.max_open_namespaces is not None:
+            excess = len(open_names) - len(victims) - self.max_open_namespaces
+            victims += [name for name in idle if name not in victims][:max(excess, 0)]
+
+        evicted = []
+        for name in victims:
+            ns = self.namespaces[name]
+            # Skip namespaces someone else is opening or closing right now
+            if not ns['open_lock'].acquire(blocking=False):
+                continue
+            try:
+                with self._namespaces_lock:
+                    # Someone may have started using it since the sweep began
+                    handle = None if ns['active'] else ns['handle']
+                    if handle is not None:
+                        ns['handle'] = None
+                if handle is not None:
+                    self._close_namespace(name, handle)
+                    evicted.append(name)
+            finally:
+                ns['open_lock'].release()
+        return evicted
+
+    def open_namespaces(self):
+        return [name for name, ns in list(self.namespaces.items()) if ns['handle'] is not None]
+
+    def _open_storage(self, path, profile):
+        options = resolve_profile(self.storage_profiles, profile)
+        options['block_cache'] = self.block_cache
+        return self.StorageClass(path, options)
+
+    def _plugin_context(self, namespace, db, packages, codec):
+        return {
+            'namespace': namespace,
+            'db': db,
+            'packages': packages,
+            'codec': codec,
+            'data_dir': self.data_dir
+        }
+
+    def _start_plugins(self, context):
+        # Returns (started, lazy). Lazy plugins are initialized by the first
+        # call to one of their Lua functions.
+        plugins, lazy = {}, {}
+        for name, plugin_class in self.plugins.items():
+            plugin = plugin_class()
+            if plugin.lazy:
+                lazy[name] = plugin
+                continue
+            try:
+                plugin.initialize(context)
+            except Exception as e:
+                logger.warning(f"Plugin '{name}' failed to start in namespace '{context['namespace']}': {e}")
+                continue
+            plugins[name] = plugin
+        return plugins, lazy
+
+    def _start_lazy_plugin(self, handle, name):
+        with handle['start_lock']:
+            if name in handle['plugins']:
+                return
+            plugin = handle['lazy'][name]
+            try:
+                plugin.initialize(handle['context'])
+            except Exception as e:
+                logger.warning(f"Plugin '{name}' failed to start in namespace '{handle['context']['namespace']}': {e}")
+                raise RuntimeError(f"Plugin '{name}' failed to start: {e}")
+            handle['plugins'] = dict(handle['plugins'], **{name: plugin})
+
+    def _lazy_function(self, handle, name, func):
+        # Arguments are passed through untouched; func unpacks Lua tables
+        # itself if it was wrapped with lua_callable
+        plugin = handle['lazy'][name]
+
+        def wrapper(*args):
+            if name not in handle['plugins']:
+                self._start_lazy_plugin(handle, name)
+            self._bind_late(plugin)
+            return func(*args)
+        return wrapper
+
+    def _bind_late(self, plugin):
+        # Queries that began before the plugin started haven't bound it
+        current = getattr(self._query, 'current', None)
+        if current is not None and plugin not in current[1]:
+            plugin.bind(current[0])
+            current[1].append(plugin)
+
+    def _plugin_lookup(self, handle):
+        # Returns context['plugin'](name), which gives plugins the started
+        # instance of another plugin in the same namespace, or None
+        def plugin(name):
+            if name not in handle['plugins']:
+                if name not in handle['lazy']:
+                    return None
+                self._start_lazy_plugin(handle, name)
+            instance = handle['plugins'][name]
+            self._bind_late(instance)
+            return instance
+        return plugin
+
+    def _stop_plugins(self, plugins):
+        for name, plugin in plugins.items():
+            try:
+                plugin.shutdown()
+            except Exception as e:
+                logger.warning(f"Plugin '{name}' failed to shut down: {e}")
+
+    def _mutating_names(self, plugins):
+        names = set()
+        for plugin in plugins.values():
+            names.update(plugin.mutating_functions)
+        return names
+
+    def _mutating_pattern(self, plugins):
+        names = self._mutating_names(plugins)
+        if not names:
+            return None
+        return re.compile(r'\b(' + '|'.join(sorted(map(re.escape, names))) + r')\b')
+
+    def _is_read_only(self, handle, query):
+        pattern = handle['mutating_pattern']
+        return pattern is None or pattern.search(query) is None
+
+    def _create_lua_pool(self, namespace, handle):
+        lua_env = {}
+        for plugin in handle['plugins'].values():
+            lua_env.update(plugin.get_lua_interface())
+        for name, plugin in handle['lazy'].items():
+            for func_name, func in plugin.get_lua_interface().items():
+                lua_env[func_name] = self._lazy_function(handle, name, func)
+        # Scanning the query text picks the lock, but misses names built at
+        # runtime (_G['db_' .. 'put']), so mutating functions check again
+        for func_name in self._mutating_names({**handle['plugins'], **handle['lazy']}):
+            if func_name in lua_env:
+                lua_env[func_name] = self._write_guard(handle['db'], func_name, lua_env[func_name])
+        for plugin in {**handle['plugins'], **handle['lazy']}.values():
+            for func_name in plugin.model_functions:
+                if func_name in lua_env:
+                    lua_env[func_name] = self._lock_released(lua_env[func_name])
+        namespace_path = os.path.join(self.data_dir, 'namespaces', namespace)
+        return LuaRuntimePool(namespace_path, lua_env, max_size=self.lua_pool_size)
+
+    def _write_guard(self, db, func_name, func):
+        # Also bumps the namespace DB's version, since plugin state such as
+        # the vector index can change without a storage write
+        def guarded(*args):
+            current = getattr(self._query, 'current', None)
+            if current is not None and current[0]['read_only']:
+                raise ValueError(f"{func_name} modifies the namespace but the query runs read-only; "
+                                 f"name it in the query text or pass read_only=False")
+            try:
+                return func(*args)
+            finally:
+                db.bump_version()
+        return guarded
+
+    def _lock_released(self, func):
+        # The namespace lock prefers writers, so a read-only query waiting on
+        # a model would otherwise stall every new query behind one writer
+        def released(*args):
+            current = getattr(self._query, 'current', None)
+            if current is None or not current[0]['read_only']:
+                return func(*args)
+            lock = current[2]
+            lock.release_read()
+            try:
+                return func(*args)
+            finally:
+                lock.acquire_read()
+        return released
+
+    def execute_query(self, namespace, query, return_format='dict', params=None, read_only=None, session=None,
+                      emit=None):
+        # emit is called with every value the query passes to emit() while it
+        # runs, for callers that stream partial results
+        with self._namespace(namespace) as handle:
+            return self._execute(namespace, handle, query, return_format, params, read_only, session, emit)
+
+    def _execute(self, namespace, handle, query, return_format, params, read_only, session, emit=None):
+        ns = self.namespaces[namespace]
+        # Queries that never mention a function which modifies the namespace
+        # share the lock; anything else runs exclusively.
+        mutates = not self._is_read_only(handle, query)
+        if read_only is None:
+            read_only = not mutates
+        elif read_only and mutates:
+            raise ValueError("Query marked read-only calls functions that modify the namespace")
+
+        session = self._get_session(namespace, session)
+        lock = ns['lock'].read_lock() if read_only else ns['lock'].write_lock()
+        with lock, handle['lua_pool'].runtime() as runtime:
+            context = self._plugin_context(namespace, handle['db'], ns['packages'], ns['codec'])
+            context['session'] = session
+            context['plugin'] = handle['context']['plugin']
+            context['read_only'] = read_only
+            # Lets plugins hand results back as native Lua tables
+            context['lua'] = runtime.lua
+            # Compiles Lua source in this runtime through the compiled-chunk cache
+            context['compile'] = lambda source: self._compile(runtime, namespace, source)
+            context['emit'] = self._emitter(emit)
+            runtime.lua.globals()['emit'] = context['emit']
+            plugins = list(handle['plugins'].values())
+            outer_query = getattr(self._query, 'current', None)
+            self._query.current = (context, plugins, ns['lock'])
+            try:
+                for plugin in plugins:
+                    plugin.bind(context)
+                chunk = self._compile(runtime, namespace, query)
+                if params is not None:
+                    runtime.lua.globals()['params'] = runtime.lua.table_from(params, recursive=True)
+                result = chunk()
+                return self._format_result(result, return_format)
+            finally:
+                self._query.current = outer_query
+                for plugin in plugins:
+                    plugin.unbind(context)
+                if not session.persistent:
+                    session.close()
+
+    def _get_session(self, namespace, session_id):
+        if session_id is None:
+            return Session()
+        with self._sessions_lock:
+            self._expire_sessions()
+            session = self.sessions.get((namespace, session_id))
+            if session is None:
+                session = self.sessions[(namespace, session_id)] = Session(session_id)
+            session.touch()
+            return session
+
+    def _expire_sessions(self):
+        cutoff = time.monotonic() - self.session_timeout
+        for key, session in list(self.sessions.items()):
+            if session.last_used < cutoff:
+                session.close()
+                del self.sessions[key]
+
+    def end_session(self, namespace, session_id):
+        # Rolls back anything the session left uncommitted
+        with self._sessions_lock:
+            session = self.sessions.pop((namespace, session_id), None)
+        if session is not None:
+            session.close()
+
+    def migrate_codec(self, namespace, key_codec=None, value_codec=None, batch_size=1000):
+        # Rewrites every entry of the namespace from its current codec to the
+        # new one. Entries that don't decode with the current codec are left
+        # untouched and counted as skipped.
         if namespace not in self.namespaces:
             raise ValueError(f"Namespace '{namespace}' does not exist")
+        ns = self.namespaces[namespace]
+        new_codec = dict(ns['codec'])
+        if key_codec is not None:
+            new_codec['key'] = key_codec
+        if value_codec is not None:
+            new_codec['value'] = value_codec
+        old_keys, old_values = get_codecs(ns['codec'])
+        new_keys, new_values = get_codecs(new_codec)
 
-        with self.namespaces[namespace]['lock']:
-            context = {
-                'namespace': namespace,
-                'db': self.namespaces[namespace]['db'],
-                'packages': self.namespaces[namespace]['packages'],
-                'data_dir': self.data_dir
-            }
-            
-            # Initialize plugins and add their interfaces to the Lua environment
-            lua_env = {}
-            for plugin in self.plugins.values():
-                plugin.initialize(context)
-                lua_env.update(plugin.get_lua_interface())
+        stats = {'migrated': 0, 'skipped': 0}
+        with self._namespace(namespace) as handle, ns['lock'].write_lock():
+            db = handle['db']
+            # Column families starting with '_' belong to plugins, which keep
+            # their own encoding
+            cf_names = [cf_name for cf_name in db.list_column_families() if not cf_name.startswith('_')]
+            for cf_name in [None] + cf_names:
+                batch = []
+                # Storage iterators read from an implicit snapshot, so the
+                # rewritten keys never show up in the same pass
+                for key, value in db.iterator(cf_name=cf_name):
+                    try:
+                        new_key = new_keys.encode(old_keys.decode(key))
+                        new_value = new_values.encode(old_values.decode(value))
+                    except (ValueError, TypeError, UnicodeDecodeError):
+                        stats['skipped'] += 1
+                        continue
+                    if new_key != key:
+                        batch.append((key, None))
+                    batch.append((new_key, new_value))
+                    stats['migrated'] += 1
+                    if len(batch) >= batch_size:
+                        self._write_migration_batch(db, cf_name, batch)
+                        batch = []
+                if batch:
+                    self._write_migration_batch(db, cf_name, batch)
+            ns['codec'] = new_codec
+            self.save_metadata()
+        return stats
 
-            import sys
-            orig_dlflags = sys.getdlopenflags()
-            sys.setdlopenflags(258)
-            
-            import lupa
-            sys.setdlopenflags(orig_dlflags)
-
-            lua = lupa.LuaRuntime(unpack_returned_tuples=True)
-
-            # Set up the Lua package path for this namespace
-            setup_script = f"""
-                local home = os.getenv("HOME")
-                local lua_version = _VERSION:match("%d+%.%d+")
-                package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?.lua"
-                package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?/init.lua"
-                package.cpath = package.cpath .. ";" .. home .. "/.luarocks/lib/lua/" .. lua_version .. "/?.so"
-                
-                local ns_path = "{os.path.join(self.data_dir, 'namespaces', namespace)}"
-                package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?.lua"
-                package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?/init.lua"
-                package.cpath = package.cpath .. ";" .. ns_path .. "/lib/lua/" .. lua_version .. "/?.so"
-            """
-            
-            lua.execute(setup_script)
-            # Add the plugin interfaces to the Lua environment
-            for name, func in lua_env.items():
-                lua.globals()[name] = func
+    def _write_migration_batch(self, db, cf_name, batch):
+        db.write_batch([
+            {'type': 'delete', 'key': key, 'cf': cf_name} if value is None
+            else {'type': 'put', 'key': key, 'value': value, 'cf': cf_name}
+            for key, value in batch
+        ])
+
+    def prepare(self, namespace, name, query):
+        if namespace not in self.namespaces:
+            raise ValueError(f"Namespace '{namespace}' does not exist")
+        ns = self.namespaces[namespace]
+        with ns['lock'].write_lock():
+            old_query = ns['prepared'].get(name)
+            ns['prepared'][name] = query
+            self.save_metadata()
+        if old_query is not None and old_query != query:
+            self.invalidate_compiled_queries(namespace, old_query)
+
+    def execute_prepared(self, namespace, name, params=None, return_format='dict', session=None, emit=None):
+        if namespace not in self.namespaces:
+            raise ValueError(f"Namespace '{namespace}' does not exist")
+        query = self.namespaces[namespace]['prepared'].get(name)
+        if query is None:
+            raise ValueError(f"Prepared query '{name}' does not exist in namespace '{namespace}'")
+        return self.execute_query(namespace, query, return_format, params=params or {}, session=session, emit=emit)
 
-            # Execute the Lua query
-            # Wrap the query in a function and return its result
-            wrapped_query = f"""
-            function execute_query()
-                {query}
-            end
-            return execute_query()
-            """
+    def list_prepared(self, namespace):
+        if namespace not in self.namespaces:
+            raise ValueError(f"Namespace '{namespace}' does not exist")
+        return dict(self.namespaces[namespace]['prepared'])
 
-            # Execute the Lua query
-            result = lua.execute(wrapped_query)         
+    def _compile(self, runtime, namespace, query):
+        key = CompiledQueryCache.key(namespace, query)
+        chunk = self.compiled_cache.get(runtime, key)
+        if chunk is None:
+            chunk = runtime.compile(query)
+            self.compiled_cache.put(runtime, key, chunk)
+        return chunk
 
-            return self._format_result(result, return_format)
+    def compiled_cache_stats(self):
+        return self.compiled_cache.stats()
+
+    def invalidate_compiled_queries(self, namespace=None, query=None):
+        return self.compiled_cache.invalidate(namespace, query)
 
     def _format_result(self, result, format):
         if format == 'dict':
@@ -180,6 +579,16 @@ class Database:
         else:
             raise ValueError(f"Unsupported return format: {format}")
 
+    def _emitter(self, sink):
+        # The query's emit(value). Returns false when nobody is listening, so
+        # queries can skip work that only matters to a streaming client.
+        def emit(value):
+            if sink is None:
+                return False
+            sink(self._lua_to_python(value))
+            return True
+        return emit
+
     def _lua_to_python(self, obj):
         lua_type_name = lua_type(obj)
         if lua_type_name == 'table':
@@ -187,12 +596,9 @@ class Database:
                 return [self._lua_to_python(item) for item in obj.values()]
             else:
                 return {str(k): self._lua_to_python(v) for k, v in obj.items()}
-        elif lua_type_name == 'unicode':
-            return str(obj)
-        elif lua_type_name in ['int', 'long', 'float']:
+        elif lua_type_name is None:
+            # Numbers, strings, booleans and nil arrive as plain Python values
             return obj
-        elif lua_type_name == 'NoneType':
-            return None
         else:
             return str(obj)
 
@@ -220,6 +626,10 @@ class Database:
     def list_namespaces(self):
         return list(self.namespaces.keys())
 
+    def model_stats(self):
+        # Models loaded by plugins, shared across namespaces and databases
+        return registry.stats()
+
     def install_package(self, namespace, package):
         if namespace not in self.namespaces:
             raise ValueError(f"Namespace '{namespace}' does not exist")
@@ -243,8 +653,21 @@ class Database:
                 return False
             
     def close(self):
-        for namespace in self.namespaces.values():
-            namespace['db'].close()
+        self._stop_sweep.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+        with self._sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+        self.compiled_cache.invalidate()
+        for name, namespace in self.namespaces.items():
+            with namespace['open_lock']:
+                if namespace['handle'] is not None:
+                    self._close_namespace(name, namespace['handle'])
+                    namespace['handle'] = None
+        if self.shared_db is not None:
+            self.shared_db.close()
         self.auth_db.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+logger = logging.getLogger('Liath')
+
+
+class _Request:
+    def __init__(self, tenant, method, kwargs, deadline, stream):
+        self.tenant = tenant
+        self.method = method
+        self.kwargs = kwargs
+        self.deadline = deadline
+        # Identical requests queued while this one waits or runs share it
+        self.futures = [Future()]
+        self.chunks = queue.Queue() if stream else None
+        self.cancelled = threading.Event()
+        self.dedupe_key = None
+
+    def fail(self, error):
+        if self.chunks is not None:
+            self.chunks.put(error)
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+class _Worker:
+    """Owns one loaded model and runs every request for it on one thread.
+
+    Requests wait in one queue per tenant and the queues are served round
+    robin, so a namespace sending many prompts can't starve the others.
+    """
+
+    def __init__(self, scheduler, llm):
+        self.scheduler = scheduler
+        self.llm = llm
+        self.queues = OrderedDict()
+        self.waiting = {}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def put(self, request, dedupe_key):
+        with self.cond:
+            shared = self.waiting.get(dedupe_key) if dedupe_key is not None else None
+            if shared is not None and not shared.cancelled.is_set():
+                future = Future()
+                shared.futures.append(future)
+                self.scheduler.dedupes += 1
+                return future
+            if dedupe_key is not None:
+                self.waiting[dedupe_key] = request
+                request.dedupe_key = dedupe_key
+            self.queues.setdefault(request.tenant, deque()).append(request)
+            self.cond.notify()
+            return request.futures[0]
+
+    def _next(self):
+        # Takes the oldest request of the tenant served longest ago, or
+        # returns None once the worker has been idle long enough to exit
+        while True:
+            with self.cond:
+                if not self.queues:
+                    self.cond.wait(self.scheduler.idle_timeout)
+                if self.queues:
+                    tenant, requests = next(iter(self.queues.items()))
+                    request = requests.popleft()
+                    del self.queues[tenant]
+                    if requests:
+                        self.queues[tenant] = requests
+                    return request
+            # Let go of the model so the registry can unload it
+            if self.scheduler._retire(self):
+                return None
+
+    def _loop(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            try:
+                if time.monotonic() > request.deadline:
+                    raise TimeoutError("LLM request timed out waiting for the model")
+                # Callers that gave up cancel their futures or close the stream
+                abandoned = request.cancelled.is_set() or all(future.cancelled() for future in request.futures)
+                result = None if abandoned else self._run(request)
+            except Exception as e:
+                self._close(request)
+                request.fail(e)
+            else:
+                for future in self._close(request):
+                    if not future.done():
+                        future.set_result(result)
+
+    def _close(self, request):
+        # Stops identical requests from joining, then returns every future
+        # waiting for the result
+        with self.cond:
+            if request.dedupe_key is not None and self.waiting.get(request.dedupe_key) is request:
+                del self.waiting[request.dedupe_key]
+            return list(request.futures)
+
+    def _run(self, request):
+        kwargs = dict(request.kwargs, stream=request.chunks is not None)
+        if request.method == 'chat':
+            result = self.llm.create_chat_completion(**kwargs)
+        else:
+            # Completions stop early once the request is cancelled or past
+            # its deadline; llama.cpp checks the criteria after every token
+            def stop(input_ids, logits):
+                return request.cancelled.is_set() or time.monotonic() > request.deadline
+            result = self.llm(stopping_criteria=stop, **kwargs)
+
+        if request.chunks is not None:
+            for part in result:
+                if request.cancelled.is_set():
+                    break
+                choice = part["choices"][0]
+                text = choice["delta"].get("content") if "delta" in choice else choice.get("text")
+                if text:
+                    request.chunks.put(text)
+        if time.monotonic() > request.deadline:
+            raise TimeoutError("LLM request timed out")
+        if request.chunks is not None:
+            request.chunks.put(None)
+        return result
+
+
+class InferenceScheduler:
+    """Queues LLM requests from every namespace onto per-model workers.
+
+    Each loaded Llama instance gets a single worker thread, so calls into it
+    never overlap and no caller holds a lock while generating. Identical
+    non-streaming requests waiting at the same time are generated once. Each
+    tenant may have max_pending requests queued or running, and each request
+    has timeout seconds to finish. Workers give the model a prompt cache so
+    requests sharing a prefix (a system prompt, say) skip re-evaluating it.
+    """
+
+    def __init__(self, max_pending=8, timeout=300, prefix_cache_size=2 * 1024 ** 3, idle_timeout=60):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # Bytes of llama.cpp state kept for prefix reuse; None disables it
+        self.prefix_cache_size = prefix_cache_size
+        # Seconds a worker waits for work before it exits
+        self.idle_timeout = idle_timeout
+        self.dedupes = 0
+        self._workers = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _worker(self, llm):
+        # Keyed by instance: the worker holds a reference, so the id can't be
+        # reused while it is in the table
+        with self._lock:
+            worker = self._workers.get(id(llm))
+            if worker is None:
+                if self.prefix_cache_size and getattr(llm, 'cache', None) is None:
+                    from llama_cpp import LlamaRAMCache
+                    llm.set_cache(LlamaRAMCache(capacity_bytes=self.prefix_cache_size))
+                worker = self._workers[id(llm)] = _Worker(self, llm)
+            return worker
+
+    def _retire(self, worker):
+        with self._lock:
+            with worker.cond:
+                if worker.queues:
+                    return False
+                if self._workers.get(id(worker.llm)) is worker:
+                    del self._workers[id(worker.llm)]
+                return True
+
+    def _admit(self, tenant):
+        with self._lock:
+            if self._pending.get(tenant, 0) >= self.max_pending:
+                raise RuntimeError(f"Too many pending LLM requests for '{tenant}'")
+            self._pending[tenant] = self._pending.get(tenant, 0) + 1
+
+    def _done(self, tenant):
+        with self._lock:
+            self._pending[tenant] -= 1
+            if not self._pending[tenant]:
+                del self._pending[tenant]
+
+    def submit(self, llm, tenant, method, timeout=None, **kwargs):
+        # method is 'complete' (kwargs for Llama.__call__) or 'chat' (for
+        # create_chat_completion). Returns a Future with llama.cpp's result;
+        # cancel it to drop the request if it hasn't started yet.
+        self._admit(tenant)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        request = _Request(tenant, method, kwargs, deadline, stream=False)
+        dedupe_key = (method, json.dumps(kwargs, sort_keys=True, default=str))
+        future = self._submit(llm, request, dedupe_key)
+        future.add_done_callback(lambda _: self._done(tenant))
+        return future
+
+    def result(self, future, timeout=None):
+        # Waits for a submitted request and drops it if the wait times out
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stream(self, llm, tenant, method, timeout=None, **kwargs):
+        # Yields text chunks as they are generated. Closing the generator
+        # early cancels the request.
+        self._admit(tenant)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        request = _Request(tenant, method, kwargs, deadline, stream=True)
+        try:
+            self._submit(llm, request, None)
+            while True:
+                chunk = request.chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            request.cancelled.set()
+            self._done(tenant)
+
+    def _submit(self, llm, request, dedupe_key):
+        while True:
+            worker = self._worker(llm)
+            with self._lock:
+                # A worker that just retired can't take work; start a new one
+                if self._workers.get(id(llm)) is worker:
+                    return worker.put(request, dedupe_key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': len(self._workers),
+                'pending': dict(self._pending),
+                'dedupes': self.dedupes,
+            }
+
+
+# The scheduler every namespace in this process shares
+scheduler = InferenceScheduler()
@@ -0,0 +1,180 @@
+import itertools
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# LuaRocks C modules need the Lua symbols exported globally, so lupa has to
+# be loaded with RTLD_GLOBAL | RTLD_NOW.
+_orig_dlflags = sys.getdlopenflags()
+sys.setdlopenflags(258)
+import lupa
+sys.setdlopenflags(_orig_dlflags)
+
+
+PACKAGE_PATH_SCRIPT = """
+local home = os.getenv("HOME")
+local lua_version = _VERSION:match("%d+%.%d+")
+package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?.lua"
+package.path = package.path .. ";" .. home .. "/.luarocks/share/lua/" .. lua_version .. "/?/init.lua"
+package.cpath = package.cpath .. ";" .. home .. "/.luarocks/lib/lua/" .. lua_version .. "/?.so"
+
+local ns_path = NAMESPACE_PATH
+package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?.lua"
+package.path = package.path .. ";" .. ns_path .. "/share/lua/" .. lua_version .. "/?/init.lua"
+package.cpath = package.cpath .. ";" .. ns_path .. "/lib/lua/" .. lua_version .. "/?.so"
+"""
+
+# Snapshots the globals and the standard library tables once the runtime is
+# warm, and returns a function that puts their contents back the way they
+# were, so e.g. string.leak = 1 or math.pi = 3 can't outlive a query. Debug
+# hooks are cleared and a stopped collector restarted for the same reason.
+RESET_SCRIPT = """
+local baseline = {}
+for k, v in pairs(_G) do baseline[k] = v end
+local libraries = {[_G] = baseline}
+local names = {"string", "table", "math", "os", "io", "coroutine", "utf8", "debug", "package"}
+for _, name in ipairs(names) do
+    local lib = baseline[name]
+    if type(lib) == "table" then
+        local contents = {}
+        for k, v in pairs(lib) do contents[k] = v end
+        libraries[lib] = contents
+    end
+end
+local string_meta = getmetatable("")
+local string_meta_contents = {}
+for k, v in pairs(string_meta) do string_meta_contents[k] = v end
+libraries[string_meta] = string_meta_contents
+local globals_meta = getmetatable(_G)
+local loaded = package.loaded
+local set_metatable = debug and debug.setmetatable
+local set_hook = debug and debug.sethook
+local gc = collectgarbage
+return function()
+    if set_hook then set_hook() end
+    gc("restart")
+    setmetatable(_G, globals_meta)
+    if set_metatable and getmetatable("") ~= string_meta then set_metatable("", string_meta) end
+    for lib, contents in pairs(libraries) do
+        for k in pairs(lib) do
+            if contents[k] == nil then rawset(lib, k, nil) end
+        end
+        for k, v in pairs(contents) do
+            if rawget(lib, k) ~= v then rawset(lib, k, v) end
+        end
+    end
+    -- Modules a query required stay cached, but not stand-ins for the
+    -- standard libraries
+    for _, name in ipairs(names) do
+        if baseline[name] ~= nil then loaded[name] = baseline[name] end
+    end
+    loaded._G = _G
+end
+"""
+
+
+_runtime_ids = itertools.count(1)
+
+
+class PooledRuntime:
+    """A warmed-up Lua runtime with the namespace environment already loaded."""
+
+    def __init__(self, namespace_path, lua_env):
+        self.id = next(_runtime_ids)
+        self.lua = lupa.LuaRuntime(unpack_returned_tuples=True)
+        self.lua.execute(PACKAGE_PATH_SCRIPT.replace("NAMESPACE_PATH", _lua_string(namespace_path)))
+        lua_globals = self.lua.globals()
+        for name, func in lua_env.items():
+            lua_globals[name] = func
+        self.load = lua_globals.load
+        self._reset = self.lua.execute(RESET_SCRIPT)
+
+    def compile(self, source, chunk_name="=query"):
+        compiled = self.load(source, chunk_name, "t")
+        if isinstance(compiled, tuple):
+            raise lupa.LuaSyntaxError(compiled[1])
+        return compiled
+
+    def reset(self):
+        self._reset()
+
+
+class LuaRuntimePool:
+    """Hands out pre-warmed Lua runtimes for a single namespace.
+
+    Runtimes are created with the LuaRocks package paths and the plugin
+    functions already bound. Their globals are reset every time they are
+    returned to the pool, so one query can't leak state into the next.
+    """
+
+    def __init__(self, namespace_path, lua_env, min_size=1, max_size=8, timeout=None):
+        self.namespace_path = namespace_path
+        self.lua_env = dict(lua_env)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        for _ in range(min(min_size, max_size)):
+            self._size += 1
+            self._idle.append(PooledRuntime(self.namespace_path, self.lua_env))
+
+    def acquire(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a free Lua runtime")
+                self._cond.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+        try:
+            return PooledRuntime(self.namespace_path, self.lua_env)
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, runtime):
+        try:
+            runtime.reset()
+        except Exception:
+            # A runtime we can't reset is not safe to hand out again
+            self.discard(runtime)
+            return
+        with self._cond:
+            self._idle.append(runtime)
+            self._cond.notify()
+
+    def discard(self, runtime):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def runtime(self):
+        runtime = self.acquire()
+        try:
+            yield runtime
+        finally:
+            self.release(runtime)
+
+    def close(self):
+        with self._cond:
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+
+def _lua_string(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
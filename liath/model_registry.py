@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('Liath')
+
+
+class _Entry:
+    def __init__(self, model, size):
+        self.model = model
+        self.size = size
+        self.refs = 0
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models, shared between namespaces.
+
+    Plugins acquire a model by key and release it when they switch models or
+    shut down. A model stays loaded while anyone holds it. Released models
+    are kept for reuse until the memory budget runs out, then unloaded least
+    recently used first. Unless the caller knows better, a model's size is
+    the growth in resident memory measured around its load.
+    """
+
+    def __init__(self, budget=None):
+        # Bytes the loaded models may take; None keeps every model
+        self.budget = budget
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Sizes of models loaded before, to make room before loading again
+        self._sizes = {}
+        self._lock = threading.Lock()
+        # Loads run one at a time so each measurement only sees its own model
+        self._load_lock = threading.Lock()
+
+    def acquire(self, key, loader, size=None):
+        # Returns the model for key, calling loader() if it isn't loaded.
+        # Pass size when resident memory is a poor measure, e.g. for models
+        # that are memory-mapped and paged in as they are used.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs += 1
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.model
+        with self._load_lock:
+            with self._lock:
+                # Someone else may have loaded it while we waited
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.model
+                self._evict(size if size is not None else self._sizes.get(key, 0))
+            before = self._rss()
+            model = loader()
+            if size is None:
+                size = max(self._rss() - before, 0)
+            with self._lock:
+                entry = self._entries[key] = _Entry(model, size)
+                entry.refs = 1
+                self._sizes[key] = size
+                self.loads += 1
+                self._evict(0)
+        return model
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs == 0:
+                return
+            entry.refs -= 1
+            self._evict(0)
+
+    def _evict(self, incoming):
+        # Unloads unreferenced models, oldest first, until the loaded models
+        # plus incoming bytes fit the budget. Callers hold self._lock.
+        if self.budget is None:
+            return
+        used = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if used + incoming <= self.budget:
+                return
+            entry = self._entries[key]
+            if entry.refs:
+                continue
+            del self._entries[key]
+            used -= entry.size
+            self.evictions += 1
+        if used + incoming > self.budget:
+            logger.warning(f"Models in use take {used} bytes, over the {self.budget} byte budget")
+
+    def _rss(self):
+        try:
+            import psutil
+        except ImportError:
+            return 0
+        return psutil.Process(os.getpid()).memory_info().rss
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'used': sum(entry.size for entry in self._entries.values()),
+                'loads': self.loads,
+                'hits': self.hits,
+                'evictions': self.evictions,
+                'models': [
+                    {'key': list(key) if isinstance(key, tuple) else key, 'size': entry.size, 'refs': entry.refs}
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+
+# The registry every plugin in this process shares
+registry = ModelRegistry()
@@ -2,8 +2,40 @@ from abc import ABC, abstractmethod
 from lupa import unpacks_lua_table
 
 class PluginBase(ABC):
+    # Lua functions that modify namespace state. Queries calling any of them
+    # take the namespace lock exclusively; all other queries run concurrently.
+    mutating_functions = ()
+
+    # Lua functions that spend their time in model calls. A read-only query
+    # lets go of the namespace lock while it runs one, so a slow completion
+    # doesn't hold up writers, or the readers queued behind them. Queries
+    # holding the write lock keep it, so their writes stay atomic.
+    model_functions = ()
+
+    # Lazy plugins are initialized on the first call to one of their Lua
+    # functions instead of when the namespace opens. Set this for plugins
+    # that load models or import heavy libraries, and import those inside
+    # methods rather than at module level so loading the plugin stays cheap.
+    lazy = False
+
     @abstractmethod
     def initialize(self, context):
+        # Called once when a namespace is opened. Load models, open indexes
+        # and start background work here; the instance is reused by every
+        # query against that namespace.
+        pass
+
+    def bind(self, context):
+        # Called before every query with the per-query context.
+        pass
+
+    def unbind(self, context):
+        # Called after every query, even if it failed. Release anything the
+        # query left open here.
+        pass
+
+    def shutdown(self):
+        # Called once when the namespace is closed.
         pass
 
     @abstractmethod
@@ -20,4 +52,4 @@ class PluginBase(ABC):
         @unpacks_lua_table
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
-        return wrapper
\ No newline at end of file
+        return wrapper
@@ -5,6 +5,11 @@ from datetime import datetime
 from plugin_base import PluginBase
 
 class BackupRestorePlugin(PluginBase):
+    mutating_functions = (
+        'create_backup',
+        'restore_backup',
+    )
+
     def initialize(self, context):
         self.data_dir = os.path.join('data', context['namespace'])
         self.backup_dir = os.path.join('backups', context['namespace'])
@@ -1,16 +1,66 @@
 from plugin_base import PluginBase
+from lupa import lua_type
+from storage.encoding import get_codecs
+from storage.transaction import TransactionConflict
+import base64
 import json
+import threading
 
 class DBPlugin(PluginBase):
+    mutating_functions = (
+        'db_put',
+        'db_delete',
+        'db_multi_put',
+        'db_begin_transaction',
+        'db_commit_transaction',
+        'db_rollback_transaction',
+        'db_create_column_family',
+        'db_drop_column_family',
+        'db_put_cf',
+        'db_delete_cf',
+        'db_write_batch',
+        'db_compact_range',
+        'db_flush',
+    )
+
     def initialize(self, context):
         self.db = context['db']
-        self.txn = None
+        self._set_codec(context.get('codec'))
+        # Session and db_iter iterators of the query running on each thread
+        self._local = threading.local()
+
+    def bind(self, context):
+        # The codec only changes when a namespace is migrated
+        if context.get('codec') != self.codec:
+            self._set_codec(context.get('codec'))
+        self._local.session = context.get('session')
+        self._local.iterators = []
+
+    def unbind(self, context):
+        for it in getattr(self._local, 'iterators', []):
+            self._close_iterator(it)
+        self._local.iterators = []
+        self._local.session = None
+
+    def _txn(self):
+        session = getattr(self._local, 'session', None)
+        return session.transaction if session is not None else None
+
+    def _target(self):
+        # Inside a transaction, writes are buffered and reads see the
+        # snapshot plus the transaction's own writes
+        txn = self._txn()
+        return txn if txn is not None else self.db
 
     def get_lua_interface(self):
+        # Functions that take a single Lua table are registered as is:
+        # lua_callable would unpack that table into keyword arguments
         return {
             'db_get': self.lua_callable(self.get),
             'db_put': self.lua_callable(self.put),
             'db_delete': self.lua_callable(self.delete),
+            'db_multi_get': self.multi_get,
+            'db_multi_put': self.multi_put,
             'db_begin_transaction': self.lua_callable(self.begin_transaction),
             'db_commit_transaction': self.lua_callable(self.commit_transaction),
             'db_rollback_transaction': self.lua_callable(self.rollback_transaction),
@@ -21,47 +71,88 @@ class DBPlugin(PluginBase):
             'db_put_cf': self.lua_callable(self.put_cf),
             'db_delete_cf': self.lua_callable(self.delete_cf),
             'db_iterator': self.lua_callable(self.create_iterator),
-            'db_write_batch': self.lua_callable(self.write_batch),
+            'db_scan': self.lua_callable(self.scan),
+            'db_iter': self.lua_callable(self.iterate),
+            'db_write_batch': self.write_batch,
             'db_compact_range': self.lua_callable(self.compact_range),
             'db_flush': self.lua_callable(self.flush),
         }
 
-    def _encode(self, value):
-        return json.dumps(value).encode()
+    def _set_codec(self, config):
+        self.codec = dict(config or {})
+        self.key_codec, self.value_codec = get_codecs(self.codec)
+
+    def _encode_key(self, key):
+        return self.key_codec.encode(key)
+
+    def _decode_key(self, data):
+        return self.key_codec.decode(data)
 
-    def _decode(self, value):
-        return json.loads(value.decode()) if value else None
+    def _encode_prefix(self, prefix):
+        return self.key_codec.encode_prefix(prefix)
+
+    def _encode_value(self, value):
+        return self.value_codec.encode(value)
+
+    def _decode_value(self, data):
+        return self.value_codec.decode(data) if data is not None else None
+
+    def _encode_cursor(self, key):
+        return base64.urlsafe_b64encode(key).decode() if key is not None else None
+
+    def _decode_cursor(self, cursor):
+        return base64.urlsafe_b64decode(cursor.encode()) if cursor is not None else None
 
     def get(self, key):
-        value = self.db.get(self._encode(key))
-        return self._decode(value)
+        value = self._target().get(self._encode_key(key))
+        return self._decode_value(value)
 
     def put(self, key, value):
-        self.db.put(self._encode(key), self._encode(value))
+        self._target().put(self._encode_key(key), self._encode_value(value))
         return json.dumps({"status": "success"})
 
     def delete(self, key):
-        self.db.delete(self._encode(key))
+        self._target().delete(self._encode_key(key))
         return json.dumps({"status": "success"})
 
-    def begin_transaction(self):
-        # Note: Transaction support may vary depending on the storage backend
-        if hasattr(self.db, 'transaction'):
-            self.txn = self.db.transaction()
-            return json.dumps({"status": "success", "message": "Transaction began"})
-        return json.dumps({"status": "error", "message": "Transactions not supported by this storage backend"})
+    def multi_get(self, keys):
+        keys = list(keys.values()) if lua_type(keys) == 'table' else list(keys)
+        values = self._target().multi_get([self._encode_key(key) for key in keys])
+        return json.dumps({key: self._decode_value(value) for key, value in zip(keys, values)})
+
+    def multi_put(self, items):
+        self._target().multi_put([(self._encode_key(key), self._encode_value(value)) for key, value in items.items()])
+        return json.dumps({"status": "success"})
+
+    def begin_transaction(self, detect_conflicts=False):
+        # Transactions live on the query's session. Without a session id they
+        # are rolled back when the query ends.
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return json.dumps({"status": "error", "message": "Transactions require a session"})
+        if session.transaction is not None:
+            return json.dumps({"status": "error", "message": "Transaction already active"})
+        session.transaction = self.db.transaction(detect_conflicts=detect_conflicts)
+        return json.dumps({"status": "success", "message": "Transaction began"})
 
     def commit_transaction(self):
-        if self.txn:
-            self.txn.commit()
-            self.txn = None
+        session = getattr(self._local, 'session', None)
+        txn = self._txn()
+        if txn:
+            session.transaction = None
+            try:
+                txn.commit()
+            except TransactionConflict as e:
+                return json.dumps({"status": "error", "message": f"Transaction conflict: {e}"})
             return json.dumps({"status": "success", "message": "Transaction committed"})
         return json.dumps({"status": "error", "message": "No active transaction"})
 
     def rollback_transaction(self):
-        if self.txn:
-            self.txn.rollback()
-            self.txn = None
+        session = getattr(self._local, 'session', None)
+        txn = self._txn()
+        if txn:
+            session.transaction = None
+            txn.rollback()
             return json.dumps({"status": "success", "message": "Transaction rolled back"})
         return json.dumps({"status": "error", "message": "No active transaction"})
 
@@ -84,45 +175,111 @@ class DBPlugin(PluginBase):
 
     def get_cf(self, cf_name, key):
         try:
-            value = self.db.get_cf(cf_name, self._encode(key))
-            return self._decode(value)
+            txn = self._txn()
+            if txn is not None:
+                value = txn.get(self._encode_key(key), cf_name)
+            else:
+                value = self.db.get_cf(cf_name, self._encode_key(key))
+            return self._decode_value(value)
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
     def put_cf(self, cf_name, key, value):
         try:
-            self.db.put_cf(cf_name, self._encode(key), self._encode(value))
+            txn = self._txn()
+            if txn is not None:
+                txn.put(self._encode_key(key), self._encode_value(value), cf_name)
+            else:
+                self.db.put_cf(cf_name, self._encode_key(key), self._encode_value(value))
             return json.dumps({"status": "success"})
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
     def delete_cf(self, cf_name, key):
         try:
-            self.db.delete_cf(cf_name, self._encode(key))
+            txn = self._txn()
+            if txn is not None:
+                txn.delete(self._encode_key(key), cf_name)
+            else:
+                self.db.delete_cf(cf_name, self._encode_key(key))
             return json.dumps({"status": "success"})
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
     def create_iterator(self, cf_name=None):
         try:
-            if cf_name:
-                it = self.db.iterator(cf_name)
-            else:
-                it = self.db.iterator()
-            return json.dumps([{self._decode(k): self._decode(v)} for k, v in it])
+            it = self._target().iterator(cf_name=cf_name)
+            return json.dumps([{self._decode_key(k): self._decode_value(v)} for k, v in it])
+        except Exception as e:
+            return json.dumps({"status": "error", "message": str(e)})
+
+    def scan(self, start=None, stop=None, prefix=None, limit=100, reverse=False, cursor=None, cf_name=None):
+        try:
+            items, next_cursor = self._target().scan(
+                start=self._encode_key(start) if start is not None else None,
+                stop=self._encode_key(stop) if stop is not None else None,
+                prefix=self._encode_prefix(prefix) if prefix is not None else None,
+                limit=limit,
+                reverse=reverse,
+                cursor=self._decode_cursor(cursor),
+                cf_name=cf_name,
+            )
+            return json.dumps({
+                "items": [{"key": self._decode_key(k), "value": self._decode_value(v)} for k, v in items],
+                "cursor": self._encode_cursor(next_cursor),
+            })
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
+    def iterate(self, start=None, stop=None, prefix=None, reverse=False, cf_name=None):
+        # Returns a stateless Lua iterator, so `for k, v in db_iter{...} do`
+        # pulls one entry at a time from the storage iterator. Iterators left
+        # open by an early `break` are closed when the query ends.
+        it = self._target().iterator(
+            cf_name=cf_name,
+            start=self._encode_key(start) if start is not None else None,
+            stop=self._encode_key(stop) if stop is not None else None,
+            prefix=self._encode_prefix(prefix) if prefix is not None else None,
+            reverse=reverse,
+        )
+        if not hasattr(self._local, 'iterators'):
+            self._local.iterators = []
+        self._local.iterators.append(it)
+
+        def step(*args):
+            try:
+                key, value = next(it)
+            except StopIteration:
+                self._close_iterator(it)
+                return None
+            return self._decode_key(key), self._decode_value(value)
+        return step
+
+    def _close_iterator(self, it):
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+        iterators = getattr(self._local, 'iterators', [])
+        if it in iterators:
+            iterators.remove(it)
+
     def write_batch(self, operations):
         try:
-            self.db.write_batch(operations)
+            encoded = []
+            for op in operations.values() if lua_type(operations) == 'table' else operations:
+                cf_name = op['cf'] if lua_type(op) == 'table' else op.get('cf')
+                encoded_op = {'type': op['type'], 'key': self._encode_key(op['key']), 'cf': cf_name}
+                if op['type'] == 'put':
+                    encoded_op['value'] = self._encode_value(op['value'])
+                encoded.append(encoded_op)
+            self._target().write_batch(encoded)
             return json.dumps({"status": "success", "message": f"{len(operations)} operations executed in batch"})
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
     def compact_range(self, begin=None, end=None):
         try:
-            self.db.compact_range(self._encode(begin) if begin else None, self._encode(end) if end else None)
+            self.db.compact_range(self._encode_key(begin) if begin else None, self._encode_key(end) if end else None)
             return json.dumps({"status": "success", "message": "Compaction completed"})
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
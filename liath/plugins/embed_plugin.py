@@ -1,15 +1,37 @@
 from plugin_base import PluginBase
-import pandas as pd
+from model_registry import registry
+from lupa import lua_type
+import hashlib
 import json
-from fastembed import (
-    SparseTextEmbedding,
-    TextEmbedding,
-    LateInteractionTextEmbedding,
-    ImageEmbedding,
-)
 
 class EmbedPlugin(PluginBase):
+    mutating_functions = (
+        'set_model',
+        'set_embedding_type',
+        'clear_embedding_cache',
+    )
+    model_functions = ('embed', 'embed_batch')
+    lazy = True
+    # Texts per model call in embed_batch
+    batch_size = 256
+    # fastembed data-parallel workers for embed_batch; None embeds in this
+    # process, 0 uses every core
+    parallel = None
+    # Dense text embeddings keyed by a hash of model and text, so unchanged
+    # documents aren't embedded again
+    CACHE_CF = '_embed_cache'
+    cache_embeddings = True
+
     def initialize(self, context):
+        self.db = context['db']
+        if self.CACHE_CF not in self.db.list_column_families():
+            self.db.create_column_family(self.CACHE_CF)
+        from fastembed import (
+            SparseTextEmbedding,
+            TextEmbedding,
+            LateInteractionTextEmbedding,
+            ImageEmbedding,
+        )
         self.embedding_types = {
             "text": TextEmbedding,
             "sparse_text": SparseTextEmbedding,
@@ -18,11 +40,34 @@ class EmbedPlugin(PluginBase):
         }
         self.current_type = "text"
         self.current_model = "BAAI/bge-small-en-v1.5"  # Default model
-        self.embedding_model = self.embedding_types[self.current_type](model_name=self.current_model)
+        self.model_key = None
+        self._load_model(self.current_type, self.current_model)
+
+    def _load_model(self, embedding_type, model_name):
+        # Models come from the process-wide registry, so namespaces using
+        # the same one share a single copy
+        model_class = self.embedding_types[embedding_type]
+        key = ('fastembed', embedding_type, model_name)
+        model = registry.acquire(key, lambda: model_class(model_name=model_name))
+        if self.model_key is not None:
+            registry.release(self.model_key)
+        self.model_key = key
+        self.embedding_model = model
+        self.current_type = embedding_type
+        self.current_model = model_name
+
+    def shutdown(self):
+        if self.model_key is not None:
+            registry.release(self.model_key)
+        self.model_key = None
+        self.embedding_model = None
 
     def get_lua_interface(self):
         return {
             'embed': self.lua_callable(self.embed),
+            # Takes a single array of texts, so it mustn't be unpacked
+            'embed_batch': self.embed_batch,
+            'clear_embedding_cache': self.lua_callable(self.clear_cache),
             'list_supported_models': self.lua_callable(self.list_supported_models),
             'set_model': self.lua_callable(self.set_model),
             'set_embedding_type': self.lua_callable(self.set_embedding_type),
@@ -38,15 +83,70 @@ class EmbedPlugin(PluginBase):
             else:
                 if text is None:
                     return json.dumps({"error": "Text is required for text embeddings"})
-                embeddings = list(self.embedding_model.embed([text]))
+                embeddings, _ = self._embed_texts([text])
             
-            return json.dumps({"embedding": embeddings[0].tolist()})
+            return json.dumps({"embedding": self._to_json(embeddings[0])})
         except Exception as e:
             return json.dumps({"error": str(e)})
 
+    def embed_batch(self, texts):
+        # Embeds a whole array of texts (image paths for image embeddings)
+        # with fastembed's batching. Returns {embeddings, cached}.
+        try:
+            texts = list(texts.values()) if lua_type(texts) == 'table' else list(texts)
+            if self.current_type == "image":
+                embeddings, cached = self._model_embed(texts), 0
+            else:
+                embeddings, cached = self._embed_texts(texts)
+            return json.dumps({"embeddings": [self._to_json(e) for e in embeddings], "cached": cached})
+        except Exception as e:
+            return json.dumps({"error": str(e)})
+
+    def _model_embed(self, inputs):
+        return list(self.embedding_model.embed(inputs, batch_size=self.batch_size, parallel=self.parallel))
+
+    def _cache_key(self, text):
+        digest = hashlib.sha256()
+        for part in (self.current_type, self.current_model, text):
+            digest.update(part.encode() + b'\x00')
+        return digest.digest()
+
+    def _embed_texts(self, texts):
+        # Dense embeddings come from the cache where possible; each distinct
+        # missing text is embedded once and stored. Other types aren't cached.
+        # Returns (embeddings, number served from the cache).
+        if not self.cache_embeddings or self.current_type != "text":
+            return self._model_embed(texts), 0
+        import numpy as np
+        keys = [self._cache_key(text) for text in texts]
+        found = dict(zip(keys, self.db.multi_get(keys, cf_name=self.CACHE_CF)))
+        missing = {key: text for key, text in zip(keys, texts) if found[key] is None}
+        cached = sum(1 for key in keys if found[key] is not None)
+        if missing:
+            computed = self._model_embed(list(missing.values()))
+            items = []
+            for key, embedding in zip(missing, computed):
+                value = np.asarray(embedding, dtype='<f4').tobytes()
+                found[key] = value
+                items.append((key, value))
+            self.db.multi_put(items, cf_name=self.CACHE_CF)
+        return [np.frombuffer(found[key], dtype='<f4') for key in keys], cached
+
+    def _to_json(self, embedding):
+        if hasattr(embedding, 'indices'):
+            # Sparse embeddings
+            return {"indices": embedding.indices.tolist(), "values": embedding.values.tolist()}
+        return embedding.tolist()
+
+    def clear_cache(self):
+        keys = [key for key, _ in self.db.iterator(cf_name=self.CACHE_CF)]
+        self.db.write_batch([{'type': 'delete', 'cf': self.CACHE_CF, 'key': key} for key in keys])
+        return json.dumps({"status": "success", "message": f"{len(keys)} cached embeddings removed"})
+
     def list_supported_models(self):
+        import pandas as pd
         supported_models = (
-            pd.DataFrame(TextEmbedding.list_supported_models())
+            pd.DataFrame(self.embedding_types["text"].list_supported_models())
             .sort_values("size_in_GB")
             .drop(columns=["sources", "model_file", "additional_files"])
             .reset_index(drop=True)
@@ -55,16 +155,17 @@ class EmbedPlugin(PluginBase):
 
     def set_model(self, model_name):
         try:
-            self.current_model = model_name
-            self.embedding_model = self.embedding_types[self.current_type](model_name=self.current_model)
+            self._load_model(self.current_type, model_name)
             return json.dumps({"status": "success", "message": f"Model set to {model_name}"})
         except Exception as e:
             return json.dumps({"status": "error", "message": str(e)})
 
     def set_embedding_type(self, embedding_type):
         if embedding_type in self.embedding_types:
-            self.current_type = embedding_type
-            self.embedding_model = self.embedding_types[self.current_type](model_name=self.current_model)
+            try:
+                self._load_model(embedding_type, self.current_model)
+            except Exception as e:
+                return json.dumps({"status": "error", "message": str(e)})
             return json.dumps({"status": "success", "message": f"Embedding type set to {embedding_type}"})
         else:
             return json.dumps({"status": "error", "message": f"Invalid embedding type. Choose from {list(self.embedding_types.keys())}"})
@@ -2,6 +2,11 @@ from plugin_base import PluginBase
 import os
 
 class FilePlugin(PluginBase):
+    mutating_functions = (
+        'file_write',
+        'file_delete',
+    )
+
     def initialize(self, context):
         self.namespace = context['namespace']
         self.data_dir = os.path.join('data', self.namespace, 'files')
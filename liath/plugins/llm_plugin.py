@@ -1,36 +1,128 @@
 from plugin_base import PluginBase
-from llama_cpp import Llama
-import openai
+from model_registry import registry
+from inference import scheduler
+from response_cache import ResponseCache
+from storage.encoding import lua_to_python
 import os
 import json
+import threading
 
 class LLMPlugin(PluginBase):
+    mutating_functions = (
+        'llm_set_model',
+        'llm_set_mode',
+        'llm_cache_configure',
+        'llm_cache_clear',
+    )
+    model_functions = ('llm_complete', 'llm_stream', 'llm_chat')
+    lazy = True
+
     def initialize(self, context):
+        import openai
+        # Local requests are queued per namespace by the shared scheduler
+        self.namespace = context['namespace']
+        self.plugin = context['plugin']
+        # Answers are kept in the namespace DB; semantic mode embeds prompts
+        # with the namespace's embed plugin
+        self.cache = ResponseCache(context['db'], embed=self._embed_prompt)
         self.models = {
             "llama2-7b": "llama-2-7b.Q4_0.gguf",
             # Add more models as needed
         }
-        self.current_model = "llama2-7b"
         self.mode = "local"
-        self.llm = Llama(model_path=self.models[self.current_model])
+        self.model_key = None
+        self._load_model("llama2-7b")
+        # Streams handed to the query running on each thread
+        self._local = threading.local()
         
         # Load API key from environment variable
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
+    def _load_model(self, model_name):
+        # The registry shares each model file between namespaces. Llama
+        # memory-maps the weights, so the file size is a better estimate of
+        # its footprint than resident memory right after loading.
+        from llama_cpp import Llama
+        model_path = self.models[model_name]
+        key = ('llama', model_path)
+        size = os.path.getsize(model_path) if os.path.exists(model_path) else None
+        llm = registry.acquire(key, lambda: Llama(model_path=model_path), size=size)
+        if self.model_key is not None:
+            registry.release(self.model_key)
+        self.model_key = key
+        # Only the scheduler's worker for this instance calls into it
+        self.llm = llm
+        self.current_model = model_name
+
+    def bind(self, context):
+        self._local.streams = []
+
+    def unbind(self, context):
+        # A loop that stopped early leaves its stream open and its request queued
+        for chunks in getattr(self._local, 'streams', ()):
+            chunks.close()
+        self._local.streams = []
+
+    def shutdown(self):
+        if self.model_key is not None:
+            registry.release(self.model_key)
+        self.model_key = None
+        self.llm = None
+
     def get_lua_interface(self):
         return {
             'llm_complete': self.lua_callable(self.complete),
+            'llm_stream': self.lua_callable(self.stream),
             'llm_chat': self.lua_callable(self.chat),
             'llm_set_model': self.lua_callable(self.set_model),
             'llm_set_mode': self.lua_callable(self.set_mode),
-            'llm_list_models': self.lua_callable(self.list_models)
+            'llm_list_models': self.lua_callable(self.list_models),
+            'llm_cache_configure': self.cache_configure,
+            'llm_cache_clear': self.lua_callable(self.cache_clear),
+            'llm_cache_stats': self.lua_callable(self.cache_stats),
         }
 
+    def _embed_prompt(self, text):
+        embed = self.plugin('embed')
+        if embed is None:
+            return None
+        embedding = json.loads(embed.embed(text=text)).get('embedding')
+        # Sparse embeddings can't go in the similarity index
+        return embedding if isinstance(embedding, list) else None
+
+    def _cached(self, kind, params, text, generate):
+        # Returns the cached answer for params, or the JSON string from
+        # generate(), caching it unless it is an error
+        response = self.cache.get(kind, params, text)
+        if response is not None:
+            return json.dumps(response)
+        result = generate()
+        response = json.loads(result)
+        if response.get("status") != "error":
+            self.cache.put(kind, params, response, text)
+        return result
+
+    def cache_configure(self, options):
+        # llm_cache_configure{ttl=3600, semantic=true, threshold=0.9, enabled=true}
+        try:
+            config = self.cache.configure(**json.loads(json.dumps(options, default=lua_to_python)))
+        except ValueError as e:
+            return json.dumps({"status": "error", "message": str(e)})
+        return json.dumps({"status": "success", "config": config})
+
+    def cache_clear(self, expired_only=False):
+        return json.dumps({"removed": self.cache.clear(expired_only)})
+
+    def cache_stats(self):
+        return json.dumps(self.cache.stats())
+
     def set_model(self, model_name):
         if self.mode == "local":
             if model_name in self.models:
-                self.current_model = model_name
-                self.llm = Llama(model_path=self.models[self.current_model])
+                try:
+                    self._load_model(model_name)
+                except Exception as e:
+                    return json.dumps({"status": "error", "message": str(e)})
                 return json.dumps({"status": "success", "message": f"Model set to {model_name}"})
             else:
                 return json.dumps({"status": "error", "message": f"Model {model_name} not found"})
@@ -52,10 +144,19 @@ class LLMPlugin(PluginBase):
             return json.dumps(["gpt-3.5-turbo", "gpt-4"])  # Add more as needed
 
     def complete(self, prompt, max_tokens=100):
+        params = {"mode": self.mode, "model": self.current_model, "prompt": prompt, "max_tokens": max_tokens}
+        return self._cached('complete', params, prompt, lambda: self._complete(prompt, max_tokens))
+
+    def _complete(self, prompt, max_tokens):
         if self.mode == "local":
-            result = self.llm(prompt, max_tokens=max_tokens)
+            try:
+                result = scheduler.result(scheduler.submit(
+                    self.llm, self.namespace, 'complete', prompt=prompt, max_tokens=max_tokens))
+            except (RuntimeError, TimeoutError) as e:
+                return json.dumps({"status": "error", "message": str(e)})
             return json.dumps({"text": result["choices"][0]["text"]})
         else:
+            import openai
             response = openai.completions.create(
                 model=self.current_model,
                 prompt=prompt,
@@ -63,11 +164,65 @@ class LLMPlugin(PluginBase):
             )
             return json.dumps({"text": response.choices[0].text})
 
+    def stream(self, prompt, max_tokens=100, callback=None):
+        # Returns an iterator over generated text chunks:
+        #   for chunk in llm_stream(prompt) do emit(chunk) end
+        # With a callback, e.g. llm_stream(prompt, emit), it is called with
+        # every chunk instead and the full text is returned as llm_complete does.
+        if callable(max_tokens):
+            callback, max_tokens = max_tokens, 100
+        chunks = self._stream_chunks(prompt, max_tokens)
+        if callback is None:
+            streams = getattr(self._local, 'streams', None)
+            if streams is not None:
+                streams.append(chunks)
+
+            def next_chunk(*args):
+                return next(chunks, None)
+            return next_chunk
+
+        text = []
+        try:
+            for chunk in chunks:
+                text.append(chunk)
+                callback(chunk)
+        finally:
+            chunks.close()
+        return json.dumps({"text": "".join(text)})
+
+    def _stream_chunks(self, prompt, max_tokens):
+        if self.mode == "local":
+            # Closing this generator cancels the request in the scheduler
+            yield from scheduler.stream(self.llm, self.namespace, 'complete', prompt=prompt, max_tokens=max_tokens)
+        else:
+            import openai
+            response = openai.completions.create(
+                model=self.current_model,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            for part in response:
+                text = part.choices[0].text
+                if text:
+                    yield text
+
     def chat(self, messages):
+        messages = json.loads(json.dumps(messages, default=lua_to_python))
+        params = {"mode": self.mode, "model": self.current_model, "messages": messages}
+        # Semantic matches compare the whole conversation
+        text = "\n".join(str(message.get("content", "")) for message in messages)
+        return self._cached('chat', params, text, lambda: self._chat(messages))
+
+    def _chat(self, messages):
         if self.mode == "local":
-            result = self.llm.create_chat_completion(messages)
+            try:
+                result = scheduler.result(scheduler.submit(self.llm, self.namespace, 'chat', messages=messages))
+            except (RuntimeError, TimeoutError) as e:
+                return json.dumps({"status": "error", "message": str(e)})
             return json.dumps(result)
         else:
+            import openai
             response = openai.chat.completions.create(
                 model=self.current_model,
                 messages=messages
@@ -19,10 +19,13 @@ class MonitoringLoggingPlugin(PluginBase):
         self.lock = threading.Lock()
 
         # Start background monitoring
-        self.stop_monitoring = False
-        self.monitor_thread = threading.Thread(target=self._background_monitor)
+        self.stop_monitoring = threading.Event()
+        self.monitor_thread = threading.Thread(target=self._background_monitor, daemon=True)
         self.monitor_thread.start()
 
+    def bind(self, context):
+        self.increment_query_count()
+
     def get_lua_interface(self):
         return {
             'monitor_log': self.lua_callable(self.log),
@@ -66,23 +69,24 @@ class MonitoringLoggingPlugin(PluginBase):
             return json.dumps({"status": "error", "message": str(e)})
 
     def _background_monitor(self):
-        while not self.stop_monitoring:
-            cpu_percent = psutil.cpu_percent(interval=5)
+        # Without an interval, cpu_percent measures since the previous call
+        # instead of sleeping, so closing the namespace never waits on it
+        psutil.cpu_percent(interval=None)
+        while not self.stop_monitoring.wait(60):  # Check every minute
+            cpu_percent = psutil.cpu_percent(interval=None)
             memory = psutil.virtual_memory()
             
             if cpu_percent > 80:
                 self.logger.warning(f"High CPU usage: {cpu_percent}%")
             if memory.percent > 80:
                 self.logger.warning(f"High memory usage: {memory.percent}%")
-            
-            time.sleep(60)  # Check every minute
 
     def increment_query_count(self):
         with self.lock:
             self.query_count += 1
 
     def shutdown(self):
-        self.stop_monitoring = True
+        self.stop_monitoring.set()
         self.monitor_thread.join()
 
     @property
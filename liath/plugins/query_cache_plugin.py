@@ -1,26 +1,114 @@
 from plugin_base import PluginBase
-from functools import lru_cache
+from storage.encoding import lua_to_python
+from collections import OrderedDict
+import hashlib
 import json
+import threading
+import time
 
 class QueryCachePlugin(PluginBase):
+    """Caches the JSON results of queries run through cached_query.
+
+    Entries remember the version of the namespace DB they were computed at.
+    The storage bumps its version on every write that reaches it (db_put,
+    db_delete, db_write_batch, a committed transaction...), and the database
+    after every call to a plugin's mutating function, so a cached result is
+    never served once the namespace may have changed.
+    """
+    max_entries = 256
+    # Seconds a result may be served; None relies on invalidation alone
+    default_ttl = None
+
     def initialize(self, context):
-        self.cache_size = 100  # Adjust as needed
+        self.namespace = context['namespace']
+        self.db = context['db']
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Context of the query running on each thread
+        self._local = threading.local()
+
+    def bind(self, context):
+        self._local.context = context
+
+    def unbind(self, context):
+        self._local.context = None
 
     def get_lua_interface(self):
         return {
-            'cached_query': self.lua_callable(self.cached_query)
+            'cached_query': self.lua_callable(self.cached_query),
+            'query_cache_clear': self.lua_callable(self.clear),
+            'query_cache_stats': self.lua_callable(self.stats),
         }
 
-    @lru_cache(maxsize=100)
-    def _cached_execution(self, query, namespace):
-        # This method would actually execute the query
-        # For demonstration, we're just returning a dummy result
-        return {"result": f"Cached result for query: {query} in namespace: {namespace}"}
+    def _key(self, query, params):
+        digest = hashlib.sha256(query.encode()).hexdigest()
+        return (self.namespace, digest, json.dumps(params, sort_keys=True))
+
+    def cached_query(self, query, params=None, ttl=None):
+        # cached_query("return db_get('total')") runs the query in the
+        # current runtime and returns its result as JSON. params is visible
+        # to the query as the params global, as for execute_query.
+        context = self._local.context
+        params = json.loads(json.dumps(params, default=lua_to_python))
+        # An open transaction's writes only reach the DB on commit, and only
+        # its session sees them, so the cache can't be used inside one
+        session = context.get('session')
+        if session is not None and session.transaction is not None:
+            return self._run(context, query, params)
+
+        key = self._key(query, params)
+        now = time.monotonic()
+        # Read before running: a write landing meanwhile makes the entry stale
+        version = self.db.version
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        result = self._run(context, query, params)
+        ttl = ttl if ttl is not None else self.default_ttl
+        with self._lock:
+            self._entries[key] = (version, now + ttl if ttl is not None else None, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def _run(self, context, query, params):
+        lua = context['lua']
+        lua_globals = lua.globals()
+        outer_params = lua_globals['params']
+        if params is not None:
+            lua_globals['params'] = lua.table_from(params, recursive=True)
+        try:
+            result = context['compile'](query)()
+        finally:
+            lua_globals['params'] = outer_params
+        return json.dumps(result, default=lua_to_python)
+
+    def clear(self):
+        with self._lock:
+            removed = len(self._entries)
+            self._entries.clear()
+        return json.dumps({"removed": removed})
 
-    def cached_query(self, query, namespace):
-        result = self._cached_execution(query, namespace)
-        return json.dumps(result)
+    def stats(self):
+        with self._lock:
+            return json.dumps({
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            })
 
     @property
     def name(self):
-        return "cache"
\ No newline at end of file
+        return "cache"
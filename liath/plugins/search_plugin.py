@@ -0,0 +1,295 @@
+from plugin_base import PluginBase
+from model_registry import registry
+from storage.encoding import get_codecs
+from lupa import lua_type
+import heapq
+import json
+import math
+import re
+import struct
+import threading
+
+class SearchPlugin(PluginBase):
+    mutating_functions = (
+        'sparse_configure',
+        'sparse_index',
+        'sparse_index_batch',
+        'sparse_remove',
+    )
+    lazy = True
+
+    # Column families in the namespace DB. Like the vdb ones they start with
+    # '_' and use the default JSON codecs, whatever the namespace codec is.
+    POSTINGS_CF = '_sparse_postings'  # term \0 document -> weight, length
+    DOCS_CF = '_sparse_docs'          # document -> terms, length, text
+    META_CF = '_sparse_meta'          # mode, model and corpus statistics
+    META_KEY = b'meta'
+
+    # BM25 parameters
+    k1 = 1.2
+    b = 0.75
+    # Reciprocal-rank fusion constant, documents score sum(1 / (rrf_k + rank))
+    rrf_k = 60
+    # Candidates fetched from each retriever per wanted hybrid result
+    candidate_multiplier = 4
+    # Keep indexed text, needed for late-interaction reranking
+    store_text = True
+    sparse_model = 'prithivida/Splade_PP_en_v1'
+    rerank_model = 'colbert-ir/colbertv2.0'
+
+    _posting = struct.Struct('<fI')
+    _token = re.compile(r'\w+')
+
+    def initialize(self, context):
+        self.db = context['db']
+        self.plugin = context['plugin']
+        for cf_name in (self.POSTINGS_CF, self.DOCS_CF, self.META_CF):
+            if cf_name not in self.db.list_column_families():
+                self.db.create_column_family(cf_name)
+        self.key_codec, self.value_codec = get_codecs()
+        stored = self.db.get_cf(self.META_CF, self.META_KEY)
+        self.meta = self.value_codec.decode(stored) if stored is not None else {
+            'mode': 'bm25', 'model': None, 'count': 0, 'total_length': 0,
+        }
+        self.models = {}
+        self.models_lock = threading.Lock()
+        self._local = threading.local()
+
+    def bind(self, context):
+        self._local.lua = context.get('lua')
+
+    def unbind(self, context):
+        self._local.lua = None
+
+    def shutdown(self):
+        for key in self.models:
+            registry.release(key)
+        self.models = {}
+
+    def get_lua_interface(self):
+        return {
+            'sparse_configure': self.lua_callable(self.configure),
+            'sparse_index': self.lua_callable(self.index),
+            # Takes a single {document = text} table, so it mustn't be unpacked
+            'sparse_index_batch': self.index_batch,
+            'sparse_remove': self.lua_callable(self.remove),
+            'sparse_search': self.lua_callable(self.search),
+            'sparse_stats': self.lua_callable(self.stats),
+            # Takes a single options table
+            'hybrid_search': self.hybrid_search,
+        }
+
+    def configure(self, mode='bm25', model=None):
+        # 'bm25' scores stored text; 'sparse' indexes the weights of a
+        # fastembed sparse model such as SPLADE. Terms from the two modes
+        # don't mix, so the mode can only change while the index is empty.
+        if mode not in ('bm25', 'sparse'):
+            return json.dumps({"status": "error", "message": "Mode must be 'bm25' or 'sparse'"})
+        if self.meta['count']:
+            return json.dumps({"status": "error", "message": "Remove all documents before changing the mode"})
+        meta = dict(self.meta, mode=mode, model=model)
+        self.db.put_cf(self.META_CF, self.META_KEY, self.value_codec.encode(meta))
+        self.meta = meta
+        return json.dumps({"status": "success", "message": f"Sparse index mode set to {mode}"})
+
+    def _model(self, kind, name):
+        # Same registry keys as the embed plugin, so both share the model
+        key = ('fastembed', kind, name)
+        with self.models_lock:
+            if key not in self.models:
+                from fastembed import SparseTextEmbedding, LateInteractionTextEmbedding
+                model_class = SparseTextEmbedding if kind == 'sparse_text' else LateInteractionTextEmbedding
+                self.models[key] = registry.acquire(key, lambda: model_class(model_name=name))
+            return self.models[key]
+
+    def _terms(self, text, query=False):
+        # Returns {term: weight}. In bm25 mode the weights are term counts; in
+        # sparse mode the terms are the model's vocabulary indexes.
+        if self.meta['mode'] == 'bm25':
+            terms = {}
+            for token in self._token.findall(text.lower()):
+                terms[token] = terms.get(token, 0) + 1
+            return terms
+        model = self._model('sparse_text', self.meta['model'] or self.sparse_model)
+        embedding = next(iter(model.query_embed(text) if query else model.embed([text])))
+        return {str(index): float(value) for index, value in zip(embedding.indices, embedding.values)}
+
+    def _posting_key(self, term, doc):
+        return term.encode() + b'\x00' + doc
+
+    def _remove_ops(self, doc, meta, ops):
+        # Appends the deletes for an indexed document and takes it out of meta
+        record = self.db.get_cf(self.DOCS_CF, doc)
+        if record is None:
+            return False
+        record = self.value_codec.decode(record)
+        for term in record['terms']:
+            ops.append({'type': 'delete', 'cf': self.POSTINGS_CF, 'key': self._posting_key(term, doc)})
+        ops.append({'type': 'delete', 'cf': self.DOCS_CF, 'key': doc})
+        meta['count'] -= 1
+        meta['total_length'] -= record['length']
+        return True
+
+    def _index_ops(self, doc, text, meta, ops):
+        doc = self.key_codec.encode(doc)
+        self._remove_ops(doc, meta, ops)
+        terms = self._terms(text)
+        length = sum(terms.values()) if meta['mode'] == 'bm25' else len(terms)
+        for term, weight in terms.items():
+            ops.append({'type': 'put', 'cf': self.POSTINGS_CF, 'key': self._posting_key(term, doc),
+                        'value': self._posting.pack(weight, int(length))})
+        record = {'terms': list(terms), 'length': length}
+        if self.store_text:
+            record['text'] = text
+        ops.append({'type': 'put', 'cf': self.DOCS_CF, 'key': doc, 'value': self.value_codec.encode(record)})
+        meta['count'] += 1
+        meta['total_length'] += length
+
+    def _write(self, ops, meta):
+        # Postings, document records and statistics change in one batch
+        ops.append({'type': 'put', 'cf': self.META_CF, 'key': self.META_KEY, 'value': self.value_codec.encode(meta)})
+        self.db.write_batch(ops)
+        self.meta = meta
+
+    def index(self, doc, text):
+        # Indexing a document again replaces its previous text
+        meta, ops = dict(self.meta), []
+        try:
+            self._index_ops(doc, text, meta, ops)
+        except Exception as e:
+            return json.dumps({"status": "error", "message": str(e)})
+        self._write(ops, meta)
+        return json.dumps({"status": "success", "message": f"Indexed {doc}"})
+
+    def index_batch(self, items):
+        meta, ops = dict(self.meta), []
+        count = 0
+        try:
+            for doc, text in items.items():
+                self._index_ops(doc, text, meta, ops)
+                count += 1
+        except Exception as e:
+            return json.dumps({"status": "error", "message": str(e)})
+        self._write(ops, meta)
+        return json.dumps({"status": "success", "message": f"{count} documents indexed"})
+
+    def remove(self, doc):
+        meta, ops = dict(self.meta), []
+        if not self._remove_ops(self.key_codec.encode(doc), meta, ops):
+            return json.dumps({"status": "error", "message": f"Document not found: {doc}"})
+        self._write(ops, meta)
+        return json.dumps({"status": "success", "message": f"Removed {doc}"})
+
+    def stats(self):
+        return json.dumps(self.meta)
+
+    def _sparse_search(self, text, k):
+        # Returns [(doc, score)] best first. Each query term reads its posting
+        # list with one prefix scan.
+        meta = self.meta
+        if not meta['count']:
+            return []
+        bm25 = meta['mode'] == 'bm25'
+        average_length = meta['total_length'] / meta['count'] or 1
+        scores = {}
+        for term, query_weight in self._terms(text, query=True).items():
+            prefix = self._posting_key(term, b'')
+            postings = [(key[len(prefix):], self._posting.unpack(value))
+                        for key, value in self.db.iterator(cf_name=self.POSTINGS_CF, prefix=prefix)]
+            if bm25:
+                idf = math.log(1 + (meta['count'] - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, (weight, length) in postings:
+                if bm25:
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    score = query_weight * idf * weight * (self.k1 + 1) / (weight + norm)
+                else:
+                    score = query_weight * weight
+                scores[doc] = scores.get(doc, 0.0) + score
+        best = heapq.nlargest(int(k), scores.items(), key=lambda item: item[1])
+        return [(self.key_codec.decode(doc), score) for doc, score in best]
+
+    def search(self, text, k=10):
+        return self._lua_results([{"doc": doc, "score": score} for doc, score in self._sparse_search(text, k)])
+
+    def _dense_search(self, text, vector, k, filter):
+        # Returns [(doc, distance)] from the vdb plugin. Without a vector the
+        # query text is embedded with the namespace's embed plugin.
+        import numpy as np
+        vdb = self.plugin('vdb')
+        if vdb is None:
+            raise RuntimeError("Dense search needs the vdb plugin")
+        if vector is None:
+            embed = self.plugin('embed')
+            if embed is None:
+                raise RuntimeError("Embedding the query needs the embed plugin")
+            result = json.loads(embed.embed(text=text))
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+            vector = result['embedding']
+        rows = vdb.query(vdb._to_numpy(vector, np.float32).reshape(1, -1), k, filter, hydrate=True)
+        if rows is None:
+            return []
+        # Vectors added under an integer key have no document key
+        return [(hit['doc'] if hit['doc'] is not None else hit['key'], hit['distance']) for hit in rows[0]]
+
+    def _fuse(self, rankings):
+        scores = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking, 1):
+                scores[doc] = scores.get(doc, 0.0) + 1.0 / (self.rrf_k + rank)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def _rerank(self, text, hits):
+        # Late interaction: each query token takes its best match among the
+        # document's tokens (MaxSim) and the matches are summed. Hits without
+        # stored text keep their fused order behind the reranked ones.
+        import numpy as np
+        records = self.db.multi_get([self.key_codec.encode(hit['doc']) for hit in hits], cf_name=self.DOCS_CF)
+        texts = [self.value_codec.decode(record).get('text') if record is not None else None for record in records]
+        scored = [i for i, doc_text in enumerate(texts) if doc_text is not None]
+        if not scored:
+            return hits
+        model = self._model('late_interaction_text', self.rerank_model)
+        query = np.asarray(next(iter(model.query_embed(text))))
+        for i, tokens in zip(scored, model.embed([texts[i] for i in scored])):
+            hits[i]['rerank_score'] = float(np.max(query @ np.asarray(tokens).T, axis=1).sum())
+        return sorted(hits, key=lambda hit: hit.get('rerank_score', float('-inf')), reverse=True)
+
+    def hybrid_search(self, options):
+        # options: text and/or vector, k (10), candidates per retriever
+        # (k * candidate_multiplier), filter (passed to vdb), dense (false
+        # skips the vector side) and rerank (true reranks the fused top k
+        # with the late-interaction model). Returns a Lua array of {doc,
+        # score, dense_rank, sparse_rank}.
+        option = options.__getitem__ if lua_type(options) == 'table' else options.get
+        text, vector = option('text'), option('vector')
+        if text is None and vector is None:
+            return json.dumps({"status": "error", "message": "hybrid_search needs text or a vector"})
+        k = int(option('k') or 10)
+        candidates = int(option('candidates') or k * self.candidate_multiplier)
+        try:
+            dense = []
+            if vector is not None or option('dense') is not False:
+                dense = self._dense_search(text, vector, candidates, option('filter'))
+            sparse = self._sparse_search(text, candidates) if text is not None else []
+        except Exception as e:
+            return json.dumps({"status": "error", "message": str(e)})
+
+        dense_ranks = {doc: rank for rank, (doc, _) in enumerate(dense, 1)}
+        sparse_ranks = {doc: rank for rank, (doc, _) in enumerate(sparse, 1)}
+        hits = [{"doc": doc, "score": score, "dense_rank": dense_ranks.get(doc), "sparse_rank": sparse_ranks.get(doc)}
+                for doc, score in self._fuse([list(dense_ranks), list(sparse_ranks)])[:k]]
+        if option('rerank') and text is not None:
+            try:
+                hits = self._rerank(text, hits)
+            except Exception as e:
+                return json.dumps({"status": "error", "message": str(e)})
+        return self._lua_results(hits)
+
+    def _lua_results(self, results):
+        lua = getattr(self._local, 'lua', None)
+        return lua.table_from(results, recursive=True) if lua is not None else results
+
+    @property
+    def name(self):
+        return "search"
@@ -1,114 +1,630 @@
 from plugin_base import PluginBase
-from usearch.index import Index, Matches
+from rwlock import ReadWriteLock
+from storage.encoding import get_codecs
+from lupa import lua_type
 import json
-import numpy as np
 import os
+import threading
 
 class VDBPlugin(PluginBase):
+    mutating_functions = (
+        'vdb_create_index',
+        'vdb_add',
+        'vdb_add_batch',
+        'vdb_remove',
+        'vdb_clear',
+        'vdb_save',
+        'vdb_load',
+        'vdb_requantize',
+        'vdb_compact',
+    )
+    lazy = True
+    # Changed vectors after which the index is checkpointed automatically
+    checkpoint_interval = 100000
+    # usearch worker threads for batched inserts, 0 uses every core
+    threads = 0
+    # Index files at least this many bytes are memory-mapped on load instead
+    # of read into RAM. None only maps on vdb_load{view=true}.
+    view_threshold = None
+    # Filters matching at most this many vectors are searched exactly over
+    # just those vectors instead of post-filtering graph results
+    exact_filter_limit = 4096
+    # Graph candidates fetched per wanted result when post-filtering
+    filter_oversample = 4
+    # Vectors copied per read-locked step of a background rebuild
+    rebuild_chunk_size = 65536
+    REQUANTIZE_DTYPES = ('f64', 'f32', 'bf16', 'f16', 'i8')
+
+    # Column families in the namespace DB. Vector ids are 8-byte big-endian
+    # integers. Document keys and payloads use the default JSON codecs rather
+    # than the namespace ones, so migrate_codec can skip these families.
+    KEYS_CF = '_vdb_keys'        # vector id -> document key
+    IDS_CF = '_vdb_ids'          # document key -> vector id
+    PAYLOAD_CF = '_vdb_payload'  # vector id -> payload
+    NEXT_ID = b'next'           # next id to hand out, kept in KEYS_CF
+
     def initialize(self, context):
+        from vector_log import VectorLog
         self.namespace = context['namespace']
         self.db = context['db']
         self.data_dir = context['data_dir']
         self.index_path = os.path.join(self.data_dir, f"{self.namespace}_index.usearch")
+        # Adds and removes since the last checkpoint, replayed on load
+        self.log = VectorLog(self.index_path + '.log')
+        self.pending = 0
+        # The index stays resident for the life of the namespace and every
+        # query shares it: searches take the read side, changes the write side
+        self.index_lock = ReadWriteLock()
+        self.viewing = False
         self.index = self._load_or_create_index()
+        # Bumped whenever self.index is replaced by other content, so a
+        # rebuild that started before knows not to swap its copy in
+        self.generation = 0
+        self.rebuild_thread = None
+        self.rebuild_changes = None
+        self.rebuild_error = None
+        self.rebuild_cancel = threading.Event()
+        self.codec = None
+        self._set_codec(context.get('codec'))
+        for cf_name in (self.KEYS_CF, self.IDS_CF, self.PAYLOAD_CF):
+            if cf_name not in self.db.list_column_families():
+                self.db.create_column_family(cf_name)
+        self.next_id = None
+        self.doc_codec, self.payload_codec = get_codecs()
+        # Lua runtime of the query running on each thread
+        self._local = threading.local()
+
+    def bind(self, context):
+        if context.get('codec') != self.codec:
+            self._set_codec(context.get('codec'))
+        self._local.lua = context.get('lua')
+
+    def unbind(self, context):
+        self._local.lua = None
+
+    def _set_codec(self, config):
+        # Needed for document keys, payloads and key sets stored with db_put
+        self.codec = dict(config or {})
+        self.key_codec, self.value_codec = get_codecs(self.codec)
+
+    def shutdown(self):
+        self._cancel_rebuild()
+        with self.index_lock.write_lock():
+            if self.index is not None and self.pending:
+                self.checkpoint()
+            self.log.close()
+            self.index = None
 
     def get_lua_interface(self):
         return {
             'vdb_create_index': self.lua_callable(self.create_index),
             'vdb_add': self.lua_callable(self.add),
+            'vdb_add_batch': self.lua_callable(self.add_batch),
             'vdb_search': self.lua_callable(self.search),
+            'vdb_search_batch': self.lua_callable(self.search_batch),
+            'vdb_filter_search': self.lua_callable(self.filter_search),
             'vdb_remove': self.lua_callable(self.remove),
             'vdb_count': self.lua_callable(self.count),
             'vdb_clear': self.lua_callable(self.clear),
             'vdb_save': self.lua_callable(self.save_index),
             'vdb_load': self.lua_callable(self.load_index),
-            'vdb_get_metadata': self.lua_callable(self.get_metadata)
+            'vdb_get_metadata': self.lua_callable(self.get_metadata),
+            'vdb_requantize': self.lua_callable(self.requantize),
+            'vdb_compact': self.lua_callable(self.compact),
         }
 
-    def _load_or_create_index(self):
-        if os.path.exists(self.index_path):
-            return Index.restore(self.index_path)
-        else:
+    def _load_or_create_index(self, view=None):
+        from usearch.index import Index
+        if not os.path.exists(self.index_path):
+            self.viewing = False
             return None  # We'll create the index when the user calls create_index
+        if view is None:
+            view = self.view_threshold is not None and os.path.getsize(self.index_path) >= self.view_threshold
+
+        index = None
+        if not view or self.log.size:
+            index = Index.restore(self.index_path)
+            self.pending = self.log.replay(index)
+            if view:
+                # A memory-mapped index is read-only, so logged changes have
+                # to be folded into the file before it is mapped
+                self._save(index)
+        if view:
+            index = Index.restore(self.index_path, view=True)
+        self.viewing = view
+        return index
+
+    def _writable(self):
+        # Changing a memory-mapped index means loading it into RAM first
+        if self.viewing:
+            self.index = self._load_or_create_index(view=False)
+
+    def _to_numpy(self, value, dtype):
+        import numpy as np
+        return np.array(self._to_list(value), dtype=dtype)
+
+    def _to_list(self, value):
+        if lua_type(value) == 'table':
+            return [self._to_list(item) for item in value.values()]
+        if isinstance(value, list):
+            # e.g. vdb_add wraps a single Lua vector in a Python list
+            return [self._to_list(item) for item in value]
+        return value
+
+    @staticmethod
+    def _is_id(key):
+        return isinstance(key, int) and not isinstance(key, bool)
+
+    @staticmethod
+    def _id_bytes(vector_id):
+        return int(vector_id).to_bytes(8, 'big')
+
+    def _resolve_ids(self, keys, create=False):
+        # Maps keys to vector ids. Integers are ids already; anything else is
+        # a document key, looked up in IDS_CF and, with create, given a new id.
+        # Returns (ids, ops): unknown documents map to None and ops holds the
+        # mapping writes for new ones.
+        ids = [key if self._is_id(key) else None for key in keys]
+        docs = [(i, self.doc_codec.encode(key)) for i, key in enumerate(keys) if ids[i] is None]
+        ops = []
+        if not docs:
+            return ids, ops
+        found = self.db.multi_get([encoded for _, encoded in docs], cf_name=self.IDS_CF)
+        assigned = {}
+        for (i, encoded), value in zip(docs, found):
+            if value is not None:
+                ids[i] = int.from_bytes(value, 'big')
+            elif encoded in assigned:
+                ids[i] = assigned[encoded]
+            elif create:
+                ids[i] = assigned[encoded] = self._allocate_id(assigned.values())
+                ops.append({'type': 'put', 'cf': self.IDS_CF, 'key': encoded, 'value': self._id_bytes(ids[i])})
+                ops.append({'type': 'put', 'cf': self.KEYS_CF, 'key': self._id_bytes(ids[i]), 'value': encoded})
+        if assigned:
+            ops.append({'type': 'put', 'cf': self.KEYS_CF, 'key': self.NEXT_ID, 'value': self._id_bytes(self.next_id)})
+        return ids, ops
+
+    def _allocate_id(self, taken):
+        # Callers hold the write side of index_lock
+        if self.next_id is None:
+            stored = self.db.get_cf(self.KEYS_CF, self.NEXT_ID)
+            self.next_id = int.from_bytes(stored, 'big') if stored is not None else 1
+        # Skip ids that were added explicitly as integer keys
+        while self.next_id in taken or self.index.contains(self.next_id):
+            self.next_id += 1
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _payload_ops(self, ids, payloads):
+        ops = []
+        for vector_id, payload in zip(ids, payloads):
+            if payload is not None:
+                ops.append({'type': 'put', 'cf': self.PAYLOAD_CF, 'key': self._id_bytes(vector_id),
+                            'value': self.payload_codec.encode(payload)})
+        return ops
+
+    def _hydrate(self, rows):
+        # Joins search hits with their document key, payload and the document
+        # stored at that key, using one multi-get per keyspace for all rows
+        ids = sorted({vector_id for row in rows for vector_id, _ in row})
+        id_keys = [self._id_bytes(vector_id) for vector_id in ids]
+        docs = self.db.multi_get(id_keys, cf_name=self.KEYS_CF)
+        payloads = self.db.multi_get(id_keys, cf_name=self.PAYLOAD_CF)
+        docs = [self.doc_codec.decode(doc) if doc is not None else None for doc in docs]
+        doc_keys = [self.key_codec.encode(doc) for doc in docs if doc is not None]
+        values = dict(zip(doc_keys, self.db.multi_get(doc_keys)))
+        hydrated = {}
+        for vector_id, doc, payload in zip(ids, docs, payloads):
+            value = values.get(self.key_codec.encode(doc)) if doc is not None else None
+            hydrated[vector_id] = {
+                "doc": doc,
+                "payload": self.payload_codec.decode(payload) if payload is not None else None,
+                "value": self.value_codec.decode(value) if value is not None else None,
+            }
+        return [[dict({"key": vector_id, "distance": distance}, **hydrated[vector_id])
+                 for vector_id, distance in row] for row in rows]
+
+    def _matches(self, rows, hydrate):
+        if hydrate:
+            return self._hydrate(rows)
+        return [[{"key": key, "distance": distance} for key, distance in row] for row in rows]
+
+    def _changed(self, count):
+        self.pending += count
+        if self.pending >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Callers hold the write side of index_lock
+        if not self.viewing:
+            self._save(self.index)
+
+    def _save(self, index):
+        # Writes the whole index next to the old one, swaps it in, then drops
+        # the log entries it now contains
+        tmp_path = self.index_path + '.tmp'
+        index.save(tmp_path)
+        os.replace(tmp_path, self.index_path)
+        self.log.truncate()
+        self.pending = 0
+
+    def requantize(self, dtype, wait=False):
+        # Converts the index to another scalar type, e.g. f32 to i8 for a
+        # quarter of the memory. i8 is meant for cosine-like metrics.
+        if dtype not in self.REQUANTIZE_DTYPES:
+            return json.dumps({"status": "error", "message": f"dtype must be one of {list(self.REQUANTIZE_DTYPES)}"})
+        return self._start_rebuild(dtype, wait)
+
+    def compact(self, wait=False):
+        # Rebuilds the graph without the slots left behind by removes
+        return self._start_rebuild(None, wait)
+
+    def _rebuilding(self):
+        return self.rebuild_thread is not None and self.rebuild_thread.is_alive()
+
+    def _start_rebuild(self, dtype, wait):
+        # The copy is built in a background thread while searches and changes
+        # keep using the current index, then swapped in under the write lock.
+        # With wait the call returns once the swap is done.
+        with self.index_lock.write_lock():
+            if self.index is None:
+                return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
+            if self._rebuilding():
+                return json.dumps({"status": "error", "message": "A rebuild is already running"})
+            self.rebuild_error = None
+            self.rebuild_cancel.clear()
+            # Changes from here on are replayed onto the copy before the swap
+            self.rebuild_changes = []
+            keys = self.index.keys[:]
+            self.rebuild_thread = threading.Thread(
+                target=self._rebuild, args=(keys, dtype, self.generation), daemon=True)
+            self.rebuild_thread.start()
+        if wait:
+            self.rebuild_thread.join()
+            if self.rebuild_error is not None:
+                return json.dumps({"status": "error", "message": self.rebuild_error})
+            return json.dumps({"status": "success", "message": "Index rebuilt"})
+        return json.dumps({"status": "success", "message": "Index rebuild started"})
+
+    def _rebuild(self, keys, dtype, generation):
+        import numpy as np
+        from usearch.index import Index
+        try:
+            with self.index_lock.read_lock():
+                current = self.index
+                index = Index(
+                    ndim=current.ndim,
+                    metric=current.metric,
+                    dtype=dtype or current.dtype,
+                    connectivity=current.connectivity,
+                    expansion_add=current.expansion_add,
+                    expansion_search=current.expansion_search
+                )
+            for start in range(0, len(keys), self.rebuild_chunk_size):
+                if self.rebuild_cancel.is_set():
+                    return
+                chunk = keys[start:start + self.rebuild_chunk_size]
+                # Vectors removed since the rebuild started are skipped; ones
+                # replaced are copied again by the replay below
+                with self.index_lock.read_lock():
+                    chunk = chunk[np.atleast_1d(self.index.contains(chunk))]
+                    vectors = np.vstack(self.index.get(chunk, dtype=np.float32)) if len(chunk) else None
+                if vectors is not None:
+                    index.add(chunk, vectors, threads=self.threads)
+
+            with self.index_lock.write_lock():
+                if self.generation != generation:
+                    self.rebuild_error = "The index was replaced during the rebuild"
+                    return
+                if self.rebuild_cancel.is_set():
+                    return
+                for changed, vectors in self.rebuild_changes:
+                    changed = np.asarray(changed, dtype=np.uint64)
+                    existing = changed[np.atleast_1d(index.contains(changed))]
+                    if len(existing):
+                        index.remove(existing)
+                    if vectors is not None:
+                        index.add(changed, vectors)
+                viewing = self.viewing
+                self._save(index)
+                self.index = Index.restore(self.index_path, view=True) if viewing else index
+                self.rebuild_changes = None
+                # The swap may land after the query that started it
+                self.db.bump_version()
+        except Exception as e:
+            self.rebuild_error = str(e)
+        finally:
+            self.rebuild_changes = None
+
+    def _cancel_rebuild(self):
+        self.rebuild_cancel.set()
+        if self.rebuild_thread is not None:
+            self.rebuild_thread.join()
 
     def create_index(self, ndim, metric='cos', dtype='f32', connectivity=16, expansion_add=128, expansion_search=64):
-        self.index = Index(
-            ndim=ndim,
-            metric=metric,
-            dtype=dtype,
-            connectivity=connectivity,
-            expansion_add=expansion_add,
-            expansion_search=expansion_search
-        )
-        self.save_index()
+        from usearch.index import Index
+        with self.index_lock.write_lock():
+            self.index = Index(
+                ndim=ndim,
+                metric=metric,
+                dtype=dtype,
+                connectivity=connectivity,
+                expansion_add=expansion_add,
+                expansion_search=expansion_search
+            )
+            self.generation += 1
+            self.viewing = False
+            self.checkpoint()
         return json.dumps({"status": "success", "message": f"Index created with {ndim} dimensions"})
 
-    def add(self, key, vector):
-        if self.index is None:
+    def add(self, key, vector, payload=None):
+        # key is an integer vector id or a document key. Document keys get an
+        # id of their own; payload is stored alongside in PAYLOAD_CF.
+        return self.add_batch([key], [vector], [payload])
+
+    def add_batch(self, keys, vectors, payloads=None):
+        # One multithreaded usearch insert for the whole batch. The vectors
+        # reach disk through the log; the index itself only at checkpoints.
+        import numpy as np
+        keys = self._to_list(keys)
+        vectors = self._to_numpy(vectors, np.float32)
+        if vectors.ndim != 2 or len(keys) != len(vectors):
+            return json.dumps({"status": "error", "message": "Expected one vector per key"})
+        if lua_type(payloads) == 'table':
+            payloads = [payloads[i + 1] for i in range(len(keys))]
+        with self.index_lock.write_lock():
+            if self.index is None:
+                return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
+            self._writable()
+            ids, ops = self._resolve_ids(keys, create=True)
+            ids = np.array(ids, dtype=np.uint64)
+            try:
+                # Adding a key again replaces its vector, as a log replay does
+                existing = ids[np.atleast_1d(self.index.contains(ids))]
+                if len(existing):
+                    self.index.remove(existing)
+                self.index.add(ids, vectors, threads=self.threads)
+            except Exception as e:
+                return json.dumps({"status": "error", "message": str(e)})
+            self.log.append_add(ids, vectors)
+            if self.rebuild_changes is not None:
+                self.rebuild_changes.append((ids, vectors))
+            ops += self._payload_ops(ids.tolist(), payloads or [])
+            if ops:
+                self.db.write_batch(ops)
+            self._changed(len(ids))
+        if len(keys) == 1:
+            return json.dumps({"status": "success", "message": f"Vector added for key: {keys[0]}"})
+        return json.dumps({"status": "success", "message": f"{len(keys)} vectors added"})
+
+    def search(self, vector, k, hydrate=False):
+        import numpy as np
+        with self.index_lock.read_lock():
+            if self.index is None:
+                return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
+            matches = self.index.search(self._to_numpy(vector, np.float32), k).to_list()
+            rows = [[(int(match[0]), float(match[1])) for match in matches]]
+        return json.dumps(self._matches(rows, hydrate)[0])
+
+    def search_batch(self, vectors, k, filter=None, hydrate=False):
+        # One multithreaded usearch call for every query vector. Returns a Lua
+        # array with one array of {key, distance} per query.
+        import numpy as np
+        queries = self._to_numpy(vectors, np.float32)
+        if queries.ndim != 2:
+            return json.dumps({"status": "error", "message": "Expected a list of vectors"})
+        rows = self.query(queries, k, filter, hydrate)
+        if rows is None:
             return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
-        self.index.add(key, np.array(vector, dtype=np.float32))
-        self.save_index()
-        return json.dumps({"status": "success", "message": f"Vector added for key: {key}"})
+        return self._lua_results(rows)
 
-    def search(self, vector, k):
-        if self.index is None:
+    def filter_search(self, vector, k, filter=None, hydrate=False):
+        # Like vdb_search, restricted by filter and returning a Lua array
+        import numpy as np
+        rows = self.query(self._to_numpy(vector, np.float32).reshape(1, -1), k, filter, hydrate)
+        if rows is None:
             return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
-        matches = self.index.search(np.array(vector, dtype=np.float32), k).to_list()
-        return json.dumps([{"key": match[0], "distance": match[1]} for match in matches])
+        return self._lua_results(rows[0])
+
+    def query(self, queries, k, filter=None, hydrate=False):
+        # Searches a 2-D array of query vectors and returns one list of match
+        # dicts per query, or None without an index. Other plugins call this
+        # directly to get Python results.
+        with self.index_lock.read_lock():
+            if self.index is None:
+                return None
+            rows = self._search(queries, int(k), *self._resolve_filter(filter))
+        return self._matches(rows, hydrate)
+
+    def _resolve_filter(self, filter):
+        # filter is nil, a predicate function(key) -> bool, or a table with
+        # any of: keys (array of vector ids or document keys), keys_from (a db
+        # key whose value is such an array, optionally in column family cf)
+        # and predicate.
+        # Returns (allowed keys as a uint64 array or None, predicate or None).
+        import numpy as np
+        if filter is None:
+            return None, None
+        if lua_type(filter) == 'function':
+            return None, filter
+        allowed = None
+        if filter['keys'] is not None:
+            allowed = set(self._to_list(filter['keys']))
+        if filter['keys_from'] is not None:
+            stored = set(self._stored_keys(filter['keys_from'], filter['cf']))
+            allowed = stored if allowed is None else allowed & stored
+        if allowed is not None:
+            ids, _ = self._resolve_ids(list(allowed))
+            allowed = np.array(sorted({vector_id for vector_id in ids if vector_id is not None}), dtype=np.uint64)
+        return allowed, filter['predicate']
+
+    def _stored_keys(self, key, cf_name=None):
+        encoded = self.key_codec.encode(key)
+        value = self.db.get_cf(cf_name, encoded) if cf_name else self.db.get(encoded)
+        return self.value_codec.decode(value) if value is not None else []
+
+    def _search(self, queries, k, allowed=None, predicate=None):
+        # Returns one [(key, distance), ...] list per query row. Callers hold
+        # the read side of index_lock.
+        import numpy as np
+        if len(self.index) == 0 or k <= 0:
+            return [[] for _ in queries]
+        if allowed is None and predicate is None:
+            return self._rows(self.index.search(queries, k, threads=self.threads), len(queries))
+        if allowed is not None:
+            if len(allowed):
+                allowed = allowed[np.atleast_1d(self.index.contains(allowed))]
+            if len(allowed) <= self.exact_filter_limit:
+                return self._search_exact(queries, k, allowed, predicate)
+
+        # Post-filter graph results, widening the search for queries that
+        # come back short until the whole index has been considered
+        allowed_set = set(allowed.tolist()) if allowed is not None else None
+        verdicts = {}
+
+        def accept(key):
+            if allowed_set is not None and key not in allowed_set:
+                return False
+            if predicate is None:
+                return True
+            if key not in verdicts:
+                verdicts[key] = bool(predicate(key))
+            return verdicts[key]
+
+        results = [None] * len(queries)
+        pending = list(range(len(queries)))
+        count = min(len(self.index), k * self.filter_oversample)
+        while pending:
+            rows = self._rows(self.index.search(queries[pending], count, threads=self.threads), len(pending))
+            retry = []
+            for i, row in zip(pending, rows):
+                hits = [(key, distance) for key, distance in row if accept(key)]
+                if len(hits) >= k or count >= len(self.index):
+                    results[i] = hits[:k]
+                else:
+                    retry.append(i)
+            pending = retry
+            count = min(len(self.index), count * 2)
+        return results
+
+    def _search_exact(self, queries, k, allowed, predicate):
+        import numpy as np
+        from usearch.index import search as exact_search
+        if predicate is not None:
+            allowed = np.array([key for key in allowed.tolist() if predicate(key)], dtype=np.uint64)
+        if not len(allowed):
+            return [[] for _ in queries]
+        vectors = np.vstack(self.index.get(allowed, dtype=np.float32))
+        matches = exact_search(vectors, queries, min(k, len(allowed)), self.index.metric, exact=True,
+                               threads=self.threads)
+        # Exact search reports row numbers of vectors, not index keys
+        return [[(int(allowed[row]), distance) for row, distance in hits]
+                for hits in self._rows(matches, len(queries))]
+
+    def _rows(self, matches, n):
+        import numpy as np
+        keys = np.atleast_2d(matches.keys)
+        distances = np.atleast_2d(matches.distances)
+        counts = np.atleast_1d(matches.counts) if hasattr(matches, 'counts') else [len(matches.keys)]
+        return [
+            [(int(key), float(distance)) for key, distance in zip(keys[i][:counts[i]], distances[i][:counts[i]])]
+            for i in range(n)
+        ]
+
+    def _lua_results(self, results):
+        lua = getattr(self._local, 'lua', None)
+        return lua.table_from(results, recursive=True) if lua is not None else results
 
     def remove(self, key):
-        if self.index is None:
-            return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
-        try:
-            self.index.remove(key)
-            self.save_index()
-            return json.dumps({"status": "success", "message": f"Vector removed for key: {key}"})
-        except KeyError:
-            return json.dumps({"status": "error", "message": f"Key not found: {key}"})
+        with self.index_lock.write_lock():
+            if self.index is None:
+                return json.dumps({"status": "error", "message": "Index not created. Call vdb_create_index first."})
+            self._writable()
+            vector_id = self._resolve_ids([key])[0][0]
+            if vector_id is None or not self.index.remove(vector_id):
+                return json.dumps({"status": "error", "message": f"Key not found: {key}"})
+            self.log.append_remove([vector_id])
+            if self.rebuild_changes is not None:
+                self.rebuild_changes.append(([vector_id], None))
+            id_key = self._id_bytes(vector_id)
+            doc = self.db.get_cf(self.KEYS_CF, id_key)
+            ops = [{'type': 'delete', 'cf': self.KEYS_CF, 'key': id_key},
+                   {'type': 'delete', 'cf': self.PAYLOAD_CF, 'key': id_key}]
+            if doc is not None:
+                ops.append({'type': 'delete', 'cf': self.IDS_CF, 'key': doc})
+            self.db.write_batch(ops)
+            self._changed(1)
+        return json.dumps({"status": "success", "message": f"Vector removed for key: {key}"})
 
     def count(self):
-        if self.index is None:
-            return json.dumps({"count": 0})
-        return json.dumps({"count": len(self.index)})
+        with self.index_lock.read_lock():
+            if self.index is None:
+                return json.dumps({"count": 0})
+            return json.dumps({"count": len(self.index)})
 
     def clear(self):
-        if self.index is not None:
-            self.index = Index(
-                ndim=self.index.ndim,
-                metric=self.index.metric,
-                dtype=self.index.dtype,
-                connectivity=self.index.connectivity,
-                expansion_add=self.index.expansion_add,
-                expansion_search=self.index.expansion_search
-            )
-            self.save_index()
+        with self.index_lock.write_lock():
+            if self.index is not None:
+                from usearch.index import Index
+                self.index = Index(
+                    ndim=self.index.ndim,
+                    metric=self.index.metric,
+                    dtype=self.index.dtype,
+                    connectivity=self.index.connectivity,
+                    expansion_add=self.index.expansion_add,
+                    expansion_search=self.index.expansion_search
+                )
+                self.generation += 1
+                self.viewing = False
+                self.checkpoint()
+                self._clear_mappings()
         return json.dumps({"status": "success", "message": "Vector database cleared"})
 
+    def _clear_mappings(self):
+        # The id counter survives, so ids of cleared documents aren't reused
+        for cf_name in (self.KEYS_CF, self.IDS_CF, self.PAYLOAD_CF):
+            ops = [{'type': 'delete', 'cf': cf_name, 'key': key}
+                   for key, _ in self.db.iterator(cf_name=cf_name) if key != self.NEXT_ID]
+            if ops:
+                self.db.write_batch(ops)
+
     def save_index(self):
-        if self.index is not None:
-            self.index.save(self.index_path)
-            return json.dumps({"status": "success", "message": "Index saved to disk"})
+        # An explicit checkpoint
+        with self.index_lock.write_lock():
+            if self.index is not None:
+                self.checkpoint()
+                return json.dumps({"status": "success", "message": "Index saved to disk"})
         return json.dumps({"status": "error", "message": "No index to save"})
 
-    def load_index(self):
-        if os.path.exists(self.index_path):
-            self.index = Index.restore(self.index_path)
-            return json.dumps({"status": "success", "message": "Index loaded from disk"})
+    def load_index(self, view=False):
+        # view=true memory-maps the index file instead of reading it into
+        # RAM. The first change after that loads it fully again.
+        with self.index_lock.write_lock():
+            if os.path.exists(self.index_path):
+                self.index = self._load_or_create_index(view=bool(view))
+                self.generation += 1
+                mode = "memory-mapped" if self.viewing else "loaded"
+                return json.dumps({"status": "success", "message": f"Index {mode} from disk"})
         return json.dumps({"status": "error", "message": "No index file found"})
 
     def get_metadata(self):
-        if self.index is not None:
-            metadata = Index.metadata(self.index_path)
-            return json.dumps({
-                "ndim": metadata.ndim,
-                "metric": metadata.metric,
-                "dtype": metadata.dtype,
-                "connectivity": metadata.connectivity,
-                "expansion_add": metadata.expansion_add,
-                "expansion_search": metadata.expansion_search
-            })
+        with self.index_lock.read_lock():
+            if self.index is not None:
+                # Read from the resident index; Index.metadata() returns a
+                # dict of file header fields rather than these settings
+                return json.dumps({
+                    "ndim": self.index.ndim,
+                    "metric": self.index.metric.name.lower(),
+                    "dtype": self.index.dtype.name.lower(),
+                    "connectivity": self.index.connectivity,
+                    "expansion_add": self.index.expansion_add,
+                    "expansion_search": self.index.expansion_search,
+                    "view": self.viewing,
+                    "rebuilding": self._rebuilding(),
+                    "rebuild_error": self.rebuild_error,
+                })
         return json.dumps({"status": "error", "message": "No index available"})
 
     @property
     def name(self):
-        return "vdb"
\ No newline at end of file
+        return "vdb"
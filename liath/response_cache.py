@@ -0,0 +1,179 @@
+import hashlib
+import json
+import threading
+import time
+
+
+class ResponseCache:
+    """Persistent LLM response cache for one namespace.
+
+    Responses are stored in a column family of the namespace DB, keyed by a
+    hash of the request kind and every parameter that shapes the answer
+    (model, prompt or messages, max_tokens...). In semantic mode prompts are
+    also embedded, and a request with no exact entry gets the answer of the
+    most similar cached prompt with otherwise identical parameters, if the
+    cosine similarity reaches the threshold.
+    """
+
+    CF = '_llm_cache'
+    CONFIG_KEY = b'config'
+    DEFAULT_CONFIG = {
+        'enabled': True,
+        # Seconds an entry stays valid; None keeps entries until cleared
+        'ttl': None,
+        'semantic': False,
+        'threshold': 0.95,
+    }
+    # Nearest cached prompts checked for a semantic hit
+    semantic_candidates = 4
+
+    def __init__(self, db, embed=None):
+        # embed(text) returns a vector for text, or None if it can't
+        self.db = db
+        self.embed = embed
+        if self.CF not in db.list_column_families():
+            db.create_column_family(self.CF)
+        stored = db.get_cf(self.CF, self.CONFIG_KEY)
+        self.config = dict(self.DEFAULT_CONFIG, **(json.loads(stored) if stored is not None else {}))
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        # Prompt vectors of semantic entries, built from the column family on
+        # first use: usearch id -> cache key
+        self._index = None
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **options):
+        unknown = set(options) - set(self.DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown cache options: {sorted(unknown)}")
+        config = dict(self.config, **options)
+        self.db.put_cf(self.CF, self.CONFIG_KEY, json.dumps(config).encode())
+        self.config = config
+        return config
+
+    def _digest(self, *parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).digest()
+
+    def _load(self, key, now):
+        value = self.db.get_cf(self.CF, key)
+        if value is None:
+            return None
+        record = json.loads(value)
+        if record['expires'] is not None and record['expires'] <= now:
+            self.db.delete_cf(self.CF, key)
+            return None
+        return record
+
+    def get(self, kind, params, text=None):
+        # params must include the prompt or messages; text is what semantic
+        # mode compares, usually the prompt
+        if not self.config['enabled']:
+            return None
+        now = time.time()
+        record = self._load(self._digest(kind, params), now)
+        if record is not None:
+            self.hits += 1
+            return record['response']
+        if self.config['semantic'] and text is not None:
+            record = self._semantic_lookup(kind, params, text, now)
+            if record is not None:
+                self.semantic_hits += 1
+                return record['response']
+        self.misses += 1
+        return None
+
+    def put(self, kind, params, response, text=None):
+        if not self.config['enabled']:
+            return
+        key = self._digest(kind, params)
+        ttl = self.config['ttl']
+        record = {
+            'response': response,
+            'expires': time.time() + ttl if ttl is not None else None,
+            'scope': self._scope(kind, params),
+        }
+        vector = None
+        if self.config['semantic'] and text is not None and self.embed is not None:
+            vector = self.embed(text)
+            record['vector'] = vector
+        self.db.put_cf(self.CF, key, json.dumps(record).encode())
+        if vector is not None:
+            with self._lock:
+                if self._index is not None:
+                    self._add(key, vector)
+
+    def _scope(self, kind, params):
+        # Everything but the prompt has to match for a semantic hit
+        return self._digest(kind, {k: v for k, v in params.items() if k not in ('prompt', 'messages')}).hex()
+
+    def _add(self, key, vector):
+        import numpy as np
+        from usearch.index import Index
+        if self._index is None or self._index.ndim != len(vector):
+            # A new embedding model means the old vectors can't be compared
+            self._index = Index(ndim=len(vector), metric='cos', dtype='f32')
+            self._keys = {}
+        vector_id = len(self._keys)
+        self._keys[vector_id] = key
+        self._index.add(vector_id, np.asarray(vector, dtype=np.float32))
+
+    def _build_index(self):
+        self._index = None
+        self._keys = {}
+        for key, value in self.db.iterator(cf_name=self.CF):
+            if key == self.CONFIG_KEY:
+                continue
+            vector = json.loads(value).get('vector')
+            if vector is not None:
+                self._add(key, vector)
+
+    def _semantic_lookup(self, kind, params, text, now):
+        import numpy as np
+        if self.embed is None:
+            return None
+        vector = self.embed(text)
+        if vector is None:
+            return None
+        scope = self._scope(kind, params)
+        with self._lock:
+            if self._index is None:
+                self._build_index()
+            if self._index is None or not len(self._index) or self._index.ndim != len(vector):
+                return None
+            matches = self._index.search(np.asarray(vector, dtype=np.float32), self.semantic_candidates)
+            candidates = [(self._keys[int(key)], float(distance)) for key, distance in zip(matches.keys, matches.distances)]
+        for key, distance in candidates:
+            if 1 - distance < self.config['threshold']:
+                break
+            record = self._load(key, now)
+            if record is not None and record['scope'] == scope:
+                return record
+        return None
+
+    def clear(self, expired_only=False):
+        now = time.time()
+        removed = []
+        for key, value in self.db.iterator(cf_name=self.CF):
+            if key == self.CONFIG_KEY:
+                continue
+            expires = json.loads(value)['expires']
+            if not expired_only or (expires is not None and expires <= now):
+                removed.append(key)
+        if removed:
+            self.db.write_batch([{'type': 'delete', 'cf': self.CF, 'key': key} for key in removed])
+        with self._lock:
+            self._index = None
+            self._keys = {}
+        return len(removed)
+
+    def stats(self):
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            'config': self.config,
+        }
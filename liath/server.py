@@ -1,5 +1,6 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from database import Database
+import queue
 import threading
 from concurrent.futures import ThreadPoolExecutor
 import json
@@ -13,19 +14,67 @@ def create_app(storage_type='auto'):
     app.config['db'] = db
     return app
 
-def execute_query(namespace, query):
+def _serialize_result(result):
+    if isinstance(result, (dict, list)):
+        return json.dumps(result)
+    elif isinstance(result, str):
+        return result
+    else:
+        return json.dumps({"result": str(result)})
+
+def execute_query(namespace, query, session=None):
+    db = app.config['db']
+    try:
+        return _serialize_result(db.execute_query(namespace, query, session=session))
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
+
+def execute_prepared(namespace, name, params, session=None):
     db = app.config['db']
     try:
-        result = db.execute_query(namespace, query)
-        if isinstance(result, (dict, list)):
-            return json.dumps(result)
-        elif isinstance(result, str):
-            return result
-        else:
-            return json.dumps({"result": str(result)})
+        return _serialize_result(db.execute_prepared(namespace, name, params, session=session))
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
 
+def _sse(event, data):
+    # One server-sent event; every line of data needs its own prefix
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split('\n')]
+    return '\n'.join(lines) + '\n\n'
+
+def stream_response(run):
+    # Runs run(emit) on the executor and streams every emitted value as an
+    # SSE 'data' event, then the query result as a 'result' event (or an
+    # 'error' event). A client that disconnects makes the next emit() fail,
+    # which stops the query.
+    events = queue.Queue()
+    disconnected = threading.Event()
+
+    def emit(value):
+        if disconnected.is_set():
+            raise RuntimeError("Client disconnected")
+        events.put((None, json.dumps(value)))
+
+    def task():
+        try:
+            events.put(('result', _serialize_result(run(emit))))
+        except Exception as e:
+            events.put(('error', json.dumps({"status": "error", "message": str(e)})))
+
+    executor.submit(task)
+
+    def generate():
+        try:
+            while True:
+                event, data = events.get()
+                yield _sse(event, data)
+                if event is not None:
+                    return
+        finally:
+            disconnected.set()
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/login', methods=['POST'])
 def login():
     data = request.json
@@ -48,15 +97,51 @@ def create_user():
 @app.route('/query', methods=['POST'])
 def query():
     data = request.json
-    future = executor.submit(execute_query, data['namespace'], data['query'])
+    if data.get('stream'):
+        db = app.config['db']
+        return stream_response(lambda emit: db.execute_query(data['namespace'], data['query'],
+                                                             session=data.get('session'), emit=emit))
+    future = executor.submit(execute_query, data['namespace'], data['query'], data.get('session'))
+    result = future.result()
+    return result, 200, {'Content-Type': 'application/json'}
+
+@app.route('/prepare', methods=['POST'])
+def prepare():
+    data = request.json
+    db = app.config['db']
+    try:
+        db.prepare(data['namespace'], data['name'], data['query'])
+        return jsonify({"status": "success", "message": f"Query {data['name']} prepared"})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+@app.route('/execute', methods=['POST'])
+def execute():
+    data = request.json
+    if data.get('stream'):
+        db = app.config['db']
+        return stream_response(lambda emit: db.execute_prepared(data['namespace'], data['name'], data.get('params'),
+                                                                session=data.get('session'), emit=emit))
+    future = executor.submit(execute_prepared, data['namespace'], data['name'], data.get('params'),
+                             data.get('session'))
     result = future.result()
     return result, 200, {'Content-Type': 'application/json'}
 
+@app.route('/end_session', methods=['POST'])
+def end_session():
+    data = request.json
+    db = app.config['db']
+    db.end_session(data['namespace'], data['session'])
+    return jsonify({"status": "success", "message": f"Session {data['session']} ended"})
+
 @app.route('/create_namespace', methods=['POST'])
 def create_namespace():
     data = request.json
     db = app.config['db']
-    db.create_namespace(data['namespace'])
+    try:
+        db.create_namespace(data['namespace'], codec=data.get('codec'), profile=data.get('profile'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     return jsonify({"status": "success", "message": f"Namespace {data['namespace']} created"})
 
 @app.route('/list_namespaces', methods=['GET'])
@@ -64,6 +149,11 @@ def list_namespaces():
     db = app.config['db']
     return jsonify({"status": "success", "namespaces": db.list_namespaces()})
 
+@app.route('/model_stats', methods=['GET'])
+def model_stats():
+    db = app.config['db']
+    return jsonify({"status": "success", "models": db.model_stats()})
+
 def run_server(host='0.0.0.0', port=5000):
     app.run(host=host, port=port, threaded=True)
 
@@ -0,0 +1,26 @@
+import time
+
+
+class Session:
+    """Per-client state that outlives a single query, such as an open transaction.
+
+    Queries run without a session id get a transient session that is closed
+    as soon as the query finishes.
+    """
+
+    def __init__(self, session_id=None):
+        self.id = session_id
+        self.transaction = None
+        self.last_used = time.monotonic()
+
+    @property
+    def persistent(self):
+        return self.id is not None
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.transaction is not None:
+            self.transaction.rollback()
+            self.transaction = None
@@ -1,6 +1,94 @@
+import functools
+import threading
 from abc import ABC, abstractmethod
 
+
+def prefix_upper_bound(prefix):
+    # Smallest key greater than every key starting with prefix, or None if
+    # the prefix is all 0xff bytes.
+    prefix = bytearray(prefix)
+    while prefix and prefix[-1] == 0xff:
+        prefix.pop()
+    if not prefix:
+        return None
+    prefix[-1] += 1
+    return bytes(prefix)
+
+
+def resolve_bounds(start, stop, prefix):
+    if prefix is None:
+        return start, stop
+    upper = prefix_upper_bound(prefix)
+    start = prefix if start is None else max(start, prefix)
+    if upper is not None:
+        stop = upper if stop is None else min(stop, upper)
+    return start, stop
+
+
+def scan_page(iterator, start=None, stop=None, prefix=None, limit=100, reverse=False, cursor=None, cf_name=None):
+    # Returns one page of (key, value) pairs from iterator (a storage's or a
+    # transaction's) and the cursor for the next page, or None when the
+    # range is exhausted. The cursor is the last key of the page, so
+    # following pages resume right after it.
+    include_start = True
+    if cursor is not None:
+        if reverse:
+            stop = cursor
+        else:
+            start = cursor
+            include_start = False
+
+    items = []
+    next_cursor = None
+    it = iterator(cf_name=cf_name, start=start, stop=stop, prefix=prefix,
+                  reverse=reverse, include_start=include_start)
+    try:
+        for key, value in it:
+            if limit is not None and len(items) >= limit:
+                next_cursor = items[-1][0]
+                break
+            items.append((key, value))
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+    return items, next_cursor
+
+
+def writes(method):
+    # Marks a storage method that changes data. The storage's version is
+    # bumped once the write has been applied, so anything cached against the
+    # old version is stale by the time the new data can be read.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.bump_version()
+    return wrapper
+
+
 class StorageBase(ABC):
+    # Number of writes since the storage was opened
+    version = 0
+    _version_lock = threading.Lock()
+
+    def bump_version(self):
+        # Also called for changes that don't reach the storage, like a
+        # plugin replacing an in-memory index, so cached reads see them
+        with StorageBase._version_lock:
+            self.version += 1
+
+    @classmethod
+    def create_block_cache(cls, capacity):
+        # Backends that can share one block cache across DBs return it here
+        return None
+
+    def transaction(self, detect_conflicts=False):
+        # Imported here: the transaction module uses the range helpers above
+        from .transaction import Transaction
+        return Transaction(self, detect_conflicts=detect_conflicts)
+
     @abstractmethod
     def get(self, key):
         pass
@@ -14,13 +102,34 @@ class StorageBase(ABC):
         pass
 
     @abstractmethod
-    def iterator(self):
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        pass
+
+    def scan(self, start=None, stop=None, prefix=None, limit=100, reverse=False, cursor=None, cf_name=None):
+        return scan_page(self.iterator, start, stop, prefix, limit, reverse, cursor, cf_name)
+
+    @abstractmethod
+    def multi_get(self, keys, cf_name=None):
+        # Returns the values for keys, in the same order, with None for
+        # missing keys.
+        pass
+
+    @abstractmethod
+    def multi_put(self, items, cf_name=None):
+        # Writes an iterable of (key, value) pairs in a single batch.
         pass
 
     @abstractmethod
     def write_batch(self, operations):
         pass
 
+    @abstractmethod
+    def snapshot(self):
+        # Returns a read-only view with get(key, cf_name=None),
+        # multi_get(keys, cf_name=None), iterator(...) taking the same
+        # arguments as StorageBase.iterator, and close().
+        pass
+
     @abstractmethod
     def create_column_family(self, name):
         pass
@@ -45,6 +154,11 @@ class StorageBase(ABC):
     def delete_cf(self, cf_name, key):
         pass
 
+    @abstractmethod
+    def namespace_view(self, name):
+        # Returns a StorageBase for one namespace inside this shared DB
+        pass
+
     @abstractmethod
     def compact_range(self, begin, end):
         pass
@@ -55,4 +169,4 @@ class StorageBase(ABC):
 
     @abstractmethod
     def close(self):
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,142 @@
+import json
+import struct
+from lupa import lua_type
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def lua_to_python(value):
+    # Serializer hook for Lua tables handed over by lupa. Array-like tables
+    # become lists, everything else becomes a dict.
+    if lua_type(value) == 'table':
+        keys = list(value.keys())
+        if keys == list(range(1, len(keys) + 1)):
+            return list(value.values())
+        return dict(value.items())
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class JSONKeyCodec:
+    name = 'json'
+
+    def encode(self, key):
+        return json.dumps(key, default=lua_to_python).encode()
+
+    def decode(self, data):
+        return json.loads(data.decode())
+
+    def encode_prefix(self, prefix):
+        # JSON strings share a prefix only up to their closing quote
+        encoded = self.encode(prefix)
+        return encoded[:-1] if isinstance(prefix, str) else encoded
+
+
+class UTF8KeyCodec:
+    name = 'utf8'
+
+    def encode(self, key):
+        if isinstance(key, bytes):
+            return key
+        if not isinstance(key, str):
+            raise TypeError(f"The utf8 key codec only supports string keys, got {type(key).__name__}")
+        return key.encode()
+
+    def decode(self, data):
+        return data.decode()
+
+    def encode_prefix(self, prefix):
+        return self.encode(prefix)
+
+
+class OrderedKeyCodec:
+    """Type-tagged keys whose byte order matches their natural order.
+
+    Integers sort before floats, which sort before strings. Within each
+    type the encoded keys sort numerically or by code point.
+    """
+
+    name = 'ordered'
+
+    INT = b'\x01'
+    FLOAT = b'\x02'
+    STR = b'\x03'
+
+    def encode(self, key):
+        if isinstance(key, bool):
+            raise TypeError("The ordered key codec does not support boolean keys")
+        if isinstance(key, int):
+            return self.INT + (key + (1 << 63)).to_bytes(8, 'big')
+        if isinstance(key, float):
+            bits = struct.unpack('>Q', struct.pack('>d', key))[0]
+            bits = bits ^ 0xffffffffffffffff if bits >> 63 else bits | (1 << 63)
+            return self.FLOAT + bits.to_bytes(8, 'big')
+        if isinstance(key, bytes):
+            return self.STR + key
+        if isinstance(key, str):
+            return self.STR + key.encode()
+        raise TypeError(f"The ordered key codec does not support {type(key).__name__} keys")
+
+    def decode(self, data):
+        tag, body = data[:1], data[1:]
+        if tag == self.INT:
+            return int.from_bytes(body, 'big') - (1 << 63)
+        if tag == self.FLOAT:
+            bits = int.from_bytes(body, 'big')
+            bits = bits ^ (1 << 63) if bits >> 63 else bits ^ 0xffffffffffffffff
+            return struct.unpack('>d', struct.pack('>Q', bits))[0]
+        if tag == self.STR:
+            return body.decode()
+        raise ValueError(f"Unknown key tag: {tag!r}")
+
+    def encode_prefix(self, prefix):
+        return self.encode(prefix)
+
+
+class JSONValueCodec:
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value, default=lua_to_python).encode()
+
+    def decode(self, data):
+        return json.loads(data.decode())
+
+
+class MsgpackValueCodec:
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("The msgpack value codec requires the 'msgpack' package")
+
+    def encode(self, value):
+        return msgpack.packb(value, default=lua_to_python, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+KEY_CODECS = {
+    'json': JSONKeyCodec,
+    'utf8': UTF8KeyCodec,
+    'ordered': OrderedKeyCodec,
+}
+
+VALUE_CODECS = {
+    'json': JSONValueCodec,
+    'msgpack': MsgpackValueCodec,
+}
+
+DEFAULT_CODEC = {'key': 'json', 'value': 'json'}
+
+
+def get_codecs(config=None):
+    config = dict(DEFAULT_CODEC, **(config or {}))
+    if config['key'] not in KEY_CODECS:
+        raise ValueError(f"Unknown key codec '{config['key']}'. Choose from {list(KEY_CODECS)}")
+    if config['value'] not in VALUE_CODECS:
+        raise ValueError(f"Unknown value codec '{config['value']}'. Choose from {list(VALUE_CODECS)}")
+    return KEY_CODECS[config['key']](), VALUE_CODECS[config['value']]()
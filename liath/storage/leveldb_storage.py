@@ -1,42 +1,185 @@
 import plyvel
-from .base import StorageBase
+import threading
+from .base import StorageBase, prefix_upper_bound, resolve_bounds, writes
+
+def _strip_prefix(it, size):
+    try:
+        for key, value in it:
+            yield key[size:], value
+    finally:
+        it.close()
+
+
+class LevelDBSnapshot:
+    def __init__(self, storage):
+        self.storage = storage
+        self.snapshot = storage.db.snapshot()
+
+    def get(self, key, cf_name=None):
+        return self.snapshot.get(self.storage._cf_prefix(cf_name) + key)
+
+    def multi_get(self, keys, cf_name=None):
+        prefix = self.storage._cf_prefix(cf_name)
+        return [self.snapshot.get(prefix + key) for key in keys]
+
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        start, stop = resolve_bounds(start, stop, prefix)
+        if cf_name is None:
+            it = self.snapshot.iterator(start=start, stop=stop, reverse=reverse, include_start=include_start)
+            if self.storage.column_families:
+                return self.storage._skip_column_families(it, reverse)
+            return it
+        # One snapshot covers every column family, so their prefixes are
+        # applied and stripped by hand
+        cf_prefix = self.storage._cf_prefix(cf_name)
+        it = self.snapshot.iterator(
+            start=cf_prefix + (start or b''),
+            stop=cf_prefix + stop if stop is not None else prefix_upper_bound(cf_prefix),
+            reverse=reverse,
+            include_start=include_start or start is None,
+        )
+        return _strip_prefix(it, len(cf_prefix))
+
+    def close(self):
+        self.snapshot.close()
 
 class LevelDBStorage(StorageBase):
+    # Column family names are recorded under this prefix so they survive a
+    # reopen. Default keyspace scans skip it like a column family's range.
+    CF_NAMES_PREFIX = b'\x00cf\x00'
+    # Column family keys live under CF_KEYS_PREFIX + name + b'\x00', which
+    # utf8 or ordered default keys can't collide with unless they start
+    # with a NUL byte. Families recorded without a prefix predate it and
+    # keep the bare 'name:' layout.
+    CF_KEYS_PREFIX = b'\x00cf\x01'
+
     def __init__(self, path, options=None):
-        self.db = plyvel.DB(path, create_if_missing=True)
-        self.column_families = {}
+        # LevelDB can't share a block cache between DBs, so each one gets
+        # the profile's leveldb_cache_size instead.
+        profile = options or {}
+        self.db = plyvel.DB(
+            path,
+            create_if_missing=True,
+            write_buffer_size=profile.get('write_buffer_size'),
+            max_open_files=profile.get('max_open_files'),
+            block_size=profile.get('block_size'),
+            lru_cache_size=profile.get('leveldb_cache_size'),
+            bloom_filter_bits=profile.get('bloom_bits', 0),
+            compression=None if profile.get('compression') == 'none' else 'snappy',
+        )
+        self._load_column_families()
+        self.commit_lock = threading.Lock()
+
+    def _load_column_families(self):
+        self._cf_prefixes = {}
+        for key, prefix in self.db.iterator(prefix=self.CF_NAMES_PREFIX):
+            name = key[len(self.CF_NAMES_PREFIX):]
+            self._cf_prefixes[name.decode()] = prefix or name + b':'
+        self.column_families = {name: self.db.prefixed_db(prefix) for name, prefix in self._cf_prefixes.items()}
 
     def get(self, key):
         return self.db.get(key)
 
+    @writes
     def put(self, key, value):
         return self.db.put(key, value)
 
+    @writes
     def delete(self, key):
         return self.db.delete(key)
 
-    def iterator(self):
-        return self.db.iterator()
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        # plyvel refuses prefix together with start/stop, so fold it into the bounds
+        start, stop = resolve_bounds(start, stop, prefix)
+        it = self._keyspace(cf_name).iterator(start=start, stop=stop, reverse=reverse,
+                                              include_start=include_start)
+        if cf_name is None and self.column_families:
+            return self._skip_column_families(it, reverse)
+        return it
 
+    def _skip_column_families(self, it, reverse):
+        # Column families live in the same keyspace under their own
+        # prefixes. Seeks past their ranges so default keyspace scans only
+        # see default keys.
+        prefixes = list(self._cf_prefixes.values()) + [self.CF_NAMES_PREFIX]
+        try:
+            for key, value in it:
+                prefix = next((p for p in prefixes if key.startswith(p)), None)
+                if prefix is None:
+                    yield key, value
+                elif reverse:
+                    it.seek(prefix)
+                else:
+                    it.seek(prefix_upper_bound(prefix))
+        finally:
+            it.close()
+
+    def _keyspace(self, cf_name):
+        if cf_name is None:
+            return self.db
+        if cf_name in self.column_families:
+            return self.column_families[cf_name]
+        raise ValueError(f"Column family '{cf_name}' not found")
+
+    def multi_get(self, keys, cf_name=None):
+        # LevelDB has no native multi-get. Reading from one snapshot in key
+        # order keeps the result consistent and walks the table blocks
+        # sequentially.
+        keys = list(keys)
+        snapshot = self._keyspace(cf_name).snapshot()
+        try:
+            found = {key: snapshot.get(key) for key in sorted(set(keys))}
+        finally:
+            snapshot.close()
+        return [found[key] for key in keys]
+
+    @writes
+    def multi_put(self, items, cf_name=None):
+        with self._keyspace(cf_name).write_batch() as batch:
+            for key, value in items:
+                batch.put(key, value)
+
+    @writes
     def write_batch(self, operations):
+        # Column family operations go through the same batch with the
+        # family prefix applied by hand, so the whole batch stays atomic.
         with self.db.write_batch() as batch:
             for op in operations:
+                key = self._cf_prefix(op.get('cf')) + op['key']
                 if op['type'] == 'put':
-                    batch.put(op['key'], op['value'])
+                    batch.put(key, op['value'])
                 elif op['type'] == 'delete':
-                    batch.delete(op['key'])
+                    batch.delete(key)
+
+    def _cf_prefix(self, cf_name):
+        if cf_name is None:
+            return b''
+        if cf_name in self._cf_prefixes:
+            return self._cf_prefixes[cf_name]
+        raise ValueError(f"Column family '{cf_name}' not found")
+
+    def snapshot(self):
+        return LevelDBSnapshot(self)
 
     def create_column_family(self, name):
-        self.column_families[name] = self.db.prefixed_db(name.encode() + b':')
+        if name in self.column_families:
+            return
+        prefix = self.CF_KEYS_PREFIX + name.encode() + b'\x00'
+        self.db.put(self.CF_NAMES_PREFIX + name.encode(), prefix)
+        self._cf_prefixes[name] = prefix
+        self.column_families[name] = self.db.prefixed_db(prefix)
 
+    @writes
     def drop_column_family(self, name):
         if name in self.column_families:
             # LevelDB doesn't have built-in column families, so we need to manually delete all keys
-            prefix = name.encode() + b':'
+            prefix = self._cf_prefixes[name]
             with self.db.write_batch() as batch:
                 for key, _ in self.db.iterator(prefix=prefix):
                     batch.delete(key)
+                batch.delete(self.CF_NAMES_PREFIX + name.encode())
             del self.column_families[name]
+            del self._cf_prefixes[name]
 
     def list_column_families(self):
         return list(self.column_families.keys())
@@ -46,11 +189,13 @@ class LevelDBStorage(StorageBase):
             return self.column_families[cf_name].get(key)
         raise ValueError(f"Column family '{cf_name}' not found")
 
+    @writes
     def put_cf(self, cf_name, key, value):
         if cf_name in self.column_families:
             return self.column_families[cf_name].put(key, value)
         raise ValueError(f"Column family '{cf_name}' not found")
 
+    @writes
     def delete_cf(self, cf_name, key):
         if cf_name in self.column_families:
             return self.column_families[cf_name].delete(key)
@@ -64,5 +209,21 @@ class LevelDBStorage(StorageBase):
         # LevelDB doesn't have a direct flush method
         pass
 
+    def namespace_view(self, name):
+        return LevelDBNamespaceView(self, name)
+
+    def close(self):
+        self.db.close()
+
+class LevelDBNamespaceView(LevelDBStorage):
+    # A namespace inside a shared LevelDB, stored under its own key prefix.
+    # Column families of the namespace nest inside that prefix.
+    def __init__(self, parent, namespace):
+        self.parent = parent
+        self.db = parent.db.prefixed_db(b'ns\x00' + namespace.encode() + b'\x00')
+        self._load_column_families()
+        self.commit_lock = parent.commit_lock
+
     def close(self):
-        self.db.close()
\ No newline at end of file
+        # The shared DB is closed by its owner
+        pass
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import yaml
+
+MB = 1024 ** 2
+
+# Backend-neutral tuning knobs. RocksDB honours all of them; LevelDB maps
+# what it can (write buffer, block size, bloom filter, snappy compression,
+# per-DB cache) and ignores the rest.
+STORAGE_PROFILES = {
+    'default': {
+        'max_open_files': 300000,
+        'write_buffer_size': 64 * MB,
+        'max_write_buffer_number': 3,
+        'target_file_size_base': 64 * MB,
+        'block_size': 4096,
+        'bloom_bits': 10,
+        'compression': 'lz4',
+        'compaction_style': 'level',
+        'leveldb_cache_size': 8 * MB,
+    },
+    'read_heavy': {
+        'write_buffer_size': 32 * MB,
+        'max_write_buffer_number': 2,
+        'block_size': 16384,
+        'bloom_bits': 16,
+        'leveldb_cache_size': 32 * MB,
+    },
+    'write_heavy': {
+        'write_buffer_size': 256 * MB,
+        'max_write_buffer_number': 6,
+        'target_file_size_base': 256 * MB,
+        'compaction_style': 'universal',
+        'bloom_bits': 8,
+    },
+    # Point lookups and multi-gets of small payloads keyed by vector id
+    'vector_metadata': {
+        'write_buffer_size': 32 * MB,
+        'block_size': 4096,
+        'bloom_bits': 12,
+        'compression': 'snappy',
+    },
+}
+
+PROFILES_FILE = 'storage_profiles.yaml'
+
+
+def load_profiles(data_dir, overrides=None):
+    # Built-in profiles, then data_dir/storage_profiles.yaml, then overrides.
+    # Every profile inherits whatever it doesn't set from 'default'.
+    profiles = {name: dict(profile) for name, profile in STORAGE_PROFILES.items()}
+    path = os.path.join(data_dir, PROFILES_FILE)
+    configured = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            configured = yaml.safe_load(f) or {}
+    for source in (configured, overrides or {}):
+        for name, profile in source.items():
+            profiles.setdefault(name, {}).update(profile)
+    base = profiles['default']
+    return {name: dict(base, **profile) for name, profile in profiles.items()}
+
+
+def resolve_profile(profiles, name):
+    name = name or 'default'
+    if name not in profiles:
+        raise ValueError(f"Unknown storage profile '{name}'. Choose from {sorted(profiles)}")
+    return dict(profiles[name])
@@ -3,53 +3,181 @@ try:
 except:
     print("Please install the 'rocksdb' package")
     
-from .base import StorageBase
+import threading
+from .base import StorageBase, resolve_bounds, writes
+
+class RocksDBSnapshot:
+    def __init__(self, storage):
+        self.storage = storage
+        self.snapshot = storage.db.snapshot()
+
+    def get(self, key, cf_name=None):
+        return self.storage.db.get(key, snapshot=self.snapshot, **self.storage._cf_kwargs(cf_name))
+
+    def multi_get(self, keys, cf_name=None):
+        keys = list(keys)
+        values = self.storage.db.multi_get(keys, snapshot=self.snapshot, **self.storage._cf_kwargs(cf_name))
+        return [values.get(key) for key in keys]
+
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        start, stop = resolve_bounds(start, stop, prefix)
+        it = self.storage.db.iteritems(snapshot=self.snapshot, **self.storage._cf_kwargs(cf_name))
+        if reverse:
+            return self.storage._iterate_reverse(it, start, stop, include_start)
+        return self.storage._iterate_forward(it, start, stop, include_start)
+
+    def close(self):
+        # Released by RocksDB once the last reference goes away
+        self.snapshot = None
 
 class RocksDBStorage(StorageBase):
+    COMPRESSION = {
+        'none': 'no_compression',
+        'snappy': 'snappy_compression',
+        'lz4': 'lz4_compression',
+        'zstd': 'zstd_compression',
+    }
+
     def __init__(self, path, options=None):
-        if options is None:
-            opts = rocksdb.Options()
-            opts.create_if_missing = True
-            opts.max_open_files = 300000
-            opts.write_buffer_size = 67108864
-            opts.max_write_buffer_number = 3
-            opts.target_file_size_base = 67108864
-
-            opts.table_factory = rocksdb.BlockBasedTableFactory(
-                filter_policy=rocksdb.BloomFilterPolicy(10),
-                block_cache=rocksdb.LRUCache(2 * (1024 ** 3)),
-                block_cache_compressed=rocksdb.LRUCache(500 * (1024 ** 2)))
-
-            opts.compression = rocksdb.CompressionType.lz4_compression
-            opts.compaction_style = rocksdb.CompactionStyle.level
-        self.db = rocksdb.DB(path, options)
-        self.column_families = {}
+        # options is a resolved storage profile (see storage/profiles.py).
+        # Its 'block_cache' entry is shared between every DB the Database
+        # opens, so the cache budget is global rather than per namespace.
+        self.profile = options or {}
+        opts = self._build_options(self.profile)
+        # Column families created in earlier runs have to be opened with the
+        # DB. They get the profile's tuning and block cache like the default one.
+        existing = [name for name in self._existing_column_families(path, opts) if name != b'default']
+        cf_opts = {name: self._build_cf_options(self.profile) for name in existing}
+        self.db = rocksdb.DB(path, opts, column_families=cf_opts) if cf_opts else rocksdb.DB(path, opts)
+        self.column_families = {name.decode(): self.db.get_column_family(name) for name in existing}
+        self.commit_lock = threading.Lock()
+
+    @staticmethod
+    def _existing_column_families(path, opts):
+        try:
+            return rocksdb.list_column_families(path, opts)
+        except Exception:
+            # No DB at this path yet
+            return []
+
+    @classmethod
+    def create_block_cache(cls, capacity):
+        return rocksdb.LRUCache(capacity)
+
+    @classmethod
+    def _build_options(cls, profile):
+        opts = rocksdb.Options()
+        opts.create_if_missing = True
+        opts.max_open_files = profile.get('max_open_files', 300000)
+        return cls._apply_cf_options(opts, profile)
+
+    @classmethod
+    def _build_cf_options(cls, profile):
+        return cls._apply_cf_options(rocksdb.ColumnFamilyOptions(), profile)
+
+    @classmethod
+    def _apply_cf_options(cls, opts, profile):
+        # The per-column-family part of a profile, shared by the DB options
+        # (which also configure the default column family) and every other
+        # column family
+        opts.write_buffer_size = profile.get('write_buffer_size', 67108864)
+        opts.max_write_buffer_number = profile.get('max_write_buffer_number', 3)
+        opts.target_file_size_base = profile.get('target_file_size_base', 67108864)
+
+        table_options = {
+            'filter_policy': rocksdb.BloomFilterPolicy(profile.get('bloom_bits', 10)),
+            'block_size': profile.get('block_size', 4096),
+        }
+        if profile.get('block_cache') is not None:
+            table_options['block_cache'] = profile['block_cache']
+        opts.table_factory = rocksdb.BlockBasedTableFactory(**table_options)
+
+        compression = cls.COMPRESSION[profile.get('compression', 'lz4')]
+        opts.compression = getattr(rocksdb.CompressionType, compression)
+        opts.compaction_style = getattr(rocksdb.CompactionStyle, profile.get('compaction_style', 'level'))
+        return opts
 
     def get(self, key):
-        return self.db.get(key)
+        return self.db.get(key, **self._cf_kwargs(None))
 
+    @writes
     def put(self, key, value):
-        return self.db.put(key, value)
+        return self.db.put(key, value, **self._cf_kwargs(None))
 
+    @writes
     def delete(self, key):
-        return self.db.delete(key)
+        return self.db.delete(key, **self._cf_kwargs(None))
+
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        start, stop = resolve_bounds(start, stop, prefix)
+        it = self.db.iteritems(**self._cf_kwargs(cf_name))
+        if reverse:
+            return self._iterate_reverse(it, start, stop, include_start)
+        return self._iterate_forward(it, start, stop, include_start)
+
+    def _iterate_forward(self, it, start, stop, include_start):
+        if start is None:
+            it.seek_to_first()
+        else:
+            it.seek(start)
+        for key, value in it:
+            if key == start and not include_start:
+                continue
+            if stop is not None and key >= stop:
+                break
+            yield key, value
+
+    def _iterate_reverse(self, it, start, stop, include_start):
+        if stop is None:
+            it.seek_to_last()
+        else:
+            it.seek_for_prev(stop)
+        for key, value in reversed(it):
+            if stop is not None and key >= stop:
+                continue
+            if start is not None and (key < start or (key == start and not include_start)):
+                break
+            yield key, value
+
+    def _cf_kwargs(self, cf_name):
+        if cf_name is None:
+            return {}
+        if cf_name in self.column_families:
+            return {'column_family': self.column_families[cf_name]}
+        raise ValueError(f"Column family '{cf_name}' not found")
 
-    def iterator(self):
-        return self.db.iteritems()
+    def multi_get(self, keys, cf_name=None):
+        keys = list(keys)
+        values = self.db.multi_get(keys, **self._cf_kwargs(cf_name))
+        return [values.get(key) for key in keys]
 
+    @writes
+    def multi_put(self, items, cf_name=None):
+        cf_kwargs = self._cf_kwargs(cf_name)
+        batch = rocksdb.WriteBatch()
+        for key, value in items:
+            batch.put(key, value, **cf_kwargs)
+        return self.db.write(batch)
+
+    @writes
     def write_batch(self, operations):
         batch = rocksdb.WriteBatch()
         for op in operations:
+            cf_kwargs = self._cf_kwargs(op.get('cf'))
             if op['type'] == 'put':
-                batch.put(op['key'], op['value'])
+                batch.put(op['key'], op['value'], **cf_kwargs)
             elif op['type'] == 'delete':
-                batch.delete(op['key'])
+                batch.delete(op['key'], **cf_kwargs)
         return self.db.write(batch)
 
+    def snapshot(self):
+        return RocksDBSnapshot(self)
+
     def create_column_family(self, name):
-        cf_opts = rocksdb.ColumnFamilyOptions()
+        cf_opts = self._build_cf_options(self.profile)
         self.column_families[name] = self.db.create_column_family(cf_opts, name)
 
+    @writes
     def drop_column_family(self, name):
         if name in self.column_families:
             self.db.drop_column_family(self.column_families[name])
@@ -63,11 +191,13 @@ class RocksDBStorage(StorageBase):
             return self.db.get(key, column_family=self.column_families[cf_name])
         raise ValueError(f"Column family '{cf_name}' not found")
 
+    @writes
     def put_cf(self, cf_name, key, value):
         if cf_name in self.column_families:
             return self.db.put(key, value, column_family=self.column_families[cf_name])
         raise ValueError(f"Column family '{cf_name}' not found")
 
+    @writes
     def delete_cf(self, cf_name, key):
         if cf_name in self.column_families:
             return self.db.delete(key, column_family=self.column_families[cf_name])
@@ -79,5 +209,51 @@ class RocksDBStorage(StorageBase):
     def flush(self):
         return self.db.flush()
 
+    def namespace_view(self, name):
+        return RocksDBNamespaceView(self, name)
+
+    def close(self):
+        del self.db
+
+class RocksDBNamespaceView(RocksDBStorage):
+    # A namespace inside a shared RocksDB. Its default keyspace is the column
+    # family 'ns/<name>' and its own column families are 'ns/<name>/<cf>'.
+    def __init__(self, parent, namespace):
+        self.parent = parent
+        self.db = parent.db
+        self.profile = parent.profile
+        self.prefix = f"ns/{namespace}"
+        self.commit_lock = parent.commit_lock
+        self.default_cf = self._physical_cf(self.prefix)
+        self.column_families = {
+            name[len(self.prefix) + 1:]: handle
+            for name, handle in parent.column_families.items()
+            if name.startswith(self.prefix + '/')
+        }
+
+    def _physical_cf(self, name):
+        with self.parent.commit_lock:
+            if name not in self.parent.column_families:
+                self.parent.create_column_family(name)
+            return self.parent.column_families[name]
+
+    def _cf_kwargs(self, cf_name):
+        if cf_name is None:
+            return {'column_family': self.default_cf}
+        return super()._cf_kwargs(cf_name)
+
+    def create_column_family(self, name):
+        self.column_families[name] = self._physical_cf(f"{self.prefix}/{name}")
+
+    @writes
+    def drop_column_family(self, name):
+        if name in self.column_families:
+            self.parent.drop_column_family(f"{self.prefix}/{name}")
+            del self.column_families[name]
+
+    def compact_range(self, begin, end):
+        return self.db.compact_range(begin, end, column_family=self.default_cf)
+
     def close(self):
-        del self.db
\ No newline at end of file
+        # The shared DB is closed by its owner
+        self.db = None
\ No newline at end of file
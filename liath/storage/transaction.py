@@ -0,0 +1,173 @@
+import threading
+from collections import OrderedDict
+from .base import resolve_bounds, scan_page
+
+_DELETED = object()
+
+
+class TransactionConflict(Exception):
+    pass
+
+
+class Transaction:
+    """A buffered transaction over a storage backend.
+
+    Reads come from a snapshot taken when the transaction begins, overlaid
+    with the transaction's own pending writes. Writes are buffered and
+    applied atomically as a single write batch on commit. With
+    detect_conflicts, commit fails if any key the transaction read or wrote
+    was changed by someone else after the snapshot was taken.
+    """
+
+    def __init__(self, storage, detect_conflicts=False):
+        self.storage = storage
+        self.detect_conflicts = detect_conflicts
+        self.snapshot = storage.snapshot()
+        self.writes = OrderedDict()
+        self.reads = {}
+        self.active = True
+        self._lock = threading.Lock()
+
+    def _check_active(self):
+        if not self.active:
+            raise RuntimeError("Transaction is no longer active")
+
+    def get(self, key, cf_name=None):
+        with self._lock:
+            self._check_active()
+            pending = self.writes.get((cf_name, key))
+            if pending is not None:
+                return None if pending is _DELETED else pending
+            value = self.snapshot.get(key, cf_name)
+            if self.detect_conflicts:
+                self.reads.setdefault((cf_name, key), value)
+            return value
+
+    def multi_get(self, keys, cf_name=None):
+        keys = list(keys)
+        with self._lock:
+            self._check_active()
+            missing = [key for key in keys if (cf_name, key) not in self.writes]
+            found = dict(zip(missing, self.snapshot.multi_get(missing, cf_name)))
+            if self.detect_conflicts:
+                for key, value in found.items():
+                    self.reads.setdefault((cf_name, key), value)
+            values = []
+            for key in keys:
+                pending = self.writes.get((cf_name, key))
+                if pending is None:
+                    values.append(found[key])
+                else:
+                    values.append(None if pending is _DELETED else pending)
+            return values
+
+    def iterator(self, cf_name=None, start=None, stop=None, prefix=None, reverse=False, include_start=True):
+        # Range reads see the snapshot with the transaction's pending writes
+        # merged in. Keys read this way aren't tracked for conflicts.
+        with self._lock:
+            self._check_active()
+            low, high = resolve_bounds(start, stop, prefix)
+            pending = sorted(
+                ((key, value) for (cf, key), value in self.writes.items()
+                 if cf == cf_name
+                 and (low is None or key > low or (key == low and include_start))
+                 and (high is None or key < high)),
+                key=lambda item: item[0],
+                reverse=reverse,
+            )
+            it = self.snapshot.iterator(cf_name=cf_name, start=start, stop=stop, prefix=prefix,
+                                        reverse=reverse, include_start=include_start)
+        return self._merge(it, pending, reverse)
+
+    @staticmethod
+    def _merge(it, pending, reverse):
+        def before(a, b):
+            return a > b if reverse else a < b
+
+        i = 0
+        try:
+            for key, value in it:
+                while i < len(pending) and before(pending[i][0], key):
+                    if pending[i][1] is not _DELETED:
+                        yield pending[i]
+                    i += 1
+                if i < len(pending) and pending[i][0] == key:
+                    # Our own write replaces the snapshot's entry
+                    if pending[i][1] is not _DELETED:
+                        yield pending[i]
+                    i += 1
+                    continue
+                yield key, value
+            for key, value in pending[i:]:
+                if value is not _DELETED:
+                    yield key, value
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    def scan(self, start=None, stop=None, prefix=None, limit=100, reverse=False, cursor=None, cf_name=None):
+        return scan_page(self.iterator, start, stop, prefix, limit, reverse, cursor, cf_name)
+
+    def put(self, key, value, cf_name=None):
+        with self._lock:
+            self._check_active()
+            self.writes[(cf_name, key)] = value
+
+    def delete(self, key, cf_name=None):
+        with self._lock:
+            self._check_active()
+            self.writes[(cf_name, key)] = _DELETED
+
+    def multi_put(self, items, cf_name=None):
+        for key, value in items:
+            self.put(key, value, cf_name)
+
+    def write_batch(self, operations):
+        for op in operations:
+            if op['type'] == 'put':
+                self.put(op['key'], op['value'], op.get('cf'))
+            elif op['type'] == 'delete':
+                self.delete(op['key'], op.get('cf'))
+
+    def _conflicts(self):
+        # Any key we read or are about to overwrite must still hold the value
+        # it had in our snapshot.
+        expected = dict(self.reads)
+        for cf_name, key in self.writes:
+            if (cf_name, key) not in expected:
+                expected[(cf_name, key)] = self.snapshot.get(key, cf_name)
+        for (cf_name, key), value in expected.items():
+            current = self.storage.get(key) if cf_name is None else self.storage.get_cf(cf_name, key)
+            if current != value:
+                yield cf_name, key
+
+    def commit(self):
+        with self._lock:
+            self._check_active()
+            operations = [
+                {'type': 'delete', 'key': key, 'cf': cf_name} if value is _DELETED
+                else {'type': 'put', 'key': key, 'value': value, 'cf': cf_name}
+                for (cf_name, key), value in self.writes.items()
+            ]
+            try:
+                with self.storage.commit_lock:
+                    if self.detect_conflicts:
+                        conflict = next(self._conflicts(), None)
+                        if conflict is not None:
+                            raise TransactionConflict(f"Key {conflict[1]!r} was modified by another writer")
+                    if operations:
+                        self.storage.write_batch(operations)
+            finally:
+                self._close()
+
+    def rollback(self):
+        with self._lock:
+            if self.active:
+                self._close()
+
+    def _close(self):
+        self.active = False
+        self.writes.clear()
+        self.reads.clear()
+        self.snapshot.close()
@@ -1,5 +1,7 @@
 import unittest
+import importlib.util
 import json
+import time
 from database import Database
 from storage.rocksdb_storage import RocksDBStorage
 from storage.leveldb_storage import LevelDBStorage
@@ -14,12 +16,22 @@ class TestLiathDatabase(unittest.TestCase):
 
     def tearDown(self):
         # Clean up test data
+        self.db.close()
         import shutil
         shutil.rmtree('./test_data')
 
     def execute_query(self, query):
         result = self.db.execute_query('test_namespace', query)
-        return json.loads(result) if isinstance(result, str) else result
+        return self._decode(result)
+
+    def _decode(self, result):
+        # Plugins return JSON strings; plain string values come back as-is
+        if isinstance(result, str):
+            try:
+                return json.loads(result)
+            except ValueError:
+                return result
+        return result
 
     def test_basic_operations(self):
         # Test put and get
@@ -50,6 +62,49 @@ class TestLiathDatabase(unittest.TestCase):
         result3 = self.execute_query("return db:get('tx_key3')")
         self.assertIsNone(result3)
 
+    def test_session_transactions(self):
+        def run(query):
+            return self._decode(self.db.execute_query('test_namespace', query, session='s1'))
+
+        run("db_begin_transaction()")
+        run("db_put('tx_key1', 'tx_value1')")
+        self.assertEqual(run("return db_get('tx_key1')"), 'tx_value1')
+        self.assertIsNone(self.execute_query("return db_get('tx_key1')"))
+        run("db_commit_transaction()")
+        self.assertEqual(self.execute_query("return db_get('tx_key1')"), 'tx_value1')
+
+        run("db_begin_transaction()")
+        run("db_put('tx_key2', 'tx_value2')")
+        run("db_rollback_transaction()")
+        self.assertIsNone(self.execute_query("return db_get('tx_key2')"))
+
+    def test_transaction_range_reads(self):
+        def run(query):
+            return self._decode(self.db.execute_query('test_namespace', query, session='s1'))
+
+        self.execute_query("db_put('s:1', 1); db_put('s:3', 3)")
+        run("db_begin_transaction()")
+        run("db_put('s:2', 2); db_delete('s:3')")
+        # Written outside the transaction, after its snapshot
+        self.execute_query("db_put('s:4', 4)")
+
+        page = run("return db_scan{prefix='s:'}")
+        self.assertEqual([item['key'] for item in page['items']], ['s:1', 's:2'])
+        page = run("return db_scan{prefix='s:', reverse=true, limit=1}")
+        self.assertEqual([item['key'] for item in page['items']], ['s:2'])
+        keys = run("local keys = {} for k in db_iter{prefix='s:'} do keys[#keys + 1] = k end return keys")
+        self.assertEqual(keys, ['s:1', 's:2'])
+        run("db_rollback_transaction()")
+
+    def test_transaction_conflict(self):
+        self.execute_query("db_put('counter', 1)")
+        self.db.execute_query('test_namespace', "db_begin_transaction{detect_conflicts=true}", session='s1')
+        self.db.execute_query('test_namespace', "db_put('counter', db_get('counter') + 1)", session='s1')
+        self.execute_query("db_put('counter', 10)")
+        result = json.loads(self.db.execute_query('test_namespace', "return db_commit_transaction()", session='s1'))
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(self.execute_query("return db_get('counter')"), 10)
+
     def test_column_families(self):
         self.execute_query("db:create_column_family('cf1')")
         self.execute_query("db:put_cf('cf1', 'cf_key1', 'cf_value1')")
@@ -79,6 +134,101 @@ class TestLiathDatabase(unittest.TestCase):
         self.assertIn({'iter_key2': 'iter_value2'}, iterator_result)
         self.assertIn({'iter_key3': 'iter_value3'}, iterator_result)
 
+    def test_scan(self):
+        for i in range(5):
+            self.execute_query(f"db_put('user:{i}', 'value{i}')")
+        self.execute_query("db_put('other', 'x')")
+
+        page = self.execute_query("return db_scan{prefix='user:', limit=3}")
+        self.assertEqual([item['key'] for item in page['items']], ['user:0', 'user:1', 'user:2'])
+        self.assertIsNotNone(page['cursor'])
+
+        page = self.execute_query(f"return db_scan{{prefix='user:', limit=3, cursor='{page['cursor']}'}}")
+        self.assertEqual([item['key'] for item in page['items']], ['user:3', 'user:4'])
+        self.assertIsNone(page['cursor'])
+
+        page = self.execute_query("return db_scan{prefix='user:', limit=2, reverse=true}")
+        self.assertEqual([item['key'] for item in page['items']], ['user:4', 'user:3'])
+
+    def test_lazy_iterator(self):
+        for i in range(5):
+            self.execute_query(f"db_put('n:{i}', {i})")
+
+        result = self.execute_query("""
+            local count, total = 0, 0
+            for k, v in db_iter{prefix='n:'} do
+                count = count + 1
+                total = total + v
+            end
+            return {count = count, total = total}
+        """)
+        self.assertEqual(result, {'count': 5, 'total': 10})
+
+        result = self.execute_query("""
+            for k, v in db_iter{prefix='n:', reverse=true} do
+                return k
+            end
+        """)
+        self.assertEqual(result, 'n:4')
+
+    def test_multi_get_put(self):
+        self.execute_query("db_multi_put({a = 1, b = 2, c = {x = 3}})")
+        result = self.execute_query("return db_multi_get({'a', 'c', 'missing'})")
+        self.assertEqual(result, {'a': 1, 'c': {'x': 3}, 'missing': None})
+
+    def test_codec_migration(self):
+        self.execute_query("db_put('user:2', {name = 'b'})")
+        self.execute_query("db_put('user:10', {name = 'a'})")
+
+        stats = self.db.migrate_codec('test_namespace', key_codec='ordered', value_codec='msgpack')
+        self.assertEqual(stats['migrated'], 2)
+        self.assertEqual(self.db.namespaces['test_namespace']['codec'], {'key': 'ordered', 'value': 'msgpack'})
+
+        result = self.execute_query("return db_get('user:10')")
+        self.assertEqual(result, {'name': 'a'})
+        page = self.execute_query("return db_scan{prefix='user:'}")
+        self.assertEqual([item['key'] for item in page['items']], ['user:10', 'user:2'])
+
+    def test_codec_migration_with_column_families(self):
+        # LevelDB keeps column families under prefixes of the default
+        # keyspace; migrating default keys must leave them alone
+        self.db.create_namespace('utf8_ns', codec={'key': 'utf8'})
+        self.db.execute_query('utf8_ns', "db_put('a', 1); db_create_column_family('mycf'); db_put_cf('mycf', 'k', 2)")
+
+        stats = self.db.migrate_codec('utf8_ns', key_codec='ordered')
+        self.assertEqual(stats, {'migrated': 2, 'skipped': 0})
+        self.assertEqual(self.db.execute_query('utf8_ns', "return db_get_cf('mycf', 'k')"), 2)
+        page = self._decode(self.db.execute_query('utf8_ns', "return db_scan{}"))
+        self.assertEqual([item['key'] for item in page['items']], ['a'])
+
+    def test_column_family_keyspace(self):
+        # utf8 default keys that look like a column family's keys stay apart
+        self.db.create_namespace('cf_ns', codec={'key': 'utf8'})
+        self.db.execute_query('cf_ns', """
+            db_create_column_family('user')
+            db_put_cf('user', 'x', 'cf value')
+            db_put('user:x', 'default value')
+        """)
+        self.assertEqual(self.db.execute_query('cf_ns', "return db_get_cf('user', 'x')"), 'cf value')
+        page = self._decode(self.db.execute_query('cf_ns', "return db_scan{prefix = 'user:'}"))
+        self.assertEqual([item['key'] for item in page['items']], ['user:x'])
+        stats = self.db.migrate_codec('cf_ns', key_codec='ordered')
+        self.assertEqual(stats, {'migrated': 2, 'skipped': 0})
+        self.assertEqual(self.db.execute_query('cf_ns', "return db_get('user:x')"), 'default value')
+
+        # Families created with the older bare 'name:' layout still open
+        path = os.path.join('./test_data', 'legacy_cf')
+        storage = LevelDBStorage(path)
+        storage.db.put(LevelDBStorage.CF_NAMES_PREFIX + b'old', b'')
+        storage.db.put(b'old:k', b'v')
+        storage.close()
+        storage = LevelDBStorage(path)
+        try:
+            self.assertEqual(storage.get_cf('old', b'k'), b'v')
+            self.assertEqual(list(storage.iterator()), [])
+        finally:
+            storage.close()
+
     def test_write_batch(self):
         batch_ops = [
             {"type": "put", "key": "batch_key1", "value": "batch_value1"},
@@ -92,6 +242,600 @@ class TestLiathDatabase(unittest.TestCase):
         self.assertIsNone(result1)
         self.assertEqual(result2, 'batch_value2')
 
+    def test_globals_reset_between_queries(self):
+        self.execute_query("leaked_global = 42")
+        result = self.execute_query("return leaked_global")
+        self.assertIsNone(result)
+
+        # Standard library tables are restored too
+        self.execute_query("string.leak = 'x'; math.pi = 3; getmetatable('').__index = {}")
+        result = self.execute_query("return {string.leak == nil, math.pi > 3, ('x'):upper()}")
+        self.assertEqual(result, [True, True, 'X'])
+
+        # So are debug hooks and a stopped garbage collector
+        self.execute_query("debug.sethook(function() end, 'l'); collectgarbage('stop')")
+        result = self.execute_query("return {debug.gethook() == nil, collectgarbage('isrunning')}")
+        self.assertEqual(result, [True, True])
+
+    def test_plugin_lifecycle(self):
+        from plugin_base import PluginBase
+        calls = []
+
+        class Probe(PluginBase):
+            def initialize(self, context):
+                calls.append(('initialize', context['namespace']))
+
+            def bind(self, context):
+                calls.append('bind')
+
+            def shutdown(self):
+                calls.append('shutdown')
+
+            def get_lua_interface(self):
+                return {}
+
+            @property
+            def name(self):
+                return "probe"
+
+        self.db.plugins['probe'] = Probe
+        self.db.create_namespace('lifecycle')
+        for _ in range(3):
+            self.db.execute_query('lifecycle', "return 1")
+        # Started once for the namespace, bound for every query
+        self.assertEqual(calls, [('initialize', 'lifecycle'), 'bind', 'bind', 'bind'])
+        monitor = self.db.namespaces['lifecycle']['handle']['plugins']['monitor']
+        self.assertTrue(monitor.monitor_thread.is_alive())
+
+        self.db.max_open_namespaces = 0
+        self.assertIn('lifecycle', self.db.evict_namespaces())
+        self.assertEqual(calls[-1], 'shutdown')
+        self.assertFalse(monitor.monitor_thread.is_alive())
+
+    def test_compiled_query_cache(self):
+        query = "return 1 + 1"
+        self.assertEqual(self.execute_query(query), 2)
+        hits = self.db.compiled_cache_stats()['hits']
+        self.assertEqual(self.execute_query(query), 2)
+        self.assertEqual(self.db.compiled_cache_stats()['hits'], hits + 1)
+
+        self.assertEqual(self.db.invalidate_compiled_queries('test_namespace', query), 1)
+        misses = self.db.compiled_cache_stats()['misses']
+        self.execute_query(query)
+        self.assertEqual(self.db.compiled_cache_stats()['misses'], misses + 1)
+
+    def test_prepared_queries(self):
+        self.db.prepare('test_namespace', 'add', "return params.a + params.b")
+        result = self.db.execute_prepared('test_namespace', 'add', {'a': 2, 'b': 3})
+        self.assertEqual(result, 5)
+        self.assertIn('add', self.db.list_prepared('test_namespace'))
+
+        with self.assertRaises(ValueError):
+            self.db.execute_prepared('test_namespace', 'missing')
+
+    def test_read_only_queries(self):
+        self.execute_query("db_put('ro_key', 'ro_value')")
+        result = self.db.execute_query('test_namespace', "return db_get('ro_key')", read_only=True)
+        self.assertEqual(result, 'ro_value')
+
+        with self.assertRaises(ValueError):
+            self.db.execute_query('test_namespace', "db_put('ro_key', 'other')", read_only=True)
+        # Names built at runtime are caught when the function is called
+        dynamic = "local f = _G['db_' .. 'put']; f('ro_key', 'other')"
+        for read_only in (None, True):
+            with self.assertRaises(ValueError):
+                self.db.execute_query('test_namespace', dynamic, read_only=read_only)
+        self.assertEqual(self.execute_query("return db_get('ro_key')"), 'ro_value')
+        self.db.execute_query('test_namespace', dynamic, read_only=False)
+        self.assertEqual(self.execute_query("return db_get('ro_key')"), 'other')
+
+    def test_model_calls_release_the_lock(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from plugin_base import PluginBase
+        entered, finish = threading.Event(), threading.Event()
+
+        class SlowModel(PluginBase):
+            model_functions = ('slow_complete',)
+
+            def initialize(self, context):
+                pass
+
+            def get_lua_interface(self):
+                return {'slow_complete': self.lua_callable(self.complete)}
+
+            def complete(self):
+                entered.set()
+                finish.wait(10)
+                return 'done'
+
+            @property
+            def name(self):
+                return "slow_model"
+
+        self.db.plugins['slow_model'] = SlowModel
+        self.db.create_namespace('models')
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            reader = pool.submit(self.db.execute_query, 'models', "return {slow_complete(), db_get('key')}")
+            self.assertTrue(entered.wait(5))
+            # A writer, and a reader queued behind it, don't wait for the model
+            writer = pool.submit(self.db.execute_query, 'models', "db_put('key', 'value')")
+            writer.result(timeout=5)
+            self.assertEqual(self.db.execute_query('models', "return db_get('key')"), 'value')
+            finish.set()
+            # The reader takes the lock back before its next read
+            self.assertEqual(self._decode(reader.result(timeout=5)), ['done', 'value'])
+
+    @unittest.skipUnless(importlib.util.find_spec('rocksdb'), "rocksdb is not installed")
+    def test_rocksdb_column_family_options(self):
+        cache = RocksDBStorage.create_block_cache(8 * 1024 ** 2)
+        profile = {'write_buffer_size': 8 * 1024 ** 2, 'compression': 'zstd', 'block_size': 16384, 'block_cache': cache}
+        storage = RocksDBStorage('./test_data/cf_options.db', profile)
+        try:
+            storage.create_column_family('mycf')
+            storage.put_cf('mycf', b'k', b'v')
+        finally:
+            storage.close()
+        # Reopening applies the profile to the existing column family too
+        storage = RocksDBStorage('./test_data/cf_options.db', profile)
+        try:
+            self.assertEqual(storage.get_cf('mycf', b'k'), b'v')
+        finally:
+            storage.close()
+
+        # RocksDB records the options each column family was opened with
+        import glob
+        latest = max(glob.glob('./test_data/cf_options.db/OPTIONS-*'), key=os.path.getmtime)
+        with open(latest) as f:
+            options = f.read()
+        cf_section = options.split('[CFOptions "mycf"]')[1].split('[')[0]
+        self.assertIn(f"write_buffer_size={8 * 1024 ** 2}", cf_section)
+        self.assertIn("compression=kZSTD", cf_section)
+        # The table factory carrying the bloom filter and shared block cache
+        table_section = options.split('[TableOptions/BlockBasedTable "mycf"]')[1].split('[')[0]
+        self.assertIn("block_size=16384", table_section)
+
+    def test_idle_namespaces_reopen(self):
+        self.db.close()
+        self.db = Database(data_dir='./test_data', storage_type='leveldb', namespace_idle_timeout=0.1)
+        self.db.execute_query('test_namespace', "db_create_column_family('mycf'); db_put_cf('mycf', 'k', 'v')")
+        # The sweep closes the namespace without any other query arriving
+        deadline = time.monotonic() + 5
+        while self.db.namespaces['test_namespace']['handle'] is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertIsNone(self.db.namespaces['test_namespace']['handle'])
+        # LevelDB column families are found again after reopening
+        self.assertEqual(self.db.execute_query('test_namespace', "return db_get_cf('mycf', 'k')"), 'v')
+        self.assertEqual(self._decode(self.db.execute_query('test_namespace', "return db_scan{}"))['items'], [])
+
+    def test_storage_profiles(self):
+        self.db.create_namespace('read_ns', profile='read_heavy')
+        self.assertEqual(self.db.namespaces['read_ns']['profile'], 'read_heavy')
+        self.db.execute_query('read_ns', "db_put('k', 'v')")
+        self.assertEqual(self.db.execute_query('read_ns', "return db_get('k')"), 'v')
+
+        with self.assertRaises(ValueError):
+            self.db.create_namespace('bad_ns', profile='no_such_profile')
+        self.assertNotIn('bad_ns', self.db.list_namespaces())
+
+    def test_namespace_eviction(self):
+        self.db.max_open_namespaces = 1
+        self.execute_query("db_put('k', 'v1')")
+        self.db.create_namespace('other_ns')
+        self.assertNotIn('other_ns', self.db.open_namespaces())
+        self.db.execute_query('other_ns', "db_put('k', 'v2')")
+        self.assertEqual(self.db.open_namespaces(), ['other_ns'])
+        self.assertEqual(self.execute_query("return db_get('k')"), 'v1')
+        self.assertEqual(self.db.open_namespaces(), ['test_namespace'])
+
+    def test_shared_layout(self):
+        self.db.close()
+        self.db = Database(data_dir='./test_data', storage_type='leveldb', storage_layout='shared')
+        self.db.create_namespace('a')
+        self.db.create_namespace('b')
+        self.db.execute_query('a', "db_put('k', 'from a')")
+        self.db.execute_query('b', "db_put('k', 'from b')")
+        self.db.execute_query('a', "db_create_column_family('cf'); db_put_cf('cf', 'k', 'cf of a')")
+        self.db.execute_query('b', "db_create_column_family('cf')")
+        self.assertEqual(self.db.execute_query('a', "return db_get('k')"), 'from a')
+        self.assertEqual(self.db.execute_query('b', "return db_get('k')"), 'from b')
+        self.assertIsNone(self.db.execute_query('b', "return db_get_cf('cf', 'k')"))
+        self.assertFalse(os.path.exists('./test_data/a.db'))
+
+    def test_lazy_plugins(self):
+        self.assertEqual(self.db.open_namespaces(), [])
+        self.execute_query("return 1")
+        handle = self.db.namespaces['test_namespace']['handle']
+        self.assertIn('db', handle['plugins'])
+        # Model-backed plugins only start when one of their functions is called
+        self.assertNotIn('llm', handle['plugins'])
+        self.assertIn('llm', handle['lazy'])
+
+    def test_vdb_add_batch(self):
+        self.execute_query("vdb_create_index(3)")
+        self.execute_query("vdb_add_batch({1, 2, 3}, {{1, 0, 0}, {0, 1, 0}, {0, 0, 1}})")
+        result = self.execute_query("return vdb_search({0, 1, 0}, 1)")
+        self.assertEqual(result[0]['key'], 2)
+
+        # Inserts go to the log; the index file is only rewritten at checkpoints
+        log_path = './test_data/test_namespace_index.usearch.log'
+        self.assertGreater(os.path.getsize(log_path), 0)
+        self.execute_query("vdb_save()")
+        self.assertEqual(os.path.getsize(log_path), 0)
+
+        self.execute_query("vdb_add(4, {1, 1, 0})")
+        self.execute_query("vdb_remove(1)")
+        self.db.close()
+        self.db = Database(data_dir='./test_data', storage_type='leveldb')
+        self.assertEqual(self.execute_query("return vdb_count()"), {'count': 3})
+
+    def test_vdb_view_mode(self):
+        self.execute_query("vdb_create_index(2)")
+        self.execute_query("vdb_add_batch({1, 2}, {{1, 0}, {0, 1}})")
+        # Mapping the file folds the logged inserts into it first
+        self.execute_query("vdb_load{view=true}")
+        self.assertTrue(self.execute_query("return vdb_get_metadata()")['view'])
+        self.assertEqual(self.execute_query("return vdb_search({0, 1}, 1)")[0]['key'], 2)
+
+        # Changes load the index back into memory
+        self.execute_query("vdb_add(3, {1, 1})")
+        metadata = self.execute_query("return vdb_get_metadata()")
+        self.assertFalse(metadata['view'])
+        self.assertEqual(metadata['ndim'], 2)
+        self.assertEqual(self.execute_query("return vdb_count()"), {'count': 3})
+
+    def test_vdb_batch_and_filtered_search(self):
+        self.execute_query("vdb_create_index(2)")
+        self.execute_query("vdb_add_batch({1, 2, 3, 4}, {{1, 0}, {0.9, 0.1}, {0, 1}, {0.1, 0.9}})")
+
+        result = self.execute_query("""
+            local results = vdb_search_batch({{1, 0}, {0, 1}}, 1)
+            return {results[1][1].key, results[2][1].key}
+        """)
+        self.assertEqual(result, [1, 3])
+
+        result = self.execute_query("return vdb_filter_search({1, 0}, 2, {keys = {3, 4}})")
+        self.assertEqual([match['key'] for match in result], [4, 3])
+
+        self.execute_query("db_put('tenant:a', {2, 4})")
+        result = self.execute_query("return vdb_filter_search({1, 0}, 1, {keys_from = 'tenant:a'})")
+        self.assertEqual(result[0]['key'], 2)
+
+        result = self.execute_query("""
+            local matches = vdb_filter_search({1, 0}, 3, function(key) return key % 2 == 1 end)
+            return #matches
+        """)
+        self.assertEqual(result, 2)
+
+    def test_vdb_document_keys(self):
+        self.execute_query("vdb_create_index(2)")
+        self.execute_query("db_put('doc:a', 'first')")
+        self.execute_query("vdb_add('doc:a', {1, 0}, {title = 'A'})")
+        self.execute_query("vdb_add_batch({'doc:b', 'doc:c'}, {{0, 1}, {0.1, 0.9}}, {{title = 'B'}, {title = 'C'}})")
+
+        result = self.execute_query("return vdb_search({1, 0}, 1, true)")
+        self.assertEqual(result[0]['doc'], 'doc:a')
+        self.assertEqual(result[0]['payload'], {'title': 'A'})
+        self.assertEqual(result[0]['value'], 'first')
+
+        result = self.execute_query("return vdb_filter_search({1, 0}, 1, {keys = {'doc:c'}}, true)")
+        self.assertEqual(result[0]['payload'], {'title': 'C'})
+
+        # Re-adding a document keeps its id
+        self.execute_query("vdb_add('doc:a', {0.5, 0.5})")
+        self.assertEqual(self.execute_query("return vdb_count()")['count'], 3)
+
+        self.execute_query("vdb_remove('doc:b')")
+        result = self.execute_query("return vdb_search({0, 1}, 3, true)")
+        self.assertEqual(sorted(match['doc'] for match in result), ['doc:a', 'doc:c'])
+
+    def test_vdb_mappings_stay_out_of_scans(self):
+        # On LevelDB the vdb column families share the default keyspace
+        self.db.create_namespace('utf8_vdb', codec={'key': 'utf8'})
+        run = lambda query: self._decode(self.db.execute_query('utf8_vdb', query))
+        run("vdb_create_index(2)")
+        run("db_put('doc:a', 'first')")
+        run("vdb_add('doc:a', {1, 0}, {title = 'A'})")
+        self.assertEqual([item['key'] for item in run("return db_scan{}")['items']], ['doc:a'])
+        self.assertEqual(run("return db_iterator()"), [{'doc:a': 'first'}])
+
+        self.assertEqual(self.db.migrate_codec('utf8_vdb', key_codec='ordered')['migrated'], 1)
+        result = run("return vdb_search({1, 0}, 1, true)")
+        self.assertEqual((result[0]['doc'], result[0]['payload']), ('doc:a', {'title': 'A'}))
+        self.assertEqual(result[0]['value'], 'first')
+
+    def test_vdb_requantize_and_compact(self):
+        self.execute_query("vdb_create_index(4)")
+        self.execute_query("""
+            local keys, vectors = {}, {}
+            for i = 1, 200 do
+                keys[i] = i
+                vectors[i] = {math.sin(i), math.cos(i), math.sin(2 * i), 1}
+            end
+            vdb_add_batch(keys, vectors)
+            for i = 1, 50 do vdb_remove(i) end
+        """)
+        # Both replace the live index, so they can't run as read-only queries
+        for query in ("return vdb_requantize('i8', true)", "return vdb_compact(true)"):
+            with self.assertRaises(ValueError):
+                self.db.execute_query('test_namespace', query, read_only=True)
+        result = self.execute_query("return vdb_requantize('i8', true)")
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(self.execute_query("return vdb_get_metadata()")['dtype'], 'i8')
+        self.assertEqual(self.execute_query("return vdb_count()")['count'], 150)
+        result = self.execute_query("return vdb_search({math.sin(60), math.cos(60), math.sin(120), 1}, 1)")
+        self.assertEqual(result[0]['key'], 60)
+
+        # Changes made while the copy is being built end up in it
+        self.execute_query("vdb_compact()")
+        self.execute_query("vdb_add(500, {1, 0, 0, 1})")
+        self.db.namespaces['test_namespace']['handle']['plugins']['vdb'].rebuild_thread.join()
+        self.assertEqual(self.execute_query("return vdb_count()")['count'], 151)
+        self.assertEqual(self.execute_query("return vdb_search({1, 0, 0, 1}, 1)")[0]['key'], 500)
+
+    def test_emit(self):
+        emitted = []
+        result = self.db.execute_query('test_namespace', """
+            for i = 1, 3 do emit(i) end
+            emit({done = true})
+            return 'finished'
+        """, emit=emitted.append)
+        self.assertEqual(result, 'finished')
+        self.assertEqual(emitted, [1, 2, 3, {'done': True}])
+        # Without a listener emit() is a no-op
+        self.assertEqual(self.execute_query("return emit('x')"), False)
+
+    def test_query_cache(self):
+        self.execute_query("db_put('total', '1')")
+        query = "return cached_query('return db_get(params.key)', {key = 'total'})"
+        self.assertEqual(self.execute_query(query), '1')
+        self.assertEqual(self.execute_query(query), '1')
+        stats = self.execute_query("return query_cache_stats()")
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # Any write to the namespace invalidates cached results
+        self.execute_query("db_put('total', '2')")
+        self.assertEqual(self.execute_query(query), '2')
+        self.assertEqual(self.execute_query("return query_cache_stats()")['misses'], 2)
+
+        # Writes are counted by the storage, however the query reached them
+        self.db.execute_query('test_namespace', "local f = _G['db_' .. 'put']; f('total', '3')", read_only=False)
+        self.assertEqual(self.execute_query(query), '3')
+        self.execute_query("db_write_batch({{type = 'put', key = 'total', value = '4'}})")
+        self.assertEqual(self.execute_query(query), '4')
+
+        # Misses compile the cached query through the compiled-chunk cache
+        self.execute_query("db_put('total', '5')")
+        hits = self.db.compiled_cache_stats()['hits']
+        self.assertEqual(self.execute_query(query), '5')
+        self.assertEqual(self.db.compiled_cache_stats()['hits'], hits + 2)
+
+        # So do plugin changes that never reach the storage
+        self.execute_query("vdb_create_index(2); vdb_add(1, {1, 0})")
+        search = "return cached_query('return vdb_search({1.0, 0.0}, 5)')"
+        keys = lambda: [match['key'] for match in self._decode(self.execute_query(search))]
+        self.assertEqual(keys(), [1])
+        self.execute_query("vdb_add_batch({2}, {{0.9, 0.1}})")
+        self.assertEqual(keys(), [1, 2])
+        self.execute_query("vdb_compact(true)")
+        self.assertEqual(keys(), [1, 2])
+        self.execute_query("vdb_clear()")
+        self.assertEqual(keys(), [])
+        misses = self.execute_query("return query_cache_stats()")['misses']
+        keys()
+        self.assertEqual(self.execute_query("return query_cache_stats()")['misses'], misses)
+
+    def test_embedding_cache(self):
+        import numpy as np
+        calls = []
+
+        class Model:
+            def embed(self, texts, batch_size, parallel):
+                calls.append(list(texts))
+                return [np.array([len(text), 1.0]) for text in texts]
+
+        # The plugin class as loaded by the database, given a stub model
+        # instead of a fastembed one
+        plugin = self.db.plugins['embed']()
+        plugin.db = LevelDBStorage('./test_data/embed_cache.db')
+        plugin.db.create_column_family(plugin.CACHE_CF)
+        plugin.current_type, plugin.current_model = "text", "stub"
+        plugin.embedding_model = Model()
+        try:
+            result = json.loads(plugin.embed_batch(['a', 'bb', 'a']))
+            self.assertEqual(result, {"embeddings": [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]], "cached": 0})
+            # Repeated texts are embedded once
+            self.assertEqual(calls, [['a', 'bb']])
+
+            result = json.loads(plugin.embed_batch(['bb', 'a']))
+            self.assertEqual(result['cached'], 2)
+            self.assertEqual(len(calls), 1)
+
+            plugin.clear_cache()
+            self.assertEqual(json.loads(plugin.embed_batch(['a']))['cached'], 0)
+            self.assertEqual(calls[-1], ['a'])
+        finally:
+            plugin.db.close()
+
+    def test_llm_stream(self):
+        class Model:
+            # Streams the prompt reversed, one character per chunk. It has a
+            # prompt cache already, so the scheduler doesn't add llama.cpp's.
+            cache = {}
+
+            def __call__(self, prompt, max_tokens, stopping_criteria, stream):
+                return iter([{"choices": [{"text": ch}]} for ch in prompt[::-1]])
+
+        LLMPlugin = self.db.plugins['llm']
+
+        class StubLLMPlugin(LLMPlugin):
+            def initialize(self, context):
+                import threading
+                from response_cache import ResponseCache
+                self.namespace = context['namespace']
+                self.plugin = context['plugin']
+                self.cache = ResponseCache(context['db'])
+                self.mode, self.current_model, self.model_key = "local", "stub", None
+                self.llm = Model()
+                self._local = threading.local()
+
+        self.db.plugins['llm'] = StubLLMPlugin
+        self.db.create_namespace('llm_ns')
+        emitted = []
+        result = self.db.execute_query('llm_ns', "return llm_stream('abc', emit)", emit=emitted.append)
+        self.assertEqual(emitted, ['c', 'b', 'a'])
+        self.assertEqual(json.loads(result), {"text": "cba"})
+
+        result = self.db.execute_query('llm_ns', """
+            local parts = {}
+            for chunk in llm_stream('xyz') do parts[#parts + 1] = chunk end
+            return table.concat(parts, ',')
+        """)
+        self.assertEqual(result, 'z,y,x')
+
+    @unittest.skipUnless(importlib.util.find_spec('flask'), "flask is not installed")
+    def test_server_streaming(self):
+        import server
+        server.app.config['db'] = self.db
+        client = server.app.test_client()
+
+        def events(query):
+            response = client.post('/query', json={'namespace': 'test_namespace', 'query': query, 'stream': True})
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            return [block for block in response.get_data(as_text=True).split('\n\n') if block]
+
+        self.assertEqual(events("emit(1); emit({a = 2}); return 'done'"),
+                         ['data: 1', 'data: {"a": 2}', 'event: result\ndata: done'])
+        blocks = events("emit('partial'); error('boom')")
+        self.assertEqual(blocks[0], 'data: "partial"')
+        self.assertTrue(blocks[1].startswith('event: error\ndata: '))
+        self.assertIn('boom', blocks[1])
+
+    def test_model_registry(self):
+        from model_registry import ModelRegistry
+        registry = ModelRegistry(budget=100)
+        loads = []
+
+        def loader(name):
+            return lambda: loads.append(name) or name
+
+        self.assertEqual(registry.acquire('a', loader('a'), size=60), 'a')
+        self.assertEqual(registry.acquire('a', loader('a'), size=60), 'a')
+        self.assertEqual(loads, ['a'])
+
+        # 'a' is still referenced, so it stays loaded over budget
+        registry.acquire('b', loader('b'), size=60)
+        self.assertEqual(registry.stats()['used'], 120)
+
+        registry.release('a')
+        registry.release('a')
+        # Once released, 'a' is unloaded to get back under budget
+        self.assertEqual([model['key'] for model in registry.stats()['models']], ['b'])
+        # 'b' fits the budget, so it stays loaded after its release
+        registry.release('b')
+        registry.acquire('b', loader('b'), size=60)
+        registry.acquire('a', loader('a'), size=60)
+        self.assertEqual(loads, ['a', 'b', 'a'])
+        self.assertEqual(registry.stats()['evictions'], 1)
+
+    def test_response_cache(self):
+        import time
+        from response_cache import ResponseCache
+
+        def embed(text):
+            # Letter counts: prompts differing in case or punctuation match
+            return [text.lower().count(ch) + 0.01 for ch in 'abcdefghijklmnopqrstuvwxyz']
+
+        db = LevelDBStorage('./test_data/response_cache.db')
+        try:
+            cache = ResponseCache(db, embed=embed)
+            params = {"model": "m", "prompt": "What is Liath?", "max_tokens": 10}
+            self.assertIsNone(cache.get('complete', params, params['prompt']))
+            cache.put('complete', params, {"text": "A database"}, params['prompt'])
+            self.assertEqual(cache.get('complete', params, params['prompt']), {"text": "A database"})
+
+            cache.configure(semantic=True, threshold=0.99)
+            cache.put('complete', params, {"text": "A database"}, params['prompt'])
+            similar = dict(params, prompt="what is liath")
+            self.assertEqual(cache.get('complete', similar, similar['prompt']), {"text": "A database"})
+            # Other parameters must match exactly
+            longer = dict(similar, max_tokens=20)
+            self.assertIsNone(cache.get('complete', longer, longer['prompt']))
+            self.assertEqual(cache.stats()['semantic_hits'], 1)
+
+            # Settings persist in the DB; expired entries are dropped
+            cache = ResponseCache(db, embed=embed)
+            cache.configure(ttl=0.01)
+            cache.put('chat', {"messages": ["hi"]}, {"text": "hello"})
+            time.sleep(0.02)
+            self.assertIsNone(cache.get('chat', {"messages": ["hi"]}))
+            self.assertTrue(cache.config['semantic'])
+            self.assertEqual(cache.clear(), 1)
+        finally:
+            db.close()
+
+    def test_inference_scheduler(self):
+        import threading
+        from inference import InferenceScheduler
+        gate = threading.Event()
+        prompts = []
+
+        class Model:
+            # Answers with the prompt reversed; 'slow' waits for the gate
+            def __call__(self, prompt, max_tokens, stopping_criteria, stream):
+                prompts.append(prompt)
+                if prompt == 'slow':
+                    gate.wait(5)
+                text = prompt[::-1]
+                if stream:
+                    return iter([{"choices": [{"text": ch}]} for ch in text])
+                return {"choices": [{"text": text}]}
+
+        scheduler = InferenceScheduler(max_pending=3, prefix_cache_size=None)
+        model = Model()
+        slow = scheduler.submit(model, 'a', 'complete', prompt='slow', max_tokens=5)
+        # Identical requests queued behind it are generated once
+        first = scheduler.submit(model, 'a', 'complete', prompt='abc', max_tokens=5)
+        second = scheduler.submit(model, 'a', 'complete', prompt='abc', max_tokens=5)
+        with self.assertRaises(RuntimeError):
+            scheduler.submit(model, 'a', 'complete', prompt='xyz', max_tokens=5)
+        other = scheduler.submit(model, 'b', 'complete', prompt='xyz', max_tokens=5)
+
+        gate.set()
+        self.assertEqual(scheduler.result(slow)["choices"][0]["text"], 'wols')
+        self.assertEqual(scheduler.result(first), scheduler.result(second))
+        self.assertEqual(scheduler.result(other)["choices"][0]["text"], 'zyx')
+        self.assertEqual(prompts.count('abc'), 1)
+
+        chunks = scheduler.stream(model, 'a', 'complete', prompt='hey', max_tokens=5)
+        self.assertEqual(list(chunks), ['y', 'e', 'h'])
+        self.assertEqual(scheduler.stats()['pending'], {})
+
+    def test_hybrid_search(self):
+        self.execute_query("""
+            sparse_index_batch({
+                ['doc:a'] = 'the quick brown fox',
+                ['doc:b'] = 'a lazy dog sleeps all day',
+                ['doc:c'] = 'quick thinking saves the day',
+            })
+        """)
+        result = self.execute_query("return sparse_search('quick fox', 2)")
+        self.assertEqual([hit['doc'] for hit in result], ['doc:a', 'doc:c'])
+
+        self.execute_query("sparse_remove('doc:a')")
+        self.assertEqual(self.execute_query("return sparse_stats()")['count'], 2)
+        self.execute_query("sparse_index('doc:a', 'the quick brown fox')")
+
+        self.execute_query("vdb_create_index(2)")
+        self.execute_query("vdb_add_batch({'doc:a', 'doc:b', 'doc:c'}, {{0, 1}, {1, 0}, {0.9, 0.1}})")
+        result = self.execute_query("return hybrid_search{text = 'quick day', vector = {1, 0}, k = 3}")
+        # doc:c ranks well on both sides, so fusion puts it first
+        self.assertEqual(result[0]['doc'], 'doc:c')
+        self.assertEqual((result[0]['dense_rank'], result[0]['sparse_rank']), (2, 1))
+
+        result = self.execute_query("return hybrid_search{text = 'lazy dog', dense = false, k = 1}")
+        self.assertEqual(result[0]['doc'], 'doc:b')
+
     def test_plugin_availability(self):
         # Test if db plugin is available (should always be true)
         result = self.execute_query("return plugins.db")
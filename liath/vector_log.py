@@ -0,0 +1,84 @@
+import os
+import struct
+import threading
+import numpy as np
+
+# Record header: operation, number of keys, vector dimensions (0 for removes)
+_HEADER = struct.Struct('<BII')
+_ADD = 1
+_REMOVE = 2
+
+
+class VectorLog:
+    """Append-only log of vector index changes since the last checkpoint.
+
+    The usearch index is only written out at checkpoints. Every add and
+    remove in between is appended here, and replayed on top of the last
+    checkpoint when the index is loaded again.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+
+    def append_add(self, keys, vectors):
+        keys = np.ascontiguousarray(keys, dtype='<u8')
+        vectors = np.ascontiguousarray(vectors, dtype='<f4').reshape(len(keys), -1)
+        self._write(_HEADER.pack(_ADD, len(keys), vectors.shape[1]) + keys.tobytes() + vectors.tobytes())
+
+    def append_remove(self, keys):
+        keys = np.ascontiguousarray(keys, dtype='<u8')
+        self._write(_HEADER.pack(_REMOVE, len(keys), 0) + keys.tobytes())
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def replay(self, index):
+        # Applies every complete record to index and returns how many keys
+        # they touched. A record cut short by a crash ends the replay and is
+        # cut off, so later appends aren't stuck behind it.
+        applied = 0
+        end = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                op, count, ndim = _HEADER.unpack(header)
+                keys = f.read(count * 8)
+                vectors = f.read(count * ndim * 4)
+                if len(keys) < count * 8 or len(vectors) < count * ndim * 4:
+                    break
+                keys = np.frombuffer(keys, dtype='<u8')
+                # Keys already in the checkpoint are replaced, so replaying a
+                # log that outlived its checkpoint is harmless
+                existing = keys[np.atleast_1d(index.contains(keys))]
+                if len(existing):
+                    index.remove(existing)
+                if op == _ADD:
+                    index.add(keys, np.frombuffer(vectors, dtype='<f4').reshape(count, ndim))
+                applied += count
+                end = f.tell()
+        with self._lock:
+            if os.path.getsize(self.path) > end:
+                self._file.truncate(end)
+        return applied
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def truncate(self):
+        with self._lock:
+            self._file.truncate(0)
+            self._file.seek(0)
+
+    def close(self):
+        with self._lock:
+            self._file.close()